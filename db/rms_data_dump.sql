@@ -54,14 +54,15 @@ CREATE TABLE `restaurantUser` (
 	`id`	INTEGER PRIMARY KEY AUTOINCREMENT,
 	`userId`	INTEGER,
 	`restaurantId`	INTEGER,
+	`position`	TEXT,
 	FOREIGN KEY(userId) REFERENCES user(userId) ON DELETE CASCADE,
 	FOREIGN KEY(restaurantId) REFERENCES restaurant(restaurantId) ON DELETE CASCADE
 );
-INSERT INTO `restaurantUser` (id,userId,restaurantId) VALUES (1,1,1),
- (2,1,2),
- (3,2,3),
- (4,3,4),
- (5,4,4);
+INSERT INTO `restaurantUser` (id,userId,restaurantId,position) VALUES (1,1,1,'owner'),
+ (2,1,2,'owner'),
+ (3,2,3,'owner'),
+ (4,3,4,'owner'),
+ (5,4,4,'employee');
 CREATE TABLE `restaurant` (
 	`restaurantId`	INTEGER PRIMARY KEY AUTOINCREMENT,
 	`restaurantName`	TEXT,
@@ -71,7 +72,8 @@ CREATE TABLE `restaurant` (
 INSERT INTO `restaurant` (restaurantId,restaurantName,address,phone) VALUES (1,'Milano','Yliopistokatu 12, Oulu, Finland','0458885555'),
  (2,'Rodin','Keskustie, Jyvaskyla, Finland','0477765555'),
  (3,'FastPizza','Jyvasentie1, Jyvaskyla, Finland','0558866333'),
- (4,'Opera','Poistokatu, Oulu, Finland','0556633227');
+ (4,'Opera','Poistokatu, Oulu, Finland','0556633227'),
+ (5,'Sheraz','tuira, oulu, Finland','047555325');
 CREATE TABLE "item" (
 	`itemId`	INTEGER PRIMARY KEY AUTOINCREMENT,
 	`itemName`	TEXT,
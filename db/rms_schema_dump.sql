@@ -34,6 +34,14 @@ CREATE TABLE `stock` (
 	FOREIGN KEY(restaurantId) references restaurant(restaurantId) ON DELETE CASCADE,
 	FOREIGN KEY(userId) references user(userId) ON DELETE CASCADE
 );
+CREATE TABLE `restaurantUser` (
+	`id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+	`userId`	INTEGER,
+	`restaurantId`	INTEGER,
+	`position`	TEXT,
+	FOREIGN KEY(userId) REFERENCES user(userId) ON DELETE CASCADE,
+	FOREIGN KEY(restaurantId) REFERENCES restaurant(restaurantId) ON DELETE CASCADE
+);
 CREATE TABLE `restaurant` (
 	`restaurantId`	INTEGER PRIMARY KEY AUTOINCREMENT,
 	`restaurantName`	TEXT,
@@ -0,0 +1,419 @@
+'''
+Created on 16.10.2026
+
+Non-blocking access to the database API provided by :py:mod:`database`.
+
+:py:class:`AsyncConnection` exposes the methods of
+:py:class:`database.Connection` as requests that return a :py:class:`Future`
+immediately. Reads are run by a pool of reader threads and writes by a single
+writer thread, which matches the locking model of SQLite: many concurrent
+readers and one writer at a time. An event loop can wait for a request
+without blocking by scheduling its continuation from
+:py:meth:`Future.add_done_callback`.
+
+:Example:
+
+>>> engine = Engine(pool_size=5)
+>>> con = AsyncConnection(engine, readers=4)
+>>> future = con.get_user('ahmad', timeout=1.0)
+>>> user = future.result()
+>>> con.close()
+
+'''
+
+import sqlite3, threading, time, Queue
+
+#Number of reader threads of an AsyncConnection by default.
+DEFAULT_READERS = 4
+
+#Methods of database.Connection run by the reader threads.
+READ_METHODS = ('get_user', 'get_restaurant', 'get_restaurant_details',
+                'get_users', 'get_restaurants', 'get_users_page',
+                'get_restaurants_page', 'search_users', 'search_restaurants',
+                'search_items', 'get_stock_level', 'get_stock_levels',
+                'get_stock_transactions', 'get_expiring_batches',
+                'get_changes', 'get_password_hash')
+#Methods of database.Connection run by the writer thread.
+WRITE_METHODS = ('append_user', 'append_restaurant',
+                 'assign_user_to_restaurant', 'modify_user',
+                 'modify_restaurant', 'delete_user', 'append_users_bulk',
+                 'append_restaurants_bulk', 'append_items_bulk',
+                 'append_vendors_bulk', 'record_stock_transaction',
+                 'sweep_expired_batches', 'compact_changes',
+                 'set_password_hash')
+
+_PENDING, _RUNNING, _FINISHED, _CANCELLED = range(4)
+
+
+class RequestTimeoutError(Exception):
+    '''
+    Raised by :py:meth:`Future.result` when the request did not start before
+    its deadline, or when the result is not available within the time given
+    to :py:meth:`Future.result`.
+
+    '''
+    pass
+
+
+class RequestCancelledError(Exception):
+    '''
+    Raised by :py:meth:`Future.result` when the request was cancelled.
+
+    '''
+    pass
+
+
+class Future(object):
+    '''
+    Result of a request sent to an :py:class:`AsyncConnection`.
+
+    An instance of this class should not be instantiated directly. The
+    methods of :py:class:`AsyncConnection` return them.
+
+    '''
+    def __init__(self, method, deadline):
+        super(Future, self).__init__()
+        self.method = method
+        self.deadline = deadline
+        self._cond = threading.Condition()
+        self._state = _PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        #Aborts the running statement; set by the reader threads
+        self._interrupt = None
+
+    def cancel(self):
+        '''
+        Cancels the request. A pending request is never run. A running read
+        is interrupted with :py:meth:`database.Connection.interrupt`. Running
+        writes cannot be cancelled.
+
+        :return: ``True`` if the request was cancelled or interrupted.
+
+        '''
+        with self._cond:
+            if self._state == _PENDING:
+                self._state = _CANCELLED
+                self._exception = RequestCancelledError(self.method)
+                self._cond.notify_all()
+            elif self._state == _RUNNING and self._interrupt is not None:
+                self._interrupt()
+                self._interrupt = None
+                self._exception = RequestCancelledError(self.method)
+                return True
+            else:
+                return False
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        with self._cond:
+            return self._state == _CANCELLED
+
+    def done(self):
+        with self._cond:
+            return self._state in (_FINISHED, _CANCELLED)
+
+    def result(self, timeout=None):
+        '''
+        Waits for the request and returns the value returned by the
+        :py:class:`database.Connection` method.
+
+        :param float timeout: maximum number of seconds to wait. If None,
+            waits until the request is done.
+        :raises RequestTimeoutError: if the request is not done in time.
+        :raises RequestCancelledError: if the request was cancelled.
+        :raises Exception: the exception raised by the method, if any.
+
+        '''
+        with self._cond:
+            if timeout is not None:
+                end = time.time() + timeout
+            while self._state not in (_FINISHED, _CANCELLED):
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise RequestTimeoutError(self.method)
+                    self._cond.wait(remaining)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+    def exception(self, timeout=None):
+        '''
+        Waits for the request and returns the exception it raised, or None.
+
+        '''
+        try:
+            self.result(timeout)
+        except RequestTimeoutError:
+            if not self.done():
+                raise
+            return self._exception
+        except Exception, excp:
+            return excp
+        return None
+
+    def add_done_callback(self, fn):
+        '''
+        Calls ``fn(future)`` when the request is done. The callback runs in
+        the worker thread, or immediately if the request is already done.
+
+        '''
+        with self._cond:
+            if self._state not in (_FINISHED, _CANCELLED):
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _start(self, interrupt=None):
+        '''
+        Marks the request as running. Returns ``False`` if it was cancelled
+        or its deadline has passed.
+
+        '''
+        with self._cond:
+            if self._state != _PENDING:
+                return False
+            if self.deadline is not None and time.time() > self.deadline:
+                self._state = _FINISHED
+                self._exception = RequestTimeoutError(self.method)
+                self._cond.notify_all()
+                expired = True
+            else:
+                self._state = _RUNNING
+                self._interrupt = interrupt
+                expired = False
+        if expired:
+            self._run_callbacks()
+            return False
+        return True
+
+    def _finish(self, result=None, exception=None):
+        with self._cond:
+            self._interrupt = None
+            if self._exception is not None:
+                #Cancelled while running
+                self._state = _CANCELLED
+            else:
+                self._state = _FINISHED
+                self._result = result
+                self._exception = exception
+            self._cond.notify_all()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        with self._cond:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+
+class _Worker(threading.Thread):
+    '''
+    Thread running the requests of a queue on its own
+    :py:class:`database.Connection`.
+
+    '''
+    def __init__(self, owner, queue, reader, name):
+        super(_Worker, self).__init__(name=name)
+        self.daemon = True
+        self.owner = owner
+        self.queue = queue
+        self.reader = reader
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            #The connection is opened in the thread that uses it
+            con = self.owner.engine.connect()
+        except Exception, excp:
+            self.error = excp
+            self.ready.set()
+            return
+        self.ready.set()
+        try:
+            while True:
+                request = self.queue.get()
+                if request is None:
+                    break
+                future, args, kwargs = request
+                interrupt = con.interrupt if self.reader else None
+                if not future._start(interrupt):
+                    continue
+                try:
+                    result = getattr(con, future.method)(*args, **kwargs)
+                except Exception, excp:
+                    future._finish(exception=excp)
+                else:
+                    future._finish(result)
+        finally:
+            con.close()
+
+
+def _request_method(name, write):
+    def method(self, *args, **kwargs):
+        timeout = kwargs.pop('timeout', self.timeout)
+        return self._submit(name, write, args, kwargs, timeout)
+    method.__name__ = name
+    method.__doc__ = '''
+        Sends a :py:meth:`database.Connection.%s` request to the %s.
+
+        Takes the same arguments as the Connection method plus an optional
+        ``timeout`` keyword: seconds the request may wait in the queue before
+        it fails with :py:class:`RequestTimeoutError`.
+
+        :rtype: Future
+
+        ''' % (name, 'writer thread' if write else 'reader threads')
+    return method
+
+
+class AsyncConnection(object):
+    '''
+    Non-blocking interface to the database.
+
+    Every method of :py:data:`READ_METHODS` and :py:data:`WRITE_METHODS` is
+    available with the same arguments as in :py:class:`database.Connection`
+    and returns a :py:class:`Future`. Reads are spread over ``readers``
+    threads, writes are run one at a time, in order, by a single writer
+    thread. Every thread holds its own :py:class:`database.Connection`, so
+    the :py:class:`database.Engine` pool must have at least ``readers + 1``
+    connections.
+
+    Use the method :py:meth:`close` to stop the threads and release their
+    connections.
+
+    :param engine: Engine used to open the connections of the threads.
+    :type engine: database.Engine
+    :param int readers: number of reader threads.
+    :param int max_queue: maximum number of requests waiting in each queue.
+        ``0`` means unbounded. When a queue is full the calling thread
+        blocks.
+    :param float timeout: default time in seconds a request may wait in its
+        queue, or None for no limit.
+    :raises ValueError: if the pool of the engine is too small.
+
+    '''
+    def __init__(self, engine, readers=DEFAULT_READERS, max_queue=0,
+                 timeout=None):
+        super(AsyncConnection, self).__init__()
+        if readers < 1:
+            raise ValueError("At least one reader thread is needed")
+        if engine.pool is not None and engine.pool.size < readers + 1:
+            raise ValueError("The engine pool has %d connections but %d are "
+                             "needed" % (engine.pool.size, readers + 1))
+        self.engine = engine
+        self.timeout = timeout
+        self._read_queue = Queue.Queue(max_queue)
+        self._write_queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._closed = False
+        #Metrics
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._timed_out = 0
+        self._max_read_depth = 0
+        self._max_write_depth = 0
+        self._workers = [_Worker(self, self._read_queue, True,
+                                 'rms-reader-%d' % i)
+                         for i in xrange(readers)]
+        self._workers.append(_Worker(self, self._write_queue, False,
+                                     'rms-writer'))
+        for worker in self._workers:
+            worker.start()
+        for worker in self._workers:
+            worker.ready.wait()
+        errors = [w.error for w in self._workers if w.error is not None]
+        if errors:
+            self.close()
+            raise errors[0]
+
+    def _submit(self, method, write, args, kwargs, timeout):
+        if self._closed:
+            raise RuntimeError("The AsyncConnection is closed")
+        deadline = time.time() + timeout if timeout is not None else None
+        future = Future(method, deadline)
+        future.add_done_callback(self._count)
+        queue = self._write_queue if write else self._read_queue
+        queue.put((future, args, kwargs))
+        with self._lock:
+            self._submitted += 1
+            depth = queue.qsize()
+            if write:
+                self._max_write_depth = max(self._max_write_depth, depth)
+            else:
+                self._max_read_depth = max(self._max_read_depth, depth)
+        return future
+
+    def _count(self, future):
+        with self._lock:
+            if future.cancelled():
+                self._cancelled += 1
+            elif isinstance(future._exception, RequestTimeoutError):
+                self._timed_out += 1
+            elif future._exception is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+
+    for _name in READ_METHODS:
+        locals()[_name] = _request_method(_name, False)
+    for _name in WRITE_METHODS:
+        locals()[_name] = _request_method(_name, True)
+    del _name
+
+    def metrics(self):
+        '''
+        Returns the state of the queues and the request counters.
+
+        :return: a dictionary with the following keys:
+
+            * ``read_queue_depth``: reads waiting for a reader thread
+            * ``write_queue_depth``: writes waiting for the writer thread
+            * ``max_read_queue_depth``: highest read queue depth seen
+            * ``max_write_queue_depth``: highest write queue depth seen
+            * ``submitted``: requests sent
+            * ``completed``: requests finished without error
+            * ``failed``: requests whose method raised an exception
+            * ``cancelled``: requests cancelled before or while running
+            * ``timed_out``: requests that waited past their deadline
+
+        '''
+        with self._lock:
+            return {'read_queue_depth': self._read_queue.qsize(),
+                    'write_queue_depth': self._write_queue.qsize(),
+                    'max_read_queue_depth': self._max_read_depth,
+                    'max_write_queue_depth': self._max_write_depth,
+                    'submitted': self._submitted,
+                    'completed': self._completed,
+                    'failed': self._failed,
+                    'cancelled': self._cancelled,
+                    'timed_out': self._timed_out
+                    }
+
+    def close(self):
+        '''
+        Stops the threads once the queued requests are done and closes their
+        connections.
+
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            if worker.reader:
+                self._read_queue.put(None)
+            else:
+                self._write_queue.put(None)
+        for worker in self._workers:
+            worker.join()
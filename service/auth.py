@@ -0,0 +1,542 @@
+'''
+Created on 16.10.2026
+
+Authentication of the users with salted password hashes and in-memory
+sessions.
+
+The passwords are stored in ``user.password`` as PBKDF2-HMAC hashes with a
+random salt and a tunable number of iterations, in the format
+``pbkdf2_sha256$iterations$salt$hash`` (see :py:class:`PasswordHasher`).
+The users created with a plaintext password can still log in: their
+password is hashed at their first login or by
+:py:meth:`Authenticator.upgrade_passwords`. A hash with fewer iterations
+than the hasher of the :py:class:`Authenticator` is also replaced at login.
+
+:py:meth:`Authenticator.verify_credentials` reads the stored hash through
+the unique index on ``username`` and gives its connection back before the
+password is hashed. The hashes run in a pool of threads, one per CPU by
+default. hashlib releases the GIL while it hashes, so the pool hashes in
+parallel while the other threads keep using the database, and a burst of
+logins never takes more CPUs than the pool has threads. A successful login
+opens a session that stays in memory until it expires, so the next requests
+of the user are checked by :py:meth:`Authenticator.check_session` without
+hashing. The session remembers the stored hash of the login, and it ends as
+soon as the stored hash changes or the user is deleted, through any
+Connection.
+
+:Example:
+
+>>> auth = Authenticator(Engine())
+>>> auth.register_user('ali', user)
+'ali'
+>>> token = auth.verify_credentials('ali', '12335')
+>>> auth.check_session(token)
+'ali'
+>>> auth.close()
+
+or, to hash the plaintext passwords of an existing database::
+
+    python service/auth.py --db db/rms.db
+
+'''
+
+import argparse, base64, binascii, hashlib, hmac, multiprocessing, os, sys
+import threading, time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from database import Engine, DEFAULT_DB_PATH, DEFAULT_PAGE_SIZE
+
+#Hash function of the HMAC and default cost of a password hash. The time of
+#a login and of a brute force attack grow with the iterations.
+HASH_ALGORITHM = 'sha256'
+DEFAULT_HASH_ITERATIONS = 100000
+DEFAULT_SALT_BYTES = 16
+#Prefix of the stored hashes. A stored password without it is plaintext.
+HASH_PREFIX = 'pbkdf2_'
+#Default lifetime of a session in seconds and maximum number of sessions.
+DEFAULT_SESSION_TTL = 30 * 60.0
+DEFAULT_MAX_SESSIONS = 100000
+#Random bytes of a session token.
+SESSION_TOKEN_BYTES = 32
+#Salt of the hashes computed only to spend the time of a real one.
+_DUMMY_SALT = '\0' * DEFAULT_SALT_BYTES
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def is_password_hash(stored):
+    '''
+    Tells if a stored password is a hash built by :py:class:`PasswordHasher`
+    and not a plaintext password.
+
+    '''
+    return stored is not None and stored.startswith(HASH_PREFIX)
+
+
+def parse_password_hash(stored):
+    '''
+    Splits a stored password hash.
+
+    :return: a tuple ``(algorithm, iterations, salt, digest)``.
+    :raises ValueError: if ``stored`` is not a well formed hash.
+
+    '''
+    try:
+        prefix, iterations, salt, digest = _encode(stored).split('$')
+        iterations = int(iterations)
+        salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+    except (ValueError, TypeError):
+        raise ValueError("Malformed password hash")
+    if not prefix.startswith(HASH_PREFIX) or iterations < 1:
+        raise ValueError("Malformed password hash")
+    return prefix[len(HASH_PREFIX):], iterations, salt, digest
+
+
+class PasswordHasher(object):
+    '''
+    Salted PBKDF2-HMAC password hashes.
+
+    :param int iterations: cost of a new hash.
+    :param str algorithm: hash function of hashlib used by the HMAC.
+    :param int salt_bytes: length of the random salt of a new hash.
+    :raises ValueError: if ``iterations`` is smaller than 1 or the algorithm
+        is unknown.
+
+    '''
+    def __init__(self, iterations=DEFAULT_HASH_ITERATIONS,
+                 algorithm=HASH_ALGORITHM, salt_bytes=DEFAULT_SALT_BYTES):
+        super(PasswordHasher, self).__init__()
+        if iterations < 1:
+            raise ValueError("A hash needs at least one iteration")
+        #Raises ValueError if hashlib does not know the algorithm
+        hashlib.new(algorithm)
+        self.iterations = iterations
+        self.algorithm = algorithm
+        self.salt_bytes = salt_bytes
+
+    def hash(self, password):
+        '''
+        Hashes a password with a new random salt.
+
+        :param str password: the plaintext password. Unicode is encoded in
+            UTF-8.
+        :return: the hash to store, in the format
+            ``pbkdf2_<algorithm>$<iterations>$<salt>$<digest>`` with the
+            salt and the digest in base64.
+
+        '''
+        salt = os.urandom(self.salt_bytes)
+        digest = hashlib.pbkdf2_hmac(self.algorithm, _encode(password), salt,
+                                     self.iterations)
+        return '%s%s$%d$%s$%s' % (HASH_PREFIX, self.algorithm,
+                                  self.iterations, base64.b64encode(salt),
+                                  base64.b64encode(digest))
+
+    def verify(self, password, stored):
+        '''
+        Checks a password against a stored hash with the algorithm, salt and
+        iterations of the hash. A stored password that is not a hash is
+        compared as plaintext. The comparisons take the same time whatever
+        the number of matching characters.
+
+        When there is no hash to check, because the stored password is
+        missing, empty, plaintext or a malformed hash, a hash with the cost
+        of this hasher is computed anyway. The time of a check then does not
+        tell which users have no password or a plaintext one.
+
+        :param str password: the plaintext password to check.
+        :param str stored: the stored password, or None for an unknown user.
+        :return: True if the password matches, False otherwise or if the
+            stored password is missing, empty or a malformed hash.
+
+        '''
+        password = _encode(password)
+        if is_password_hash(stored):
+            try:
+                algorithm, iterations, salt, digest = parse_password_hash(
+                    stored)
+            except ValueError:
+                pass
+            else:
+                return hmac.compare_digest(
+                    hashlib.pbkdf2_hmac(algorithm, password, salt,
+                                        iterations), digest)
+        hashlib.pbkdf2_hmac(self.algorithm, password, _DUMMY_SALT,
+                            self.iterations)
+        if not stored or is_password_hash(stored):
+            return False
+        return hmac.compare_digest(password, _encode(stored))
+
+    def needs_rehash(self, stored):
+        '''
+        Tells if a stored password should be hashed again with this hasher:
+        it is plaintext, or a hash of another algorithm or with fewer
+        iterations.
+
+        '''
+        if not is_password_hash(stored):
+            return True
+        try:
+            algorithm, iterations, _, _ = parse_password_hash(stored)
+        except ValueError:
+            return False
+        return algorithm != self.algorithm or iterations < self.iterations
+
+
+class SessionCache(object):
+    '''
+    Thread-safe in-memory sessions of the authenticated users. A session
+    holds a username and the credential the user logged in with. It expires
+    ``ttl`` seconds after it is created. When the cache is full the oldest
+    session is dropped.
+
+    :param float ttl: seconds a session stays valid.
+    :param int max_sessions: maximum number of sessions.
+
+    '''
+    def __init__(self, ttl=DEFAULT_SESSION_TTL,
+                 max_sessions=DEFAULT_MAX_SESSIONS):
+        super(SessionCache, self).__init__()
+        if max_sessions < 1:
+            raise ValueError("The cache must hold at least one session")
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        #token -> (expires, username, credential). All the sessions have the
+        #same ttl, so the oldest session is the first to expire.
+        self._sessions = OrderedDict()
+        #Metrics
+        self._created = 0
+        self._hits = 0
+        self._misses = 0
+        self._expirations = 0
+        self._evictions = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _expire(self, now):
+        while self._sessions:
+            token = next(iter(self._sessions))
+            if self._sessions[token][0] >= now:
+                break
+            del self._sessions[token]
+            self._expirations += 1
+
+    def create(self, username, credential=None):
+        '''
+        Opens a session of a user.
+
+        :param str username: the username of the user.
+        :param credential: a value returned with the session by
+            :py:meth:`get`, such as the stored password of the login.
+        :return: the token of the session, a random hexadecimal string.
+
+        '''
+        token = binascii.hexlify(os.urandom(SESSION_TOKEN_BYTES))
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+                self._evictions += 1
+            self._sessions[token] = (now + self.ttl, username, credential)
+            self._created += 1
+        return token
+
+    def get(self, token):
+        '''
+        Returns a session as a tuple ``(username, credential)``, or None if
+        the session does not exist or has expired.
+
+        '''
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires, username, credential = entry
+            if expires < time.time():
+                del self._sessions[token]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._hits += 1
+        return username, credential
+
+    def revoke(self, token):
+        '''
+        Closes a session.
+
+        :return: True if the session existed.
+
+        '''
+        with self._lock:
+            return self._sessions.pop(token, None) is not None
+
+    def revoke_user(self, username):
+        '''
+        Closes every session of a user.
+
+        :return: the number of closed sessions.
+
+        '''
+        with self._lock:
+            tokens = [token for token, (_, name, _) in
+                      self._sessions.iteritems() if name == username]
+            for token in tokens:
+                del self._sessions[token]
+        return len(tokens)
+
+    def metrics(self):
+        '''
+        Returns a dictionary with the keys ``sessions``, ``created``,
+        ``hits``, ``misses``, ``expirations`` and ``evictions``.
+
+        '''
+        with self._lock:
+            return {'sessions': len(self._sessions),
+                    'created': self._created, 'hits': self._hits,
+                    'misses': self._misses,
+                    'expirations': self._expirations,
+                    'evictions': self._evictions}
+
+
+class Authenticator(object):
+    '''
+    Verifies the credentials of the users and keeps their sessions.
+
+    :param engine: Engine of the database of the users.
+    :type engine: database.Engine
+    :param hasher: hasher of the new hashes. If None, a
+        :py:class:`PasswordHasher` with the default cost.
+    :type hasher: PasswordHasher
+    :param int threads: hashing threads. If None, one per CPU.
+    :param float session_ttl: seconds a session stays valid.
+    :param int max_sessions: maximum number of sessions in memory.
+    :param bool rehash: if True, a plaintext password or a hash that
+        :py:meth:`PasswordHasher.needs_rehash` is replaced by a new hash
+        when the user logs in.
+
+    '''
+    def __init__(self, engine, hasher=None, threads=None,
+                 session_ttl=DEFAULT_SESSION_TTL,
+                 max_sessions=DEFAULT_MAX_SESSIONS, rehash=True):
+        super(Authenticator, self).__init__()
+        self.engine = engine
+        if hasher is not None:
+            self.hasher = hasher
+        else:
+            self.hasher = PasswordHasher()
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        self.rehash = rehash
+        self.sessions = SessionCache(session_ttl, max_sessions)
+        self._pool = ThreadPool(threads)
+        self._lock = threading.Lock()
+        #Metrics
+        self._logins = 0
+        self._failures = 0
+        self._rehashes = 0
+
+    def _hash(self, password):
+        return self._pool.apply(self.hasher.hash, (password,))
+
+    def verify_credentials(self, username, password):
+        '''
+        Checks the password of a user and opens a session.
+
+        :param str username: the username of the user.
+        :param str password: the plaintext password.
+        :return: the token of the new session, see :py:meth:`check_session`,
+            or None if the user does not exist or the password is wrong.
+            An unknown user or a user without password costs a hash too, so
+            a failed login takes the same time in every case.
+
+        '''
+        con = self.engine.connect()
+        try:
+            stored = con.get_password_hash(username)
+        finally:
+            con.close()
+        if not self._pool.apply(self.hasher.verify, (password, stored)):
+            with self._lock:
+                self._failures += 1
+            return None
+        if self.rehash and self.hasher.needs_rehash(stored):
+            password_hash = self._hash(password)
+            con = self.engine.connect()
+            try:
+                if con.set_password_hash(username, password_hash, stored):
+                    stored = password_hash
+                    with self._lock:
+                        self._rehashes += 1
+            finally:
+                con.close()
+        with self._lock:
+            self._logins += 1
+        return self.sessions.create(username, stored)
+
+    def check_session(self, token):
+        '''
+        Returns the username of a session opened by
+        :py:meth:`verify_credentials` or None if it does not exist or has
+        expired.
+
+        The stored password of the user is read through the unique index on
+        ``username``, without hashing. If it is not the one of the login,
+        because the user was deleted or its password was changed by any
+        Connection, the session is closed and None is returned.
+
+        '''
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        username, credential = session
+        con = self.engine.connect()
+        try:
+            stored = con.get_password_hash(username)
+        finally:
+            con.close()
+        if stored != credential:
+            self.sessions.revoke(token)
+            return None
+        return username
+
+    def logout(self, token):
+        '''
+        Closes a session.
+
+        :return: True if the session existed.
+
+        '''
+        return self.sessions.revoke(token)
+
+    def register_user(self, username, user):
+        '''
+        Creates a user with a hashed password. Takes the arguments of
+        :py:meth:`database.Connection.append_user`, with the plaintext
+        password in ``user['password']``.
+
+        :return: the username of the added user or None if the username is
+            already in the database.
+
+        '''
+        user = dict(user, password=self._hash(user['password']))
+        con = self.engine.connect()
+        try:
+            return con.append_user(username, user)
+        finally:
+            con.close()
+
+    def set_password(self, username, password):
+        '''
+        Replaces the password of a user and closes all the sessions of the
+        user at once. The sessions of the users whose password is changed by
+        other means are closed by :py:meth:`check_session`.
+
+        :param str username: the username of the user.
+        :param str password: the new plaintext password.
+        :return: True if the user exists.
+
+        '''
+        password_hash = self._hash(password)
+        con = self.engine.connect()
+        try:
+            changed = con.set_password_hash(username, password_hash)
+        finally:
+            con.close()
+        if changed:
+            self.sessions.revoke_user(username)
+        return changed
+
+    def upgrade_passwords(self, chunk_size=DEFAULT_PAGE_SIZE):
+        '''
+        Hashes the plaintext passwords of the database. The users are read a
+        page at a time and the passwords of a page are hashed by all the
+        threads. A password changed meanwhile is not overwritten.
+
+        :param int chunk_size: users per page.
+        :return: the number of hashed passwords.
+
+        '''
+        upgraded = 0
+        after = None
+        while True:
+            con = self.engine.connect()
+            try:
+                page = con.get_password_hashes(chunk_size, after)
+            finally:
+                con.close()
+            if not page:
+                break
+            after = page[-1][0]
+            plaintext = [(username, password) for username, password in page
+                         if password and not is_password_hash(password)]
+            hashes = self._pool.map(self.hasher.hash,
+                                    [password for _, password in plaintext])
+            con = self.engine.connect()
+            try:
+                for (username, password), password_hash in zip(plaintext,
+                                                                hashes):
+                    if con.set_password_hash(username, password_hash,
+                                             password):
+                        upgraded += 1
+            finally:
+                con.close()
+        return upgraded
+
+    def metrics(self):
+        '''
+        Returns a dictionary with the keys ``logins``, ``failures`` and
+        ``rehashes`` and the metrics of the sessions, see
+        :py:meth:`SessionCache.metrics`.
+
+        '''
+        with self._lock:
+            metrics = {'logins': self._logins, 'failures': self._failures,
+                       'rehashes': self._rehashes}
+        metrics.update(self.sessions.metrics())
+        return metrics
+
+    def close(self):
+        '''
+        Stops the hashing threads. The sessions are lost.
+
+        '''
+        self._pool.close()
+        self._pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hash the plaintext '
+                                     'passwords of the users.')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH,
+                        help='database file (default %(default)s)')
+    parser.add_argument('--iterations', type=int,
+                        default=DEFAULT_HASH_ITERATIONS,
+                        help='cost of the hashes (default %(default)s)')
+    parser.add_argument('--threads', type=int,
+                        help='hashing threads (default: one per CPU)')
+    args = parser.parse_args(argv)
+    engine = Engine(args.db)
+    auth = Authenticator(engine, PasswordHasher(args.iterations),
+                         args.threads)
+    try:
+        start = time.time()
+        upgraded = auth.upgrade_passwords()
+    finally:
+        auth.close()
+        engine.dispose()
+    print '%d passwords hashed in %.2f s' % (upgraded, time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,452 @@
+'''
+Created on 16.10.2026
+
+Reproducible benchmark suite of the public :py:class:`database.Connection`
+methods.
+
+A synthetic dataset of the chosen scale is generated once. Every public
+method is then called ``rounds`` times by one thread and by several threads,
+each run working on a fresh copy of the dataset, and the throughput and the
+p50, p95 and p99 latencies of every method are reported. The results can be
+saved as a JSON baseline and later runs compared against it::
+
+    python service/bench_suite.py --scale small --save baseline.json
+    python service/bench_suite.py --scale small --baseline baseline.json
+
+The comparison exits with status 1 when a method lost throughput or its p95
+latency grew by more than the tolerance.
+
+'''
+
+import argparse, datetime, json, math, os, platform, random, shutil, sqlite3
+import sys, tempfile, threading, time
+
+from database import Engine, DEFAULT_DB_PATH, STOCK_PURCHASE
+from benchmark import (_copy_database, _remove_copy, _synthetic_users,
+                       _load_synthetic_ledger, _print_table)
+
+#Sizes of the synthetic dataset. ``staff`` is the number of users assigned to
+#every restaurant and ``stock`` the number of ledger rows.
+SCALES = {'small': {'users': 1000, 'restaurants': 10, 'staff': 5,
+                    'items': 20, 'vendors': 10, 'stock': 10000},
+          'medium': {'users': 100000, 'restaurants': 100, 'staff': 10,
+                     'items': 50, 'vendors': 50, 'stock': 1000000},
+          'large': {'users': 1000000, 'restaurants': 1000, 'staff': 20,
+                    'items': 100, 'vendors': 200, 'stock': 10000000}}
+DEFAULT_SCALE = 'small'
+DEFAULT_ROUNDS = 500
+DEFAULT_THREADS = (1, 4)
+DEFAULT_SEED = 42
+#Relative change of a metric tolerated by compare()
+DEFAULT_TOLERANCE = 0.2
+#Methods reading whole tables are called rounds / LISTING_DIVISOR times
+LISTING_DIVISOR = 50
+#Records appended by every call of the bulk methods
+BULK_RECORDS = 50
+#Days covered by the synthetic ledger
+LEDGER_DAYS = 365
+#Metrics checked by compare(): name and whether larger values are better
+COMPARED_METRICS = (('ops_per_s', True), ('p95_us', False))
+
+
+def _consume(iterator):
+    for _ in iterator:
+        pass
+
+
+class _Worker(object):
+    '''
+    State of one benchmark thread: its random generator and the names of the
+    rows it writes, which never collide with the rows of other workers.
+
+    '''
+    def __init__(self, dataset, index, seed):
+        self.dataset = dataset
+        self.index = index
+        self.rand = random.Random(seed * 1000 + index)
+
+    def name(self, i):
+        return 'suite-%d-%d' % (self.index, i)
+
+    def user(self, i):
+        return {'firstname': 'suite', 'lastname': 'worker%d' % self.index,
+                'phone': '04%08d' % i,
+                'email': '%s@example.com' % self.name(i),
+                'password': 'secret', 'dob': '01-01-2000'}
+
+    def restaurant(self, i):
+        return {'restaurantName': self.name(i), 'address': 'Street %d' % i,
+                'phone': '08%08d' % i}
+
+    def existing_user(self):
+        return 'suite%d' % self.rand.randrange(self.dataset['users'])
+
+    def existing_restaurant(self):
+        return self.dataset['names'][
+            self.rand.randrange(len(self.dataset['names']))]
+
+    def existing_item(self):
+        name = self.existing_restaurant()
+        items = self.dataset['items'][name]
+        return name, items[self.rand.randrange(len(items))]
+
+    def bulk(self, i, build):
+        return [build('%s-%d' % (self.name(i), j))
+                for j in xrange(BULK_RECORDS)]
+
+
+#Benchmarked methods, in the order they run. Every entry is a tuple
+#``(method, kind, call)`` where ``call(con, worker, i)`` makes the i-th call of
+#a worker. The writes of a worker reuse the rows it created in the previous
+#entries, so delete_user goes last.
+OPERATIONS = [
+    ('get_user', 'read',
+     lambda con, w, i: con.get_user(w.existing_user())),
+    ('get_restaurant', 'read',
+     lambda con, w, i: con.get_restaurant(w.existing_restaurant())),
+    ('get_restaurant_details', 'read',
+     lambda con, w, i: con.get_restaurant_details(w.existing_restaurant())),
+    ('get_users', 'listing', lambda con, w, i: con.get_users()),
+    ('get_users_page', 'read',
+     lambda con, w, i: con.get_users_page(100, w.existing_user())),
+    ('iter_users', 'listing', lambda con, w, i: _consume(con.iter_users())),
+    ('get_restaurants', 'listing', lambda con, w, i: con.get_restaurants()),
+    ('get_restaurants_page', 'read',
+     lambda con, w, i: con.get_restaurants_page(100,
+                                                w.existing_restaurant())),
+    ('iter_restaurants', 'listing',
+     lambda con, w, i: _consume(con.iter_restaurants())),
+    ('get_stock_level', 'read',
+     lambda con, w, i: con.get_stock_level(*w.existing_item())),
+    ('get_stock_levels', 'read',
+     lambda con, w, i: con.get_stock_levels(w.existing_restaurant())),
+    ('get_stock_transactions', 'read',
+     lambda con, w, i: con.get_stock_transactions(*w.existing_item())),
+    ('get_expiring_batches', 'read',
+     lambda con, w, i: con.get_expiring_batches(w.existing_restaurant())),
+    ('search_users', 'read',
+     lambda con, w, i: con.search_users(w.existing_user())),
+    ('search_restaurants', 'read',
+     lambda con, w, i: con.search_restaurants(w.existing_restaurant())),
+    ('search_items', 'read',
+     lambda con, w, i: con.search_items('item%d' % w.rand.randrange(10))),
+    ('append_user', 'write',
+     lambda con, w, i: con.append_user(w.name(i), w.user(i))),
+    ('modify_user', 'write',
+     lambda con, w, i: con.modify_user(w.name(i), w.user(i + 1))),
+    ('append_restaurant', 'write',
+     lambda con, w, i: con.append_restaurant(w.restaurant(i))),
+    ('modify_restaurant', 'write',
+     lambda con, w, i: con.modify_restaurant(w.name(i), w.restaurant(i))),
+    ('assign_user_to_restaurant', 'write',
+     lambda con, w, i: con.assign_user_to_restaurant(w.name(i), w.name(i),
+                                                     'employee')),
+    ('record_stock_transaction', 'write',
+     lambda con, w, i: con.record_stock_transaction(
+         *w.existing_item(), transactionType=STOCK_PURCHASE, quantity=1,
+         price=1.0)),
+    ('append_users_bulk', 'write',
+     lambda con, w, i: con.append_users_bulk(w.bulk(
+         i, lambda name: {'username': name, 'firstname': 'suite',
+                          'lastname': 'bulk', 'phone': '0400000000',
+                          'email': name + '@example.com',
+                          'password': 'secret', 'dob': '01-01-2000'}))),
+    ('append_restaurants_bulk', 'write',
+     lambda con, w, i: con.append_restaurants_bulk(w.bulk(
+         i, lambda name: {'restaurantName': name, 'address': 'street',
+                          'phone': '0800000000'}))),
+    ('append_items_bulk', 'write',
+     lambda con, w, i: con.append_items_bulk(w.bulk(
+         i, lambda name: {'itemName': name, 'description': '',
+                          'restaurantName': w.name(i)}))),
+    ('append_vendors_bulk', 'write',
+     lambda con, w, i: con.append_vendors_bulk(w.bulk(
+         i, lambda name: {'name': name, 'address': '', 'email': '',
+                          'phone': '', 'restaurantName': w.name(i)}))),
+    ('delete_user', 'write', lambda con, w, i: con.delete_user(w.name(i))),
+    ]
+
+
+def build_dataset(path, scale, db_path=DEFAULT_DB_PATH):
+    '''
+    Creates the synthetic dataset in ``path``: a copy of ``db_path`` with
+    ``scale['users']`` users, ``scale['restaurants']`` restaurants with
+    ``scale['staff']`` users and ``scale['items']`` items each,
+    ``scale['vendors']`` vendors and a ledger of ``scale['stock']`` random
+    stock transactions. The data only depends on the scale.
+
+    :return: a dictionary with the keys ``users``, ``names`` (the names of
+        the synthetic restaurants), ``items`` (maps the names to the ids of
+        their items) and ``seconds``.
+
+    '''
+    start = time.time()
+    shutil.copy(db_path, path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    try:
+        con.append_users_bulk(_synthetic_users(scale['users'], 'suite'))
+        names, restaurant_ids, item_ids, _ = _load_synthetic_ledger(
+            con, scale['stock'], scale['restaurants'], scale['items'],
+            scale['vendors'], datetime.date(2024, 1, 1), LEDGER_DAYS)
+        raw = con.con
+        staff = min(scale['staff'] * len(names), scale['users'])
+        raw.executemany(
+            'INSERT INTO restaurantUser(userId, restaurantId, position) '
+            'SELECT userId, ?, ? FROM user WHERE username = ?',
+            ((restaurant_ids[i % len(names)],
+              'owner' if i < len(names) else 'employee', 'suite%d' % i)
+             for i in xrange(staff)))
+        raw.commit()
+        raw.execute('ANALYZE')
+        raw.commit()
+    finally:
+        con.close()
+        engine.dispose()
+    return {'users': scale['users'], 'names': names,
+            'items': dict((name, item_ids[restaurant_id])
+                          for name, restaurant_id
+                          in zip(names, restaurant_ids)),
+            'seconds': time.time() - start}
+
+
+def _percentile(latencies, percent):
+    '''
+    Nearest-rank percentile of a sorted list.
+
+    '''
+    if not latencies:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(latencies)))
+    return latencies[max(rank, 1) - 1]
+
+
+def _run_operation(engine, dataset, call, threads, calls, seed):
+    '''
+    Runs ``calls`` calls of an operation in each of ``threads`` threads, every
+    thread with its own Connection. The clock starts once all the threads
+    are connected.
+
+    :return: a tuple ``(latencies, errors, seconds)`` with the sorted
+        latencies of the successful calls in seconds.
+
+    '''
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    ready = threading.Event()
+    connected = []
+
+    def worker(index):
+        state = _Worker(dataset, index, seed)
+        timings = []
+        failures = 0
+        con = engine.connect()
+        try:
+            with lock:
+                connected.append(index)
+            ready.wait()
+            for i in xrange(calls):
+                start = time.time()
+                try:
+                    call(con, state, i)
+                except (sqlite3.Error, ValueError):
+                    failures += 1
+                    continue
+                timings.append(time.time() - start)
+        finally:
+            con.close()
+            with lock:
+                latencies.extend(timings)
+                errors.append(failures)
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in xrange(threads)]
+    for thread in workers:
+        thread.start()
+    while len(connected) < threads and any(t.is_alive() for t in workers):
+        time.sleep(0.001)
+    start = time.time()
+    ready.set()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return latencies, sum(errors), elapsed
+
+
+def run_suite(scale=DEFAULT_SCALE, threads=DEFAULT_THREADS,
+              rounds=DEFAULT_ROUNDS, seed=DEFAULT_SEED, methods=None,
+              db_path=DEFAULT_DB_PATH, **sizes):
+    '''
+    Generates the dataset and benchmarks the :py:data:`OPERATIONS` with each
+    number of threads in ``threads``. Every thread count runs on a fresh
+    copy of the dataset.
+
+    :param str scale: one of the keys of :py:data:`SCALES`.
+    :param threads: numbers of concurrent threads.
+    :param int rounds: calls per thread of every method. Methods reading
+        whole tables are called ``rounds / LISTING_DIVISOR`` times.
+    :param int seed: seed of the random rows read and written by the calls.
+    :param methods: names of the methods to run. All of them by default.
+        The writes of a method use the rows created by the methods before
+        it, so running only some of them may measure calls that find no
+        row, for example delete_user without append_user.
+    :param sizes: overrides of the sizes of the scale, for example
+        ``users=5000``.
+    :return: a dictionary with the keys ``config`` (the settings of the run,
+        used by :py:func:`compare`), ``setup_seconds`` and ``results``, a
+        list of dictionaries with the keys ``threads``, ``method``, ``kind``,
+        ``calls``, ``errors``, ``ops_per_s``, ``p50_us``, ``p95_us`` and
+        ``p99_us``.
+    :raises ValueError: if the scale or a method is unknown.
+
+    '''
+    if scale not in SCALES:
+        raise ValueError("Unknown scale %s" % scale)
+    sizes = dict(SCALES[scale], **dict((key, value) for key, value
+                                       in sizes.items() if value is not None))
+    known = [name for name, _, _ in OPERATIONS]
+    for name in methods or ():
+        if name not in known:
+            raise ValueError("Unknown method %s" % name)
+    operations = [op for op in OPERATIONS if not methods or op[0] in methods]
+    tmp_dir = tempfile.mkdtemp(prefix='rms-suite-')
+    template = os.path.join(tmp_dir, 'dataset.db')
+    results = []
+    try:
+        dataset = build_dataset(template, sizes, db_path)
+        for count in threads:
+            path = _copy_database(template)
+            engine = Engine(path, pool_size=count)
+            try:
+                for name, kind, call in operations:
+                    calls = rounds
+                    if kind == 'listing':
+                        calls = max(1, rounds // LISTING_DIVISOR)
+                    latencies, errors, elapsed = _run_operation(
+                        engine, dataset, call, count, calls, seed)
+                    results.append({
+                        'threads': count, 'method': name, 'kind': kind,
+                        'calls': len(latencies) + errors, 'errors': errors,
+                        'ops_per_s': len(latencies) / elapsed
+                        if elapsed else 0.0,
+                        'p50_us': _percentile(latencies, 50) * 1e6,
+                        'p95_us': _percentile(latencies, 95) * 1e6,
+                        'p99_us': _percentile(latencies, 99) * 1e6})
+            finally:
+                engine.dispose()
+                _remove_copy(path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'config': {'scale': scale, 'sizes': sizes, 'rounds': rounds,
+                       'seed': seed, 'python': platform.python_version(),
+                       'sqlite': sqlite3.sqlite_version},
+            'setup_seconds': dataset['seconds'],
+            'results': results}
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''
+    Compares the results of :py:func:`run_suite` with a baseline produced by
+    it. A metric of :py:data:`COMPARED_METRICS` regresses when it is worse
+    than the baseline by more than ``tolerance`` (``0.2`` is 20%). Methods
+    missing in either report are ignored.
+
+    :return: a list of dictionaries with the keys ``threads``, ``method``,
+        ``metric``, ``baseline``, ``current``, ``change_pct`` and ``status``
+        (``ok`` or ``REGRESSION``).
+    :raises ValueError: if both reports were not run with the same sizes and
+        rounds, since their numbers are then not comparable.
+
+    '''
+    for key in ('sizes', 'rounds'):
+        if report['config'][key] != baseline['config'][key]:
+            raise ValueError("The baseline was run with other %s: %r" %
+                             (key, baseline['config'][key]))
+    previous = dict(((row['threads'], row['method']), row)
+                    for row in baseline['results'])
+    rows = []
+    for row in report['results']:
+        base = previous.get((row['threads'], row['method']))
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = base[metric], row[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            rows.append({'threads': row['threads'], 'method': row['method'],
+                         'metric': metric, 'baseline': float(old),
+                         'current': float(new), 'change_pct': change * 100,
+                         'status': 'REGRESSION' if worse > tolerance
+                         else 'ok'})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the public '
+                                     'Connection methods on a synthetic '
+                                     'dataset.')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH,
+                        help='database copied as the base of the dataset '
+                        '(default %(default)s)')
+    parser.add_argument('--scale', choices=sorted(SCALES),
+                        default=DEFAULT_SCALE,
+                        help='size of the dataset (default %(default)s)')
+    for key in sorted(SCALES[DEFAULT_SCALE]):
+        parser.add_argument('--%s' % key, type=int,
+                            help='override the %s of the scale' % key)
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=list(DEFAULT_THREADS),
+                        help='thread counts to run (default %(default)s)')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS,
+                        help='calls per thread and method '
+                        '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--method', action='append', dest='methods',
+                        choices=[name for name, _, _ in OPERATIONS],
+                        help='run only this method (repeatable)')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of a previous run to '
+                        'compare with')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='tolerated relative regression '
+                        '(default %(default)s)')
+    args = parser.parse_args(argv)
+    report = run_suite(args.scale, args.threads, args.rounds, args.seed,
+                       args.methods, args.db,
+                       **dict((key, getattr(args, key))
+                              for key in SCALES[DEFAULT_SCALE]))
+    print 'Dataset %s generated in %.2f s' % (
+        ', '.join('%s=%d' % item
+                  for item in sorted(report['config']['sizes'].items())),
+        report['setup_seconds'])
+    print
+    _print_table('Connection methods', ('threads', 'method', 'calls',
+                                        'errors', 'ops_per_s', 'p50_us',
+                                        'p95_us', 'p99_us'),
+                 report['results'])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            rows = compare(report, baseline, args.tolerance)
+        except ValueError, excp:
+            print >> sys.stderr, excp
+            return 2
+        _print_table('Comparison with %s' % args.baseline,
+                     ('threads', 'method', 'metric', 'baseline', 'current',
+                      'change_pct', 'status'), rows)
+        regressions = [row for row in rows if row['status'] != 'ok']
+        if regressions:
+            print >> sys.stderr, '%d regressions over %d%%' % (
+                len(regressions), args.tolerance * 100)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
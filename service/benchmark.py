@@ -0,0 +1,1602 @@
+'''
+Created on 16.10.2026
+
+Benchmarks for the database API provided by :py:mod:`database`.
+
+Every benchmark works on a temporary copy of the database file, so the
+original file is never modified. Run all of them with::
+
+    python service/benchmark.py [db_path]
+
+'''
+
+import datetime, gc, itertools, json, multiprocessing, os, random
+import resource, shutil, sqlite3, sys, tempfile, threading, time
+
+from auth import Authenticator, PasswordHasher
+from database import (Engine, DEFAULT_DB_PATH, DEFAULT_DATA_DUMP,
+                      DEFAULT_SCHEMA, RECORD_MODES, STOCK_PURCHASE,
+                      STOCK_CONSUMPTION, STOCK_WASTE, RetryPolicy,
+                      connection_profile, is_busy_error)
+import export
+from group_commit import GroupCommitWriter
+from instrumentation import Instrumentation
+import reporting
+from sharding import ShardedEngine
+
+
+class _CountingCursor(object):
+    '''
+    Cursor proxy counting the statements executed through it.
+
+    '''
+    def __init__(self, owner, cur):
+        self._owner = owner
+        self._cur = cur
+
+    def execute(self, *args):
+        self._owner.statements += 1
+        return self._cur.execute(*args)
+
+    def executemany(self, *args):
+        self._owner.statements += 1
+        return self._cur.executemany(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+
+class _CountingConnection(object):
+    '''
+    sqlite3 connection proxy counting the statements executed through its
+    cursors and through :py:meth:`execute`.
+
+    '''
+    def __init__(self, con):
+        self.__dict__['_con'] = con
+        self.__dict__['statements'] = 0
+
+    def cursor(self, *args):
+        return _CountingCursor(self, self._con.cursor(*args))
+
+    def execute(self, *args):
+        self.__dict__['statements'] += 1
+        return self._con.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def __setattr__(self, name, value):
+        if name == 'statements':
+            self.__dict__[name] = value
+        else:
+            setattr(self._con, name, value)
+
+
+def _copy_database(db_path):
+    '''
+    Copies the database file into a temporary directory.
+
+    :return: the path of the copy
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='rms-bench-')
+    path = os.path.join(tmp_dir, os.path.basename(db_path))
+    shutil.copy(db_path, path)
+    return path
+
+
+def _remove_copy(path):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def _legacy_setup(con):
+    '''
+    Reproduces the per-call connection setup that every method used to run
+    before the connection profile existed.
+
+    '''
+    con.set_foreign_keys_support()
+    con.con.row_factory = sqlite3.Row
+
+
+def bench_connection_profile(db_path=DEFAULT_DB_PATH, rounds=2000):
+    '''
+    Compares every Connection method run with the old per-call setup
+    (``PRAGMA foreign_keys = ON`` plus resetting the row factory, twice for
+    ``modify_user``) against the same method relying on the connection
+    profile applied at open.
+
+    :return: a list of dictionaries with the keys ``method``,
+        ``legacy_statements``, ``statements``, ``legacy_us`` and ``us``
+        (microseconds per call).
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    counting = _CountingConnection(con.con)
+    con.con = counting
+    user = {'firstname': 'bench', 'lastname': 'mark', 'phone': '0400000000',
+            'email': 'bench@example.com', 'password': 'secret',
+            'dob': '01-01-2000'}
+
+    def remove_bench_users():
+        con.con.execute("DELETE FROM user WHERE username LIKE 'bench%'")
+        con.con.commit()
+
+    def insert_bench_users():
+        remove_bench_users()
+        for i in xrange(rounds):
+            con.append_user('bench%d' % i, user)
+
+    #(method, call, number of legacy setups, reset run between both passes)
+    calls = [('get_user', lambda i: con.get_user('ahmad'), 1, None),
+             ('get_restaurant', lambda i: con.get_restaurant('Milano'), 1,
+              None),
+             ('get_users', lambda i: con.get_users(), 1, None),
+             ('get_restaurants', lambda i: con.get_restaurants(), 1, None),
+             ('append_user',
+              lambda i: con.append_user('bench%d' % i, user), 1,
+              remove_bench_users),
+             ('modify_user',
+              lambda i: con.modify_user('bench%d' % i, user), 2, None),
+             ('delete_user', lambda i: con.delete_user('bench%d' % i), 1,
+              insert_bench_users)]
+    results = []
+    try:
+        for name, call, setups, reset in calls:
+            timings = {}
+            counts = {}
+            for legacy in (True, False):
+                counting.statements = 0
+                start = time.time()
+                for i in xrange(rounds):
+                    if legacy:
+                        for _ in xrange(setups):
+                            _legacy_setup(con)
+                    call(i)
+                timings[legacy] = (time.time() - start) / rounds * 1e6
+                counts[legacy] = counting.statements / float(rounds)
+                if legacy and reset is not None:
+                    reset()
+            results.append({'method': name,
+                            'legacy_statements': counts[True],
+                            'statements': counts[False],
+                            'legacy_us': timings[True],
+                            'us': timings[False]})
+    finally:
+        con.con = counting._con
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return results
+
+
+def stress_append_user(db_path=DEFAULT_DB_PATH, workers=8, usernames=200):
+    '''
+    Concurrency stress test of :py:meth:`database.Connection.append_user`.
+    Several threads, each one with its own Connection, try to add the same
+    set of usernames in a different order. Every username must be reported
+    as added by exactly one call and must be stored exactly once.
+
+    :return: a dictionary with the keys ``workers``, ``attempts``,
+        ``inserted``, ``double_successes`` (usernames reported as added more
+        than once), ``duplicates`` (usernames stored more than once),
+        ``errors`` and ``ops_per_s``.
+    :raises AssertionError: if a duplicated username gets through.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=workers)
+    names = ['stress%d' % i for i in xrange(usernames)]
+    user = {'firstname': 'stress', 'lastname': 'test', 'phone': '0400000000',
+            'email': 'stress@example.com', 'password': 'secret',
+            'dob': '01-01-2000'}
+    successes = dict((name, 0) for name in names)
+    errors = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        order = list(names)
+        random.Random(seed).shuffle(order)
+        con = engine.connect()
+        try:
+            for name in order:
+                try:
+                    added = con.append_user(name, user)
+                except sqlite3.Error, excp:
+                    with lock:
+                        errors.append(str(excp))
+                    continue
+                if added is not None:
+                    with lock:
+                        successes[name] += 1
+        finally:
+            con.close()
+
+    try:
+        #Apply the migrations before starting the clock
+        engine.connect().close()
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in xrange(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        check = sqlite3.connect(path)
+        duplicates = check.execute('SELECT COUNT(*) FROM (SELECT username '
+                                   'FROM user GROUP BY username '
+                                   'HAVING COUNT(*) > 1)').fetchone()[0]
+        check.close()
+    finally:
+        engine.dispose()
+        _remove_copy(path)
+    result = {'workers': workers,
+              'attempts': workers * usernames,
+              'inserted': sum(1 for n in successes.values() if n > 0),
+              'double_successes': sum(1 for n in successes.values() if n > 1),
+              'duplicates': duplicates,
+              'errors': len(errors),
+              'ops_per_s': workers * usernames / elapsed}
+    assert result['duplicates'] == 0, 'Duplicated usernames stored'
+    assert result['double_successes'] == 0, 'Username added twice'
+    return result
+
+
+def _contention_worker(args):
+    '''
+    Body of one process of :py:func:`bench_process_contention`: adds,
+    modifies and deletes ``writes`` users through its own Engine.
+
+    :return: a tuple ``(writes, lock_errors, other_errors)``.
+
+    '''
+    path, number, writes, busy_timeout, retry_policy = args
+    engine = Engine(path, pool_size=1, auto_migrate=False,
+                    profile=connection_profile(busy_timeout=busy_timeout),
+                    retry_policy=retry_policy)
+    user = {'firstname': 'contention', 'lastname': 'test',
+            'phone': '0400000000', 'email': 'contention@example.com',
+            'password': 'secret', 'dob': '01-01-2000'}
+    calls = (lambda con, name: con.append_user(name, user),
+             lambda con, name: con.modify_user(name, user),
+             lambda con, name: con.delete_user(name))
+    lock_errors = other_errors = 0
+    con = engine.connect()
+    try:
+        for i in xrange(writes):
+            name = 'contention%d_%d' % (number, i)
+            for call in calls:
+                try:
+                    call(con, name)
+                except sqlite3.Error, excp:
+                    if is_busy_error(excp):
+                        lock_errors += 1
+                    else:
+                        other_errors += 1
+    finally:
+        con.close()
+        engine.dispose()
+    return writes * len(calls), lock_errors, other_errors
+
+
+def bench_process_contention(db_path=DEFAULT_DB_PATH, workers=8, writes=200):
+    '''
+    Runs ``workers`` processes writing to the same database file, each one
+    adding, modifying and deleting ``writes`` users, with three settings:
+
+    * ``fail_fast``: no busy timeout and no retries
+    * ``busy_timeout``: the busy timeout of the default profile
+    * ``retry``: a short busy timeout and a :py:class:`database.RetryPolicy`
+
+    :return: a list of dictionaries with the keys ``mode``, ``workers``,
+        ``writes``, ``ops_per_s``, ``lock_errors``, ``other_errors`` and
+        ``error_rate_pct``.
+
+    '''
+    modes = [('fail_fast', 0, None),
+             ('busy_timeout',
+              connection_profile()['busy_timeout'], None),
+             ('retry', 50, RetryPolicy(attempts=10))]
+    results = []
+    for mode, busy_timeout, retry_policy in modes:
+        path = _copy_database(db_path)
+        engine = Engine(path, pool_size=1)
+        #Apply the migrations before starting the clock
+        engine.connect().close()
+        engine.dispose()
+        pool = multiprocessing.Pool(workers)
+        try:
+            start = time.time()
+            counts = pool.map(_contention_worker,
+                              [(path, i, writes, busy_timeout, retry_policy)
+                               for i in xrange(workers)])
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+            _remove_copy(path)
+        total = sum(c[0] for c in counts)
+        lock_errors = sum(c[1] for c in counts)
+        other_errors = sum(c[2] for c in counts)
+        results.append({'mode': mode, 'workers': workers, 'writes': total,
+                        'ops_per_s': (total - lock_errors - other_errors) /
+                        elapsed,
+                        'lock_errors': lock_errors,
+                        'other_errors': other_errors,
+                        'error_rate_pct': 100.0 * (lock_errors +
+                                                   other_errors) / total})
+    return results
+
+
+def _synthetic_users(count, prefix='user'):
+    '''
+    Yields ``count`` user dictionaries with the format used by
+    :py:meth:`database.Connection.append_user`.
+
+    '''
+    for i in xrange(count):
+        yield {'username': '%s%d' % (prefix, i), 'firstname': 'first%d' % i,
+               'lastname': 'last%d' % i, 'phone': '04%08d' % i,
+               'email': '%s%d@example.com' % (prefix, i),
+               'password': 'secret', 'dob': '01-01-2000'}
+
+
+def bench_bulk_import(db_path=DEFAULT_DB_PATH, rows=5000):
+    '''
+    Compares adding ``rows`` users one by one with
+    :py:meth:`database.Connection.append_user` against
+    :py:meth:`database.Connection.append_users_bulk`.
+
+    :return: a list of dictionaries with the keys ``method``, ``rows``,
+        ``seconds`` and ``rows_per_s``.
+
+    '''
+    results = []
+    runs = [('append_user',
+             lambda con: [con.append_user(u['username'], u)
+                          for u in _synthetic_users(rows)]),
+            ('append_users_bulk',
+             lambda con: con.append_users_bulk(_synthetic_users(rows)))]
+    for name, run in runs:
+        path = _copy_database(db_path)
+        engine = Engine(path, pool_size=1)
+        con = engine.connect()
+        try:
+            start = time.time()
+            run(con)
+            elapsed = time.time() - start
+        finally:
+            con.close()
+            engine.dispose()
+            _remove_copy(path)
+        results.append({'method': name, 'rows': rows, 'seconds': elapsed,
+                        'rows_per_s': rows / elapsed})
+    return results
+
+
+def bench_method_overhead(db_path=DEFAULT_DB_PATH, rounds=2000):
+    '''
+    Measures the time per call of every public method of
+    :py:class:`database.Connection` on a small database, where the cost is
+    dominated by the per-call overhead rather than by the data.
+
+    :return: a list of dictionaries with the keys ``method`` and ``us``
+        (microseconds per call).
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    user = {'firstname': 'bench', 'lastname': 'mark', 'phone': '0400000000',
+            'email': 'bench@example.com', 'password': 'secret',
+            'dob': '01-01-2000'}
+    calls = [('get_user', lambda i: con.get_user('ahmad')),
+             ('get_restaurant', lambda i: con.get_restaurant('Milano')),
+             ('get_users', lambda i: con.get_users()),
+             ('get_restaurants', lambda i: con.get_restaurants()),
+             ('get_users_page', lambda i: con.get_users_page(10)),
+             ('get_restaurants_page',
+              lambda i: con.get_restaurants_page(10)),
+             ('append_user', lambda i: con.append_user('bench%d' % i, user)),
+             ('append_restaurant',
+              lambda i: con.append_restaurant(
+                  {'restaurantName': 'bench%d' % i, 'address': 'street',
+                   'phone': '0400000000'})),
+             ('assign_user_to_restaurant',
+              lambda i: con.assign_user_to_restaurant(
+                  'bench%d' % i, 'bench%d' % i, 'employee')),
+             ('modify_user', lambda i: con.modify_user('bench%d' % i, user)),
+             ('modify_restaurant',
+              lambda i: con.modify_restaurant(
+                  'bench%d' % i, {'restaurantName': 'bench%d' % i,
+                                  'address': 'avenue',
+                                  'phone': '0400000001'})),
+             ('delete_user', lambda i: con.delete_user('bench%d' % i))]
+    results = []
+    try:
+        for name, call in calls:
+            start = time.time()
+            for i in xrange(rounds):
+                call(i)
+            results.append({'method': name,
+                            'us': (time.time() - start) / rounds * 1e6})
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return results
+
+
+def bench_instrumentation(db_path=DEFAULT_DB_PATH, rounds=5000):
+    '''
+    Measures the cost per call of :py:class:`instrumentation.Instrumentation`
+    with its default slow-query threshold, which is the setting meant to be
+    left on in production.
+
+    :return: a list of dictionaries with the keys ``method``, ``plain_us``,
+        ``instrumented_us`` and ``overhead_us``.
+
+    '''
+    user = {'firstname': 'bench', 'lastname': 'mark', 'phone': '0400000000',
+            'email': 'bench@example.com', 'password': 'secret',
+            'dob': '01-01-2000'}
+    calls = [('get_user', lambda con, i: con.get_user('ahmad')),
+             ('get_users_page', lambda con, i: con.get_users_page(10)),
+             ('get_stock_level', lambda con, i: con.get_stock_level('Milano',
+                                                                    1)),
+             ('append_user', lambda con, i: con.append_user('bench%d' % i,
+                                                            user))]
+    timings = {}
+    for mode in ('plain', 'instrumented'):
+        path = _copy_database(db_path)
+        instrumentation = Instrumentation() if mode == 'instrumented' \
+            else None
+        engine = Engine(path, pool_size=1, instrumentation=instrumentation)
+        con = engine.connect()
+        try:
+            for name, call in calls:
+                start = time.time()
+                for i in xrange(rounds):
+                    call(con, i)
+                timings[mode, name] = (time.time() - start) / rounds * 1e6
+        finally:
+            con.close()
+            engine.dispose()
+            _remove_copy(path)
+    return [{'method': name, 'plain_us': timings['plain', name],
+             'instrumented_us': timings['instrumented', name],
+             'overhead_us': timings['instrumented', name] -
+             timings['plain', name]} for name, _ in calls]
+
+
+def _estimate_size(value):
+    '''
+    Approximates the memory used by a value made of dictionaries, lists and
+    strings.
+
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += _estimate_size(key) + _estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += _estimate_size(item)
+    return size
+
+
+def _max_rss_mb():
+    '''
+    Returns the peak resident memory of the process in MiB.
+
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_user_listing(db_path=DEFAULT_DB_PATH, users=1000000):
+    '''
+    Lists ``users`` users with :py:meth:`database.Connection.get_users_page`,
+    :py:meth:`database.Connection.iter_users` and
+    :py:meth:`database.Connection.get_users`. The list methods are measured
+    last because the peak memory of the process never decreases.
+
+    :return: a list of dictionaries with the keys ``method``, ``rows``,
+        ``first_row_ms`` (latency of the first row), ``seconds`` and
+        ``peak_rss_growth_mb``.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    results = []
+
+    def page_walk():
+        page, after = con.get_users_page(1000)
+        yield page
+        while after is not None:
+            page, after = con.get_users_page(1000, after)
+            yield page
+
+    def measure(name, batches):
+        rss = _max_rss_mb()
+        start = time.time()
+        first = None
+        rows = 0
+        for batch in batches:
+            if first is None:
+                first = time.time() - start
+            rows += len(batch)
+        elapsed = time.time() - start
+        results.append({'method': name, 'rows': rows,
+                        'first_row_ms': (first or 0.0) * 1000,
+                        'seconds': elapsed,
+                        'peak_rss_growth_mb': _max_rss_mb() - rss})
+
+    try:
+        con.append_users_bulk(_synthetic_users(users), 10000)
+        measure('get_users_page', page_walk())
+        measure('iter_users', ([user] for user in con.iter_users(1000)))
+
+        def listing():
+            yield con.get_users()
+        measure('get_users', listing())
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return results
+
+
+def _synthetic_restaurants(count, prefix='restaurant'):
+    '''
+    Yields ``count`` restaurant dictionaries with the format used by
+    :py:meth:`database.Connection.append_restaurant`.
+
+    '''
+    for i in xrange(count):
+        yield {'restaurantName': '%s%d' % (prefix, i),
+               'address': 'Street %d, Oulu, Finland' % i,
+               'phone': '08%08d' % i}
+
+
+def bench_record_mode(db_path=DEFAULT_DB_PATH, users=200000,
+                      restaurants=50000, rounds=3):
+    '''
+    Compares the ``dict`` and ``record`` modes of get_users and
+    get_restaurants.
+
+    :return: a list of dictionaries with the keys ``method``, ``mode``,
+        ``rows_per_s`` (best of ``rounds``), ``bytes_per_row`` (approximate
+        memory of the returned objects) and ``gc_objects_per_row`` (objects
+        tracked by the garbage collector that the result adds).
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    try:
+        con.append_users_bulk(_synthetic_users(users), 10000)
+        con.append_restaurants_bulk(_synthetic_restaurants(restaurants),
+                                    10000)
+    finally:
+        con.close()
+        engine.dispose()
+    results = []
+    try:
+        for mode in RECORD_MODES:
+            engine = Engine(path, pool_size=1, record_mode=mode)
+            con = engine.connect()
+            try:
+                for name in ('get_users', 'get_restaurants'):
+                    method = getattr(con, name)
+                    best = None
+                    for _ in xrange(rounds):
+                        start = time.time()
+                        result = method()
+                        elapsed = time.time() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                        del result
+                    gc.collect()
+                    before = len(gc.get_objects())
+                    result = method()
+                    tracked = len(gc.get_objects()) - before
+                    rows = len(result)
+                    results.append({'method': name, 'mode': mode,
+                                    'rows_per_s': rows / best,
+                                    'bytes_per_row':
+                                        _estimate_size(result) / float(rows),
+                                    'gc_objects_per_row':
+                                        tracked / float(rows)})
+                    del result
+            finally:
+                con.close()
+                engine.dispose()
+    finally:
+        _remove_copy(path)
+    return results
+
+
+def bench_read_replicas(db_path=DEFAULT_DB_PATH, users=100000,
+                        thread_counts=(1, 2, 4, 8), reads=500, writes=200):
+    '''
+    Measures the read throughput of ``1..n`` threads listing pages of users
+    while one more thread adds users, with every Connection on a pooled
+    sqlite3 connection (``shared``) and with an Engine with one writer and
+    one reader per thread (``replicas``).
+
+    :return: a list of dictionaries with the keys ``mode``, ``threads``,
+        ``cpus``, ``reads_per_s``, ``write_p50_ms`` and ``write_max_ms``.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    con.append_users_bulk(_synthetic_users(users, 'replica'))
+    con.close()
+    engine.dispose()
+    user = {'firstname': 'replica', 'lastname': 'writer',
+            'phone': '0400000000', 'email': 'replica@example.com',
+            'password': 'secret', 'dob': '01-01-2000'}
+    results = []
+    try:
+        for threads in thread_counts:
+            for mode in ('shared', 'replicas'):
+                if mode == 'shared':
+                    engine = Engine(path, pool_size=threads + 1)
+                else:
+                    engine = Engine(path, pool_size=1, readers=threads)
+                latencies = []
+
+                def reader(seed):
+                    rand = random.Random(seed)
+                    con = engine.connect()
+                    try:
+                        for _ in xrange(reads):
+                            con.get_users_page(100, 'replica%d' %
+                                               rand.randrange(users))
+                    finally:
+                        con.close()
+
+                def writer(prefix):
+                    con = engine.connect()
+                    try:
+                        for i in xrange(writes):
+                            start = time.time()
+                            con.append_user('%s%d' % (prefix, i), user)
+                            latencies.append(time.time() - start)
+                    finally:
+                        con.close()
+
+                readers = [threading.Thread(target=reader, args=(i,))
+                           for i in xrange(threads)]
+                write_thread = threading.Thread(
+                    target=writer, args=('%s%d_' % (mode, threads),))
+                try:
+                    start = time.time()
+                    for thread in readers + [write_thread]:
+                        thread.start()
+                    for thread in readers:
+                        thread.join()
+                    elapsed = time.time() - start
+                    write_thread.join()
+                finally:
+                    engine.dispose()
+                latencies.sort()
+                results.append({'mode': mode, 'threads': threads,
+                                'cpus': multiprocessing.cpu_count(),
+                                'reads_per_s': threads * reads / elapsed,
+                                'write_p50_ms':
+                                latencies[len(latencies) // 2] * 1000,
+                                'write_max_ms': latencies[-1] * 1000})
+    finally:
+        _remove_copy(path)
+    return results
+
+
+def bench_restaurant_details(db_path=DEFAULT_DB_PATH,
+                             staff_counts=(10, 100, 500), items=50,
+                             vendors=10, rounds=200):
+    '''
+    Measures the latency of reading a restaurant with its whole staff,
+    items and vendors, for restaurants with ``staff_counts`` members: with
+    :py:meth:`database.Connection.get_restaurant` and one
+    :py:meth:`database.Connection.get_user` per member, with
+    :py:meth:`database.Connection.get_restaurant_details`, and with
+    get_restaurant_details answered by the cache.
+
+    :return: a list of dictionaries with the keys ``staff``, ``method``,
+        ``statements``, ``p50_ms`` and ``p95_ms``.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    cached_engine = Engine(path, pool_size=1, cache_size=1000)
+    con = engine.connect()
+    cached = cached_engine.connect()
+    results = []
+    try:
+        for count in staff_counts:
+            name = 'details%d' % count
+            con.append_restaurant({'restaurantName': name,
+                                   'address': 'Street 1, Oulu, Finland',
+                                   'phone': '0800000000'})
+            con.append_users_bulk(_synthetic_users(count, name))
+            for i in xrange(count):
+                con.assign_user_to_restaurant('%s%d' % (name, i), name,
+                                              'employee')
+            con.append_items_bulk({'itemName': 'item%d' % i,
+                                   'description': 'item of %s' % name,
+                                   'restaurantName': name}
+                                  for i in xrange(items))
+            con.append_vendors_bulk({'name': 'vendor%d' % i, 'address': '',
+                                     'email': '', 'phone': '',
+                                     'restaurantName': name}
+                                    for i in xrange(vendors))
+            usernames = ['%s%d' % (name, i) for i in xrange(count)]
+
+            def n_plus_one():
+                con.get_restaurant(name)
+                return [con.get_user(username) for username in usernames]
+            runs = [('get_restaurant + get_user', count + 1, n_plus_one),
+                    ('get_restaurant_details', 4,
+                     lambda: con.get_restaurant_details(name)),
+                    ('get_restaurant_details, cached', 0,
+                     lambda: cached.get_restaurant_details(name))]
+            for method, statements, function in runs:
+                function()
+                latencies = []
+                for _ in xrange(rounds):
+                    start = time.time()
+                    function()
+                    latencies.append((time.time() - start) * 1000)
+                latencies.sort()
+                results.append({'staff': count, 'method': method,
+                                'statements': statements,
+                                'p50_ms': latencies[len(latencies) // 2],
+                                'p95_ms': latencies[
+                                    int(len(latencies) * 0.95)]})
+    finally:
+        con.close()
+        cached.close()
+        engine.dispose()
+        cached_engine.dispose()
+        _remove_copy(path)
+    return results
+
+
+def bench_change_log(db_path=DEFAULT_DB_PATH, users=200000, changes=1000):
+    '''
+    Compares a consumer that reads all the users again with
+    :py:meth:`database.Connection.get_users` against one that reads the
+    last ``changes`` modifications with
+    :py:meth:`database.Connection.iter_changes`, measures the cost of the
+    change log triggers on :py:meth:`database.Connection.modify_user` and
+    compacts the log of the bulk load.
+
+    :return: a list of dictionaries with the keys ``operation``, ``rows``
+        and ``ms``.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    results = []
+    user = {'firstname': 'change', 'lastname': 'log', 'phone': '0400000000',
+            'email': 'change@example.com', 'dob': '01-01-2000'}
+    try:
+        con.append_users_bulk(_synthetic_users(users, 'change'))
+        start = time.time()
+        compacted = con.compact_changes(max_rows=0)
+        results.append({'operation': 'compact_changes of the bulk load',
+                        'rows': compacted['truncated'],
+                        'ms': (time.time() - start) * 1000})
+        position = compacted['truncatedSeq']
+        names = ['change%d' % i for i in
+                 random.Random(3).sample(xrange(users), changes)]
+        raw = con.con
+        triggers = raw.execute("SELECT name, sql FROM sqlite_master WHERE "
+                               "type = 'trigger' AND name LIKE ?",
+                               ('changeLog_user_%',)).fetchall()
+        for logged in (False, True):
+            if logged:
+                for _, sql in triggers:
+                    raw.execute(sql)
+            else:
+                for name, _ in triggers:
+                    raw.execute('DROP TRIGGER %s' % name)
+            raw.commit()
+            start = time.time()
+            for name in names:
+                con.modify_user(name, user)
+            results.append({'operation': 'modify_user, %s change log' %
+                            ('with' if logged else 'without'),
+                            'rows': changes,
+                            'ms': (time.time() - start) * 1000})
+        start = time.time()
+        rows = len(con.get_users())
+        results.append({'operation': 'get_users', 'rows': rows,
+                        'ms': (time.time() - start) * 1000})
+        start = time.time()
+        rows = sum(1 for _ in con.iter_changes(position))
+        results.append({'operation': 'iter_changes', 'rows': rows,
+                        'ms': (time.time() - start) * 1000})
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return results
+
+
+def bench_search(db_path=DEFAULT_DB_PATH, rows=1000000, rounds=5):
+    '''
+    Loads ``rows`` users and ``rows`` items, which keeps the full-text
+    indexes up to date through their triggers, and compares the search
+    methods against a ``LIKE '%text%'`` scan of the same columns.
+
+    :return: a tuple ``(setup, queries)``. ``setup`` is a list of
+        dictionaries with the keys ``step``, ``rows`` and ``seconds``.
+        ``queries`` is a list of dictionaries with the keys ``method``,
+        ``query``, ``matches`` (on the first page of 100), ``like_ms`` and
+        ``search_ms`` (best of ``rounds``).
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    setup = []
+    queries = []
+    try:
+        start = time.time()
+        con.append_users_bulk(_synthetic_users(rows, 'search'))
+        setup.append({'step': 'append_users_bulk', 'rows': rows,
+                      'seconds': time.time() - start})
+        con.append_restaurants_bulk(_synthetic_restaurants(100, 'search'))
+        start = time.time()
+        con.append_items_bulk({'itemName': 'item%d' % i,
+                               'description': 'batch %d of product %d' %
+                               (i % 97, i),
+                               'restaurantName': 'search%d' % (i % 100)}
+                              for i in xrange(rows))
+        setup.append({'step': 'append_items_bulk', 'rows': rows,
+                      'seconds': time.time() - start})
+        raw = con.con
+        like_user = ('SELECT username, firstname, lastname FROM user WHERE '
+                     'username LIKE ? OR firstname LIKE ? OR lastname LIKE ? '
+                     'OR email LIKE ? LIMIT 101')
+        like_item = ('SELECT itemId, itemName, description FROM item WHERE '
+                     'itemName LIKE ? OR description LIKE ? LIMIT 101')
+        runs = [('search_users', 'search123456', like_user, 4),
+                ('search_users', 'first4242', like_user, 4),
+                ('search_users', 'search99@example', like_user, 4),
+                ('search_users', 'fi', like_user, 4),
+                ('search_items', 'item777777', like_item, 2),
+                ('search_items', 'product 31415', like_item, 2)]
+        for method, text, like, columns in runs:
+            pattern = '%%%s%%' % text
+            like_ms, _ = _best_ms(lambda: raw.execute(
+                like, (pattern,) * columns).fetchall(), rounds)
+            search_ms, (found, _) = _best_ms(
+                lambda: getattr(con, method)(text), rounds)
+            queries.append({'method': method, 'query': text,
+                            'matches': len(found), 'like_ms': like_ms,
+                            'search_ms': search_ms})
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return setup, queries
+
+
+def _synthetic_ledger(rows, restaurant_ids, items, vendor_ids, first_day,
+                      days):
+    '''
+    Yields ``rows`` parameter tuples of random stock transactions for the
+    columns ``price, quantity, quantityInStock, expireDate, date, isoDate,
+    isoExpireDate, transactionType, vendorId, itemId, restaurantId``.
+    ``items`` maps every restaurant id to the ids of its items. Every item is
+    bought from one vendor, and only purchases have a vendor.
+
+    '''
+    rand = random.Random(12)
+    dates = []
+    for offset in xrange(days + 30):
+        day = first_day + datetime.timedelta(days=offset)
+        dates.append((day.strftime('%d-%m-%Y'), day.isoformat()))
+    types = (STOCK_PURCHASE,) * 4 + (STOCK_CONSUMPTION,) * 5 + (STOCK_WASTE,)
+    for _ in xrange(rows):
+        restaurant_id = rand.choice(restaurant_ids)
+        offset = rand.randrange(days)
+        date, iso_date = dates[offset]
+        expire, iso_expire = dates[offset + rand.randrange(1, 30)]
+        item = rand.randrange(len(items[restaurant_id]))
+        transaction_type = rand.choice(types)
+        vendor_id = (vendor_ids[item % len(vendor_ids)]
+                     if transaction_type == STOCK_PURCHASE else None)
+        #Purchases are larger than consumptions, so the stock grows
+        quantity = rand.randrange(1, 50 if vendor_id is not None else 20)
+        yield (round(rand.uniform(0.5, 20.0), 2), quantity, 0,
+               expire, date, iso_date, iso_expire, transaction_type,
+               vendor_id, items[restaurant_id][item], restaurant_id)
+
+
+def _best_ms(function, rounds):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def _load_synthetic_ledger(con, rows, restaurants, items, vendors, first_day,
+                           days):
+    '''
+    Creates synthetic restaurants, items and vendors and loads a ledger of
+    ``rows`` random stock transactions. The ledger is loaded with the stock
+    triggers dropped and the aggregates and batches are then rebuilt in one
+    pass, which is how a large ledger would be imported.
+
+    :return: a tuple ``(names, restaurant_ids, item_ids, setup)`` where
+        ``item_ids`` maps the restaurant ids to the ids of their items and
+        ``setup`` is a list of dictionaries with the keys ``step``,
+        ``seconds`` and ``rows``.
+
+    '''
+    setup = []
+    con.append_restaurants_bulk(_synthetic_restaurants(restaurants, 'report'))
+    names = ['report%d' % i for i in xrange(restaurants)]
+    con.append_items_bulk({'itemName': 'item%d' % i, 'description': '',
+                           'restaurantName': name}
+                          for name in names for i in xrange(items))
+    con.append_vendors_bulk({'name': 'vendor%d' % i, 'address': '',
+                             'email': '', 'phone': '',
+                             'restaurantName': names[0]}
+                            for i in xrange(vendors))
+    raw = con.con
+    restaurant_ids = [raw.execute('SELECT restaurantId FROM restaurant '
+                                  'WHERE restaurantName = ?',
+                                  (name,)).fetchone()[0]
+                      for name in names]
+    item_ids = dict((restaurant_id, [row[0] for row in raw.execute(
+        'SELECT itemId FROM item WHERE restaurantId = ?',
+        (restaurant_id,))]) for restaurant_id in restaurant_ids)
+    vendor_ids = [row[0] for row in raw.execute(
+        'SELECT vendorId FROM vendor WHERE Name LIKE ?', ('vendor%',))]
+
+    triggers = raw.execute("SELECT name, sql FROM sqlite_master WHERE "
+                           "type = 'trigger' AND tbl_name = 'stock'"
+                           ).fetchall()
+    for name, _ in triggers:
+        raw.execute('DROP TRIGGER %s' % name)
+    raw.commit()
+    start = time.time()
+    ledger = _synthetic_ledger(rows, restaurant_ids, item_ids, vendor_ids,
+                               first_day, days)
+    while True:
+        cur = raw.executemany(
+            'INSERT INTO stock(price, quantity, quantityInStock, '
+            'expireDate, date, isoDate, isoExpireDate, transactionType, '
+            'vendorId, itemId, restaurantId) '
+            'VALUES(?,?,?,?,?,?,?,?,?,?,?)',
+            itertools.islice(ledger, 500000))
+        raw.commit()
+        if cur.rowcount < 500000:
+            break
+    setup.append({'step': 'load ledger', 'rows': rows,
+                  'seconds': time.time() - start})
+    for _, sql in triggers:
+        raw.execute(sql)
+    start = time.time()
+    aggregates = con.rebuild_stock_levels()
+    aggregates += reporting.rebuild_rollups(con)
+    setup.append({'step': 'rebuild aggregates', 'rows': aggregates,
+                  'seconds': time.time() - start})
+    start = time.time()
+    setup.append({'step': 'rebuild batches',
+                  'rows': con.rebuild_stock_batches(),
+                  'seconds': time.time() - start})
+    return names, restaurant_ids, item_ids, setup
+
+
+def bench_reporting(db_path=DEFAULT_DB_PATH, rows=10000000, restaurants=10,
+                    items=50, vendors=20, days=730, rounds=3):
+    '''
+    Loads a synthetic ledger of ``rows`` stock transactions and compares the
+    spend per vendor computed from the raw ledger, with the free text dates
+    and with the ISO date index, against :py:func:`reporting.spend_by_vendor`,
+    which reads the rollups. The ledger is loaded with
+    :py:func:`_load_synthetic_ledger`.
+
+    :return: a tuple ``(setup, queries)``. ``setup`` is a list of
+        dictionaries with the keys ``step``, ``seconds`` and ``rows``.
+        ``queries`` is a list of dictionaries with the keys ``range_days``,
+        ``text_dates_ms``, ``iso_index_ms`` and ``rollup_ms`` (best of
+        ``rounds``).
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    queries = []
+    first_day = datetime.date(2024, 1, 1)
+    try:
+        names, restaurant_ids, item_ids, setup = _load_synthetic_ledger(
+            con, rows, restaurants, items, vendors, first_day, days)
+        raw = con.con
+        start = time.time()
+        for i in xrange(1000):
+            con.record_stock_transaction(names[0],
+                                         item_ids[restaurant_ids[0]][0],
+                                         STOCK_PURCHASE, 1, 1.0)
+        setup.append({'step': '1000 record_stock_transaction', 'rows': 1000,
+                      'seconds': time.time() - start})
+
+        restaurant_id = restaurant_ids[0]
+        text_query = ('''
+            SELECT vendorId, sum(quantity), sum(quantity * price) FROM stock
+            WHERE restaurantId = ? AND transactionType = 'input'
+              AND substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' ||
+                  substr(date, 1, 2) BETWEEN ? AND ?
+            GROUP BY vendorId''')
+        iso_query = ('''
+            SELECT vendorId, sum(quantity), sum(quantity * price) FROM stock
+            WHERE restaurantId = ? AND transactionType = 'input'
+              AND isoDate BETWEEN ? AND ?
+            GROUP BY vendorId''')
+        for length in (7, 90, 365):
+            end = first_day + datetime.timedelta(days=days - 1)
+            begin = end - datetime.timedelta(days=length - 1)
+            pvalue = (restaurant_id, begin.isoformat(), end.isoformat())
+            text_ms, expected = _best_ms(
+                lambda: raw.execute(text_query, pvalue).fetchall(), rounds)
+            iso_ms, _ = _best_ms(
+                lambda: raw.execute(iso_query, pvalue).fetchall(), rounds)
+            rollup_ms, report = _best_ms(
+                lambda: reporting.spend_by_vendor(con, names[0], begin, end),
+                rounds)
+            assert (sorted((row[0], row[1]) for row in expected) ==
+                    [(row['vendorId'], row['quantity']) for row in report])
+            queries.append({'range_days': length, 'text_dates_ms': text_ms,
+                            'iso_index_ms': iso_ms, 'rollup_ms': rollup_ms})
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return setup, queries
+
+
+def bench_expiry(db_path=DEFAULT_DB_PATH, rows=1000000, restaurants=10,
+                 items=50, vendors=20, days=730, rounds=1000):
+    '''
+    Compares reading the next expiring batches of a restaurant with
+    :py:meth:`database.Connection.get_expiring_batches` against scanning and
+    parsing ``stock.expireDate``, and measures two consecutive daily sweeps
+    of the expired batches. The ledger is loaded with
+    :py:func:`_load_synthetic_ledger`.
+
+    :return: a tuple ``(setup, results)``. ``setup`` has the format
+        returned by :py:func:`_load_synthetic_ledger`. ``results`` is a list
+        of dictionaries with the keys ``operation``, ``batches`` and ``ms``
+        (mean of ``rounds`` calls for the queries).
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    results = []
+    first_day = datetime.date(2024, 1, 1)
+    try:
+        names, restaurant_ids, _, setup = _load_synthetic_ledger(
+            con, rows, restaurants, items, vendors, first_day, days)
+        raw = con.con
+
+        def scan():
+            batches = []
+            for row in raw.execute(
+                    "SELECT id, itemId, quantity, expireDate FROM stock "
+                    "WHERE restaurantId = ? AND transactionType = 'input'",
+                    (restaurant_ids[0],)):
+                expire = datetime.datetime.strptime(row[3], '%d-%m-%Y')
+                batches.append((expire, row[0], row))
+            batches.sort()
+            return batches[:10]
+        start = time.time()
+        scan()
+        results.append({'operation': 'scan expireDate', 'batches': 10,
+                        'ms': (time.time() - start) * 1000})
+        start = time.time()
+        for _ in xrange(rounds):
+            batches = con.get_expiring_batches(names[0], 10)
+        results.append({'operation': 'get_expiring_batches',
+                        'batches': len(batches),
+                        'ms': (time.time() - start) * 1000 / rounds})
+        #The first sweep flags the whole backlog, the next one a single day
+        for offset in (days, days + 1):
+            today = first_day + datetime.timedelta(days=offset)
+            start = time.time()
+            flagged = con.sweep_expired_batches(today)
+            results.append({'operation': 'sweep %s' % today.isoformat(),
+                            'batches': len(flagged),
+                            'ms': (time.time() - start) * 1000})
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return setup, results
+
+
+def bench_export(db_path=DEFAULT_DB_PATH, rows=1000000, restaurants=200,
+                 items=50, vendors=20, days=365, process_counts=(1, 2, 4)):
+    '''
+    Compares exporting every restaurant with its items and ledger through
+    the Connection methods, get_restaurants and then get_restaurant and
+    get_stock_transactions page by page, against
+    :py:func:`export.export_dataset` with 1..n processes. The ledger is
+    loaded with :py:func:`_load_synthetic_ledger`.
+
+    :return: a tuple ``(setup, results)``. ``setup`` has the format
+        returned by :py:func:`_load_synthetic_ledger`. ``results`` is a list
+        of dictionaries with the keys ``method``, ``processes``, ``rows``,
+        ``seconds`` and ``rows_per_s``.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path, pool_size=1)
+    con = engine.connect()
+    results = []
+    try:
+        names, restaurant_ids, item_ids, setup = _load_synthetic_ledger(
+            con, rows, restaurants, items, vendors,
+            datetime.date(2024, 1, 1), days)
+        start = time.time()
+        exported = 0
+        with open(os.path.join(os.path.dirname(path), 'export.json'),
+                  'wb') as out:
+            for restaurant in con.get_restaurants():
+                name = restaurant['restaurantName']
+                out.write(json.dumps(con.get_restaurant(name)))
+                exported += 1
+                restaurant_id = con._lookup_id('restaurant_id_by_name', name)
+                for item_id in item_ids.get(restaurant_id, ()):
+                    after = None
+                    while True:
+                        transactions, after = con.get_stock_transactions(
+                            name, item_id, 1000, after)
+                        out.write(json.dumps(transactions))
+                        exported += 1 + len(transactions)
+                        if after is None:
+                            break
+        seconds = time.time() - start
+        results.append({'method': 'Connection methods', 'processes': 1,
+                        'rows': exported, 'seconds': seconds,
+                        'rows_per_s': exported / seconds})
+        con.close()
+        for processes in process_counts:
+            report = export.export_dataset(
+                path, os.path.join(os.path.dirname(path), 'export%d' %
+                                   processes), processes)
+            results.append({'method': 'export_dataset',
+                            'processes': processes, 'rows': report['rows'],
+                            'seconds': report['seconds'],
+                            'rows_per_s': report['rows_per_s']})
+    finally:
+        con.close()
+        engine.dispose()
+        _remove_copy(path)
+    return setup, results
+
+
+def _write_stock(connect, names, transactions):
+    '''
+    Records ``transactions`` purchases for every restaurant of ``names``,
+    one thread per restaurant, each with its own connection returned by
+    ``connect()``.
+
+    :return: a tuple ``(seconds, errors)``.
+
+    '''
+    errors = []
+
+    def worker(name):
+        con = connect()
+        try:
+            item_id = con.get_stock_levels(name)[0]['itemId']
+            for _ in xrange(transactions):
+                con.record_stock_transaction(name, item_id, STOCK_PURCHASE,
+                                             1, 1.0)
+        except Exception, excp:
+            errors.append(excp)
+        finally:
+            con.close()
+    threads = [threading.Thread(target=worker, args=(name,))
+               for name in names]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, len(errors)
+
+
+def bench_sharding(db_path=DEFAULT_DB_PATH, restaurant_counts=(1, 2, 4, 8),
+                   transactions=2000, profile=None):
+    '''
+    Compares the stock write throughput of a single database file with a
+    :py:class:`sharding.ShardedEngine` when every restaurant has its own
+    writer thread. With ``synchronous=FULL`` in ``profile`` every commit
+    waits for the disk, which is when separate write locks pay off most.
+
+    :return: a list of dictionaries with the keys ``restaurants``,
+        ``single_file_tx_per_s``, ``sharded_tx_per_s`` and ``errors``.
+
+    '''
+    results = []
+    for count in restaurant_counts:
+        names = ['shard%d' % i for i in xrange(count)]
+        row = {'restaurants': count, 'errors': 0}
+        for mode in ('single_file', 'sharded'):
+            path = _copy_database(db_path)
+            if mode == 'sharded':
+                engine = ShardedEngine(path, pool_size=2, profile=profile)
+            else:
+                engine = Engine(path, pool_size=count + 1, profile=profile)
+            con = engine.connect()
+            try:
+                con.append_restaurants_bulk(_synthetic_restaurants(count,
+                                                                   'shard'))
+                con.append_items_bulk({'itemName': 'item', 'description': '',
+                                       'restaurantName': name}
+                                      for name in names)
+                #One purchase per restaurant creates its stock level
+                for name in names:
+                    if mode == 'sharded':
+                        item_id = con.shard(name).con.execute(
+                            'SELECT itemId FROM item').fetchone()[0]
+                    else:
+                        item_id = con.con.execute(
+                            'SELECT itemId FROM item i JOIN restaurant r ON '
+                            'CAST(i.restaurantId AS INTEGER) = r.restaurantId '
+                            'WHERE restaurantName = ?', (name,)).fetchone()[0]
+                    con.record_stock_transaction(name, item_id,
+                                                 STOCK_PURCHASE, 1, 1.0)
+                seconds, errors = _write_stock(engine.connect, names,
+                                               transactions)
+                row[mode + '_tx_per_s'] = count * transactions / seconds
+                row['errors'] += errors
+            finally:
+                con.close()
+                engine.dispose()
+                _remove_copy(path)
+        results.append(row)
+    return results
+
+
+def bench_group_commit(db_path=DEFAULT_DB_PATH, workers=8, writes=250,
+                       durabilities=('normal', 'full')):
+    '''
+    Compares ``workers`` threads adding users through their own Connection,
+    one commit per write, with the same threads sending the writes to a
+    :py:class:`group_commit.GroupCommitWriter`.
+
+    :return: a list of dictionaries with the keys ``mode``, ``durability``,
+        ``ops_per_s``, ``mean_batch_size`` and ``mean_commit_ms``.
+
+    '''
+    user = {'firstname': 'group', 'lastname': 'commit', 'phone': '0400000000',
+            'email': 'group@example.com', 'password': 'secret',
+            'dob': '01-01-2000'}
+    results = []
+    for durability in durabilities:
+        for mode in ('direct', 'group_commit'):
+            path = _copy_database(db_path)
+            engine = Engine(path, pool_size=workers + 1,
+                            profile=connection_profile(
+                                synchronous=durability.upper()))
+            engine.connect().close()
+            writer = None
+            if mode == 'group_commit':
+                writer = GroupCommitWriter(engine, durability=durability)
+
+            def worker(number):
+                names = ['gc%d_%d' % (number, i) for i in xrange(writes)]
+                if writer is not None:
+                    for future in [writer.append_user(name, user)
+                                   for name in names]:
+                        future.result()
+                    return
+                con = engine.connect()
+                try:
+                    for name in names:
+                        con.append_user(name, user)
+                finally:
+                    con.close()
+
+            try:
+                threads = [threading.Thread(target=worker, args=(i,))
+                           for i in xrange(workers)]
+                start = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.time() - start
+                row = {'mode': mode, 'durability': durability,
+                       'ops_per_s': workers * writes / elapsed,
+                       'mean_batch_size': 1.0, 'mean_commit_ms': 0.0}
+                if writer is not None:
+                    writer.close()
+                    metrics = writer.metrics()
+                    row['mean_batch_size'] = metrics['mean_batch_size']
+                    row['mean_commit_ms'] = metrics['mean_commit_ms']
+                    writer = None
+            finally:
+                if writer is not None:
+                    writer.close()
+                engine.dispose()
+                _remove_copy(path)
+            results.append(row)
+    return results
+
+
+def bench_logins(db_path=DEFAULT_DB_PATH, users=200, logins=400,
+                 clients=(1, 8, 32), iterations=10000, hash_threads=None):
+    '''
+    Measures bursts of ``logins`` concurrent
+    :py:meth:`auth.Authenticator.verify_credentials` calls from ``clients``
+    threads, while another thread reads users with
+    :py:meth:`database.Connection.get_user`, and the checks of the sessions
+    opened by the logins. The first row is the reader without logins.
+
+    :param int iterations: cost of the password hashes.
+    :param int hash_threads: hashing threads. If None, one per CPU.
+    :return: a list of dictionaries with the keys ``mode``, ``clients``,
+        ``ops_per_s``, ``p50_ms``, ``p99_ms`` and ``reader_p99_ms``.
+
+    '''
+    path = _copy_database(db_path)
+    engine = Engine(path)
+    auth = Authenticator(engine, PasswordHasher(iterations), hash_threads)
+    results = []
+    try:
+        con = engine.connect()
+        try:
+            con.append_users_bulk(_synthetic_users(users, 'login'))
+        finally:
+            con.close()
+        auth.upgrade_passwords()
+        usernames = ['login%d' % i for i in xrange(users)]
+
+        def percentile(latencies, fraction):
+            latencies.sort()
+            return latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * fraction))]
+
+        def burst(mode, count, function):
+            '''
+            Runs ``function(username)`` ``logins`` times from ``count``
+            threads while the reader runs.
+
+            '''
+            latencies = []
+            reads = []
+            done = threading.Event()
+
+            def reader():
+                reader_con = engine.connect()
+                try:
+                    while not done.is_set():
+                        start = time.time()
+                        reader_con.get_user(random.choice(usernames))
+                        reads.append((time.time() - start) * 1000)
+                        time.sleep(0.001)
+                finally:
+                    reader_con.close()
+
+            def client(number):
+                for i in xrange(number, logins, count):
+                    start = time.time()
+                    function(usernames[i % users])
+                    latencies.append((time.time() - start) * 1000)
+
+            reader_thread = threading.Thread(target=reader)
+            reader_thread.start()
+            threads = [threading.Thread(target=client, args=(i,))
+                       for i in xrange(count)]
+            start = time.time()
+            if count:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            else:
+                time.sleep(1.0)
+            elapsed = time.time() - start
+            done.set()
+            reader_thread.join()
+            row = {'mode': mode, 'clients': count, 'ops_per_s': 0.0,
+                   'p50_ms': 0.0, 'p99_ms': 0.0,
+                   'reader_p99_ms': percentile(reads, 0.99)}
+            if latencies:
+                row.update({'ops_per_s': len(latencies) / elapsed,
+                            'p50_ms': percentile(latencies, 0.5),
+                            'p99_ms': percentile(latencies, 0.99)})
+            results.append(row)
+
+        burst('no logins', 0, None)
+        tokens = {}
+
+        def login(username):
+            tokens[username] = auth.verify_credentials(username, 'secret')
+        for count in clients:
+            burst('verify_credentials', count, login)
+        for count in clients:
+            burst('check_session', count,
+                  lambda username: auth.check_session(tokens[username]))
+    finally:
+        auth.close()
+        engine.dispose()
+        _remove_copy(path)
+    return results
+
+
+def _write_user_dump(path, dump, users):
+    '''
+    Writes a copy of a data dump with ``users`` more users appended.
+
+    '''
+    shutil.copy(dump, path)
+    rows = _synthetic_users(users, 'dump')
+    with open(path, 'a') as f:
+        while True:
+            chunk = list(itertools.islice(rows, 500))
+            if not chunk:
+                break
+            f.write('INSERT INTO `user` (firstname,lastname,username,email,'
+                    'password,phone,dob) VALUES %s;\n' % ',\n '.join(
+                        "('%(firstname)s','%(lastname)s','%(username)s',"
+                        "'%(email)s','%(password)s','%(phone)s','%(dob)s')"
+                        % user for user in chunk))
+
+
+def bench_bootstrap(schema=DEFAULT_SCHEMA, dump=DEFAULT_DATA_DUMP,
+                    user_counts=(0, 100000), rounds=5):
+    '''
+    Compares rebuilding a database file from the SQL dumps with
+    :py:meth:`database.Engine.reset` and restoring a snapshot written by
+    :py:meth:`database.Engine.snapshot`, for the shipped data dump plus
+    ``user_counts`` synthetic users.
+
+    :return: a list of dictionaries with the keys ``users``, ``reset_ms``,
+        ``snapshot_ms`` and ``restore_ms``.
+
+    '''
+    results = []
+    for users in user_counts:
+        tmp_dir = tempfile.mkdtemp(prefix='rms-bench-')
+        try:
+            data = os.path.join(tmp_dir, 'data.sql')
+            _write_user_dump(data, dump, users)
+            snapshot = os.path.join(tmp_dir, 'snapshot.db')
+            engine = Engine(os.path.join(tmp_dir, 'rms.db'))
+            reset_ms, _ = _best_ms(lambda: engine.reset(schema, data), rounds)
+            snapshot_ms, _ = _best_ms(lambda: engine.snapshot(snapshot),
+                                      rounds)
+            restore_ms, _ = _best_ms(lambda: engine.restore(snapshot), rounds)
+            con = engine.connect()
+            try:
+                assert len(con.get_users()) == users + 4, 'Users lost'
+            finally:
+                con.close()
+            engine.dispose()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        results.append({'users': users, 'reset_ms': reset_ms,
+                        'snapshot_ms': snapshot_ms, 'restore_ms': restore_ms})
+    return results
+
+
+def _print_table(title, columns, rows):
+    cells = []
+    for row in rows:
+        cells.append([('%.2f' % row[c]) if isinstance(row[c], float)
+                      else str(row[c]) for c in columns])
+    widths = [max([len(c)] + [len(line[i]) for line in cells])
+              for i, c in enumerate(columns)]
+    print title
+    print '  '.join(c.rjust(w) for c, w in zip(columns, widths))
+    for line in cells:
+        print '  '.join(v.rjust(w) for v, w in zip(line, widths))
+    print
+
+
+def main(argv):
+    db_path = argv[1] if len(argv) > 1 else DEFAULT_DB_PATH
+    _print_table('Connection profile: statements and microseconds per call',
+                 ('method', 'legacy_statements', 'statements', 'legacy_us',
+                  'us'),
+                 bench_connection_profile(db_path))
+    _print_table('Per-call overhead of the public methods',
+                 ('method', 'us'), bench_method_overhead(db_path))
+    _print_table('Cost of the instrumentation per call',
+                 ('method', 'plain_us', 'instrumented_us', 'overhead_us'),
+                 bench_instrumentation(db_path))
+    _print_table('append_user under contention',
+                 ('workers', 'attempts', 'inserted', 'double_successes',
+                  'duplicates', 'errors', 'ops_per_s'),
+                 [stress_append_user(db_path)])
+    _print_table('append_user, modify_user and delete_user from several '
+                 'processes',
+                 ('mode', 'workers', 'writes', 'ops_per_s', 'lock_errors',
+                  'other_errors', 'error_rate_pct'),
+                 bench_process_contention(db_path))
+    _print_table('Bulk import of users',
+                 ('method', 'rows', 'seconds', 'rows_per_s'),
+                 bench_bulk_import(db_path))
+    _print_table('dict and record modes',
+                 ('method', 'mode', 'rows_per_s', 'bytes_per_row',
+                  'gc_objects_per_row'),
+                 bench_record_mode(db_path))
+    _print_table('Listing 1M users',
+                 ('method', 'rows', 'first_row_ms', 'seconds',
+                  'peak_rss_growth_mb'),
+                 bench_user_listing(db_path))
+    setup, queries = bench_reporting(db_path)
+    _print_table('Reporting: 10M row ledger', ('step', 'rows', 'seconds'),
+                 setup)
+    _print_table('Reporting: spend per vendor of one restaurant',
+                 ('range_days', 'text_dates_ms', 'iso_index_ms', 'rollup_ms'),
+                 queries)
+    _print_table('Reads of 1..n threads during writes: shared pool and '
+                 'read-only replicas',
+                 ('mode', 'threads', 'cpus', 'reads_per_s', 'write_p50_ms',
+                  'write_max_ms'),
+                 bench_read_replicas(db_path))
+    _print_table('Restaurant with its staff, items and vendors',
+                 ('staff', 'method', 'statements', 'p50_ms', 'p95_ms'),
+                 bench_restaurant_details(db_path))
+    _print_table('Change log: 200k users', ('operation', 'rows', 'ms'),
+                 bench_change_log(db_path))
+    setup, queries = bench_search(db_path)
+    _print_table('Search: 1M users and 1M items', ('step', 'rows', 'seconds'),
+                 setup)
+    _print_table('Search: first page of results',
+                 ('method', 'query', 'matches', 'like_ms', 'search_ms'),
+                 queries)
+    setup, results = bench_expiry(db_path)
+    _print_table('Expiry: 1M row ledger', ('step', 'rows', 'seconds'), setup)
+    _print_table('Expiry: FEFO queries and sweeps',
+                 ('operation', 'batches', 'ms'), results)
+    setup, results = bench_export(db_path)
+    _print_table('Export: 1M row ledger', ('step', 'rows', 'seconds'), setup)
+    _print_table('Export of the restaurants, items and ledger',
+                 ('method', 'processes', 'rows', 'seconds', 'rows_per_s'),
+                 results)
+    for synchronous in ('NORMAL', 'FULL'):
+        _print_table('Stock writes: one writer thread per restaurant, '
+                     'synchronous=%s' % synchronous,
+                     ('restaurants', 'single_file_tx_per_s',
+                      'sharded_tx_per_s', 'errors'),
+                     bench_sharding(db_path, profile=connection_profile(
+                         synchronous=synchronous)))
+    _print_table('append_user: one commit per write and group commit',
+                 ('mode', 'durability', 'ops_per_s', 'mean_batch_size',
+                  'mean_commit_ms'),
+                 bench_group_commit(db_path))
+    _print_table('Login bursts: PBKDF2 with 10000 iterations',
+                 ('mode', 'clients', 'ops_per_s', 'p50_ms', 'p99_ms',
+                  'reader_p99_ms'),
+                 bench_logins(db_path))
+    _print_table('Bootstrap: dump replay and snapshot restore',
+                 ('users', 'reset_ms', 'snapshot_ms', 'restore_ms'),
+                 bench_bootstrap())
+
+
+if __name__ == '__main__':
+    main(sys.argv)
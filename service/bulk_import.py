@@ -0,0 +1,119 @@
+'''
+Created on 16.10.2026
+
+Command line tool that streams users, restaurants, items or vendors from a
+CSV or JSONL file into the database using the bulk import methods of
+:py:class:`database.Connection`.
+
+The file is read one record at a time, so files of any size can be imported.
+CSV files must have a header with the keys expected by the bulk method, for
+instance::
+
+    python service/bulk_import.py users staff.csv
+    python service/bulk_import.py --db db/rms.db items menu.jsonl
+
+'''
+
+import argparse, csv, json, os, sys
+
+from database import Engine, DEFAULT_DB_PATH, DEFAULT_BULK_CHUNK_SIZE
+
+#Bulk method of database.Connection used for every kind of record.
+BULK_METHODS = {'users': 'append_users_bulk',
+                'restaurants': 'append_restaurants_bulk',
+                'items': 'append_items_bulk',
+                'vendors': 'append_vendors_bulk'}
+
+
+def read_csv(path):
+    '''
+    Yields the rows of a CSV file as dictionaries with unicode values.
+
+    '''
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            yield dict((key.decode('utf-8'),
+                        value.decode('utf-8') if value is not None else None)
+                       for key, value in row.items())
+
+
+def read_jsonl(path):
+    '''
+    Yields the objects of a JSONL file, one per non empty line.
+
+    '''
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_records(path, file_format=None):
+    '''
+    Returns a generator of records read from a CSV or JSONL file.
+
+    :param str path: location of the file.
+    :param str file_format: ``csv`` or ``jsonl``. If None it is deduced from
+        the file extension.
+    :raises ValueError: if the format is not supported.
+
+    '''
+    if file_format is None:
+        file_format = os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format in ('json', 'ndjson'):
+            file_format = 'jsonl'
+    if file_format == 'csv':
+        return read_csv(path)
+    if file_format == 'jsonl':
+        return read_jsonl(path)
+    raise ValueError("Unsupported file format %s" % file_format)
+
+
+def import_file(db_path, kind, path, file_format=None,
+                chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+    '''
+    Imports a CSV or JSONL file into the database.
+
+    :param str db_path: location of the database file.
+    :param str kind: one of the keys of :py:data:`BULK_METHODS`.
+    :param str path: location of the file to import.
+    :return: dictionary with the format provided in the method
+        :py:meth:`database.Connection._bulk_append`
+
+    '''
+    engine = Engine(db_path, pool_size=1)
+    con = engine.connect()
+    try:
+        method = getattr(con, BULK_METHODS[kind])
+        return method(read_records(path, file_format), chunk_size)
+    finally:
+        con.close()
+        engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream CSV or JSONL '
+                                     'records into the database.')
+    parser.add_argument('kind', choices=sorted(BULK_METHODS))
+    parser.add_argument('path', help='CSV or JSONL file')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH,
+                        help='database file (default %(default)s)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='file format (default: from the extension)')
+    parser.add_argument('--chunk-size', type=int,
+                        default=DEFAULT_BULK_CHUNK_SIZE,
+                        help='rows per executemany (default %(default)s)')
+    args = parser.parse_args(argv)
+    report = import_file(args.db, args.kind, args.path, args.format,
+                         args.chunk_size)
+    for error in report['errors']:
+        print >> sys.stderr, 'record %d (%s): %s' % (
+            error['index'], error['key'], error['error'])
+    print '%d %s imported, %d rejected' % (report['inserted'], args.kind,
+                                           len(report['errors']))
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,11 +10,1634 @@ Provides the database API to access the forum persistent data.
 '''
 
 from datetime import datetime
-import time, sqlite3, re, os
+import time, sqlite3, re, os, shutil, threading, itertools, sys, random
+import operator, contextlib, urllib, inspect, json, cPickle
+from collections import OrderedDict
 #Default paths for .db and .sql files to create and populate the database.
 DEFAULT_DB_PATH = 'db/rms.db'
 DEFAULT_SCHEMA = "db/rms_schema_dump.sql"
 DEFAULT_DATA_DUMP = "db/rms_data_dump.sql"
+#Default settings of the connection pool used by the Engine.
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 30.0
+#Number of rows passed to each executemany by the bulk import methods.
+DEFAULT_BULK_CHUNK_SIZE = 500
+#Rows per page or per fetchmany of the paginated and streaming list methods.
+DEFAULT_PAGE_SIZE = 100
+#Default retry of the writes that find the database locked (see RetryPolicy).
+#Delays are in seconds.
+DEFAULT_RETRY_ATTEMPTS = 5
+DEFAULT_RETRY_BASE_DELAY = 0.01
+DEFAULT_RETRY_MAX_DELAY = 0.5
+#Isolation level of the transactions that sqlite3 opens before the first
+#write. IMMEDIATE takes the write lock at BEGIN, where the busy timeout
+#applies, instead of failing when a read transaction upgrades to a write.
+WRITE_ISOLATION_LEVEL = 'IMMEDIATE'
+#Connection methods that only read. An Engine with readers runs them on its
+#read-only connections.
+READ_METHODS = ('get_user', 'get_restaurant', 'get_restaurant_details',
+                'get_users', 'get_restaurants', 'get_users_page',
+                'get_restaurants_page', 'iter_users', 'iter_restaurants',
+                'search_users', 'search_restaurants', 'search_items',
+                'get_stock_level', 'get_stock_levels',
+                'get_stock_transactions', 'get_expiring_batches',
+                'verify_stock_levels', 'get_changes', 'iter_changes',
+                'get_password_hash', 'get_password_hashes')
+#Lists of the restaurant aggregate returned by get_restaurant_details.
+RESTAURANT_DETAIL_FIELDS = ('staff', 'items', 'vendors')
+#Default limits of the read-through cache of get_user, get_restaurant and
+#get_restaurant_details.
+DEFAULT_CACHE_TTL = 60.0
+DEFAULT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+#Type of the objects returned by get_user and the list methods: dictionaries
+#or compact Record tuples (see Record).
+RECORD_MODES = ('dict', 'record')
+#Values of stock.transactionType. Any other value found in older ledgers is
+#counted as a consumption.
+STOCK_PURCHASE = 'input'
+STOCK_CONSUMPTION = 'output'
+STOCK_WASTE = 'waste'
+STOCK_TRANSACTION_TYPES = (STOCK_PURCHASE, STOCK_CONSUMPTION, STOCK_WASTE)
+#Format of the stock dates, as in the existing ledger.
+STOCK_DATE_FORMAT = '%d-%m-%Y'
+#PRAGMAs applied once to every sqlite3 connection when it is opened. The order
+#of CONNECTION_PRAGMAS is the order in which they are executed.
+CONNECTION_PRAGMAS = ('journal_mode', 'synchronous', 'foreign_keys',
+                      'cache_size', 'mmap_size', 'temp_store', 'busy_timeout',
+                      'query_only')
+DEFAULT_CONNECTION_PROFILE = {'journal_mode': 'WAL',
+                              'synchronous': 'NORMAL',
+                              'foreign_keys': 'ON',
+                              #Negative values are KiB: 8 MiB page cache
+                              'cache_size': -8192,
+                              'mmap_size': 64 * 1024 * 1024,
+                              'temp_store': 'MEMORY',
+                              #Milliseconds
+                              'busy_timeout': 5000
+                              }
+#PRAGMAs of the connection that loads the SQL dumps. The dumps insert the rows
+#of a table before the rows they reference, so the foreign keys are checked
+#once the whole dump is loaded.
+BULK_LOAD_PROFILE = dict(DEFAULT_CONNECTION_PROFILE, synchronous='OFF',
+                         foreign_keys='OFF', cache_size=-65536)
+#Tables emptied by Engine.clear(), in order. The ledger goes first so that its
+#triggers do not recreate the aggregates.
+CLEAR_TABLES = ('stock', 'stockLevel', 'stockDaily', 'stockWeekly',
+                'restaurantUser', 'item', 'vendor', 'user', 'restaurant',
+                'restaurantChange', 'changeLog')
+_PRAGMA_VALUE = re.compile(r'^-?[A-Za-z0-9_]+$')
+_LEDGER_DATE = re.compile(r'^(\d\d)[-./](\d\d)[-./](\d{4})$')
+_ISO_DATE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)')
+_DUMP_TRANSACTION = re.compile(r'^\s*(BEGIN TRANSACTION|COMMIT)\s*;\s*$',
+                               re.MULTILINE | re.IGNORECASE)
+_DUMP_CREATE_TABLE = re.compile(r'CREATE TABLE (?!IF NOT EXISTS)',
+                                re.IGNORECASE)
+#Number of batches read at a time when a consumption is allocated.
+_BATCH_FETCH = 16
+#Words of a search query, see search_expression()
+_SEARCH_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def to_date(value):
+    '''
+    Converts a date given as ``datetime.date``, ``dd-mm-yyyy`` or
+    ``yyyy-mm-dd`` into a ``datetime.date``.
+
+    :raises ValueError: if the value is not a valid date.
+
+    '''
+    if isinstance(value, datetime):
+        return value.date()
+    if hasattr(value, 'isoformat'):
+        return value
+    match = _LEDGER_DATE.match(value)
+    if match is not None:
+        day, month, year = match.groups()
+    else:
+        match = _ISO_DATE.match(value)
+        if match is None:
+            raise ValueError("Invalid date %s" % value)
+        year, month, day = match.groups()
+    return datetime(int(year), int(month), int(day)).date()
+
+
+def normalize_date(value):
+    '''
+    Returns a date in the sortable format of the ISO stock columns
+    (``yyyy-mm-dd``).
+
+    :raises ValueError: if the value is not a valid date.
+
+    '''
+    return to_date(value).isoformat()
+
+
+def _normalize_sql(sql):
+    '''
+    Collapses the whitespace of a SQL statement into single spaces.
+
+    '''
+    return re.sub(r'\s+', ' ', sql).strip()
+
+#Named SQL statements used by the Connection methods. Every statement is
+#normalized once here, so each one maps to exactly one entry of the sqlite3
+#statement cache instead of one entry per whitespace variant.
+STATEMENTS = dict((name, _normalize_sql(sql)) for name, sql in {
+    #The columns are in the order of UserRecord.fields
+    'user_by_username': '''
+        SELECT firstname, lastname, email, phone, username, dob FROM user
+        WHERE username = ?''',
+    'user_id_by_username': 'SELECT userId FROM user WHERE username = ?',
+    #Only the first staff member is read: LIMIT 1 lets the statement finish
+    #so that the reused cursor does not keep a read transaction open
+    'restaurant_with_staff': '''
+        SELECT r.*, u.*, ru.position, u.phone AS uphone, r.phone AS rphone
+        FROM restaurant r
+        JOIN restaurantUser ru ON r.restaurantId = ru.restaurantId
+        JOIN user u ON ru.userId = u.userId
+        WHERE restaurantName = ?
+        LIMIT 1''',
+    'restaurant_id_by_name':
+        'SELECT restaurantId FROM restaurant WHERE restaurantName = ?',
+    #The restaurant aggregate: the columns are in the order of the fields of
+    #RestaurantRecord, StaffRecord, ItemRecord and VendorRecord
+    'restaurant_by_name': '''
+        SELECT restaurantId, restaurantName, address, phone FROM restaurant
+        WHERE restaurantName = ?''',
+    'restaurant_staff': '''
+        SELECT u.username, u.firstname, u.lastname, u.email, u.phone, u.dob,
+               ru.position
+        FROM restaurantUser ru JOIN user u ON u.userId = ru.userId
+        WHERE ru.restaurantId = ? ORDER BY ru.id''',
+    'restaurant_items': '''
+        SELECT itemId, itemName, description FROM item
+        WHERE restaurantId = ? ORDER BY itemId''',
+    'restaurant_vendors': '''
+        SELECT vendorId, Name, address, email, phont FROM vendor
+        WHERE restaurantId = ? ORDER BY vendorId''',
+    'restaurant_id_by_item': 'SELECT restaurantId FROM item WHERE itemId = ?',
+    'restaurant_name_by_name':
+        'SELECT restaurantName FROM restaurant WHERE restaurantName = ?',
+    'users_list': 'SELECT username, firstname, lastname FROM user',
+    'users_page_first': '''
+        SELECT username, firstname, lastname FROM user
+        ORDER BY username LIMIT ?''',
+    'users_page_after': '''
+        SELECT username, firstname, lastname FROM user
+        WHERE username > ? ORDER BY username LIMIT ?''',
+    'restaurants_list': 'SELECT restaurantName, address, phone FROM restaurant',
+    'restaurants_page_first': '''
+        SELECT restaurantName, address, phone FROM restaurant
+        ORDER BY restaurantName LIMIT ?''',
+    'restaurants_page_after': '''
+        SELECT restaurantName, address, phone FROM restaurant
+        WHERE restaurantName > ? ORDER BY restaurantName LIMIT ?''',
+    'insert_user': '''
+        INSERT INTO user(username, firstname, lastname, phone, email,
+                         password, dob)
+        VALUES(?,?,?,?,?,?,?)''',
+    'append_user': '''
+        INSERT INTO user(username, firstname, lastname, phone, email,
+                         password, dob)
+        VALUES(?,?,?,?,?,?,?)
+        ON CONFLICT(username) DO NOTHING''',
+    'modify_user': '''
+        UPDATE user SET firstname = ?, lastname = ?, phone = ?, email = ?,
+                        dob = ?
+        WHERE username = ?''',
+    'delete_user': 'DELETE FROM user WHERE username = ?',
+    'user_password': 'SELECT password FROM user WHERE username = ?',
+    'user_passwords_first': '''
+        SELECT username, password FROM user ORDER BY username LIMIT ?''',
+    'user_passwords_after': '''
+        SELECT username, password FROM user
+        WHERE username > ? ORDER BY username LIMIT ?''',
+    'set_password': 'UPDATE user SET password = ? WHERE username = ?',
+    'replace_password': '''
+        UPDATE user SET password = ? WHERE username = ? AND password = ?''',
+    'insert_restaurant':
+        'INSERT INTO restaurant(restaurantName, address, phone) VALUES(?,?,?)',
+    'modify_restaurant': '''
+        UPDATE restaurant SET restaurantName = ?, address = ?, phone = ?
+        WHERE restaurantName = ?''',
+    'insert_restaurant_user': '''
+        INSERT INTO restaurantUser(userId, restaurantId, position)
+        VALUES(?,?,?)''',
+    'insert_item': '''
+        INSERT INTO item(itemName, description, restaurantId)
+        VALUES(?,?,?)''',
+    'insert_vendor': '''
+        INSERT INTO vendor(Name, address, email, phont, restaurantId)
+        VALUES(?,?,?,?,?)''',
+    #quantityInStock is the on-hand quantity after the transaction, read
+    #from the aggregate in the same statement
+    'insert_stock': '''
+        INSERT INTO stock(price, quantity, quantityInStock, expireDate, date,
+                          transactionType, vendorId, itemId, restaurantId,
+                          userId, remaining)
+        VALUES(?, ?, coalesce((SELECT onHand FROM stockLevel
+                               WHERE restaurantId = ? AND itemId = ?), 0) + ?,
+               ?, ?, ?, ?, ?, ?, ?, ?)''',
+    #Batches are the purchases; remaining is the quantity not yet consumed.
+    #The partial indexes only hold the batches with remaining quantity.
+    'stock_batches_fefo': '''
+        SELECT id, remaining FROM stock
+        WHERE restaurantId = ? AND itemId = ? AND remaining > 0
+          AND isoExpireDate IS NOT NULL
+        ORDER BY isoExpireDate, id LIMIT %d''' % _BATCH_FETCH,
+    'stock_batches_no_expiry': '''
+        SELECT id, remaining FROM stock
+        WHERE restaurantId = ? AND itemId = ? AND remaining > 0
+          AND isoExpireDate IS NULL
+        ORDER BY id LIMIT %d''' % _BATCH_FETCH,
+    'stock_take_batch':
+        'UPDATE stock SET remaining = remaining - ? WHERE id = ?',
+    'expiring_batches': '''
+        SELECT id, itemId, remaining, isoExpireDate, price, vendorId
+        FROM stock
+        WHERE restaurantId = ? AND remaining > 0 AND expired = 0
+          AND isoExpireDate IS NOT NULL AND isoExpireDate <= ?
+        ORDER BY isoExpireDate, id LIMIT ?''',
+    'expired_batches_due': '''
+        SELECT id, restaurantId, itemId, remaining, isoExpireDate FROM stock
+        WHERE remaining > 0 AND expired = 0 AND isoExpireDate IS NOT NULL
+          AND isoExpireDate < ?
+        ORDER BY isoExpireDate LIMIT ?''',
+    'flag_expired_batch': 'UPDATE stock SET expired = 1 WHERE id = ?',
+    'stock_level': '''
+        SELECT itemId, onHand, purchasedQuantity, purchasedValue,
+               consumedQuantity, wastedQuantity, transactions
+        FROM stockLevel WHERE restaurantId = ? AND itemId = ?''',
+    'stock_levels': '''
+        SELECT itemId, onHand, purchasedQuantity, purchasedValue,
+               consumedQuantity, wastedQuantity, transactions
+        FROM stockLevel WHERE restaurantId = ? ORDER BY itemId''',
+    'stock_transactions': '''
+        SELECT id, price, quantity, quantityInStock, expireDate, date,
+               transactionType, vendorId, itemId, userId
+        FROM stock WHERE restaurantId = ? AND itemId = ? AND id > ?
+        ORDER BY id LIMIT ?''',
+    'stock_levels_all': '''
+        SELECT restaurantId, itemId, onHand, purchasedQuantity,
+               purchasedValue, consumedQuantity, wastedQuantity, transactions
+        FROM stockLevel''',
+    #bm25() weights follow the columns of SEARCH_INDEXES
+    'search_users': '''
+        SELECT u.username, u.firstname, u.lastname
+        FROM userSearch s JOIN user u ON u.userId = s.rowid
+        WHERE userSearch MATCH ?
+        ORDER BY bm25(userSearch, 4.0, 2.0, 2.0, 1.0), u.userId
+        LIMIT ? OFFSET ?''',
+    'search_restaurants': '''
+        SELECT r.restaurantName, r.address, r.phone
+        FROM restaurantSearch s JOIN restaurant r ON r.restaurantId = s.rowid
+        WHERE restaurantSearch MATCH ?
+        ORDER BY bm25(restaurantSearch, 4.0, 1.0), r.restaurantId
+        LIMIT ? OFFSET ?''',
+    'search_items': '''
+        SELECT i.itemId, i.itemName, i.description, i.restaurantId,
+               bm25(itemSearch, 4.0, 1.0) AS rank
+        FROM itemSearch s JOIN item i ON i.itemId = s.rowid
+        WHERE itemSearch MATCH ?
+        ORDER BY rank, i.itemId LIMIT ? OFFSET ?''',
+    'changes_after': '''
+        SELECT seq, tableName, operation, rowKey, time, data FROM changeLog
+        WHERE seq > ? ORDER BY seq LIMIT ?''',
+    #Oldest position from which the log is complete, and last sequence
+    #number given to a change
+    'change_log_bounds': '''
+        SELECT coalesce((SELECT truncatedSeq FROM changeLogState), 0),
+               coalesce((SELECT seq FROM sqlite_sequence
+                         WHERE name = 'changeLog'), 0)''',
+    'truncate_change_log':
+        'UPDATE changeLogState SET truncatedSeq = max(truncatedSeq, ?)',
+    #A change is superseded by a later change of the same row
+    'collapse_changes': '''
+        DELETE FROM changeLog
+        WHERE seq > ? AND seq <= ? AND EXISTS (
+            SELECT 1 FROM changeLog later
+            WHERE later.tableName = changeLog.tableName
+              AND later.rowKey = changeLog.rowKey
+              AND later.seq > changeLog.seq)''',
+    'delete_changes': 'DELETE FROM changeLog WHERE seq > ? AND seq <= ?',
+    'change_seq_range': 'SELECT min(seq), max(seq) FROM changeLog',
+    'change_seq_keeping': '''
+        SELECT seq FROM changeLog ORDER BY seq DESC LIMIT 1 OFFSET ?''',
+    'first_change_since':
+        'SELECT seq FROM changeLog WHERE time >= ? ORDER BY seq LIMIT 1',
+    'search_items_of_restaurant': '''
+        SELECT i.itemId, i.itemName, i.description, i.restaurantId,
+               bm25(itemSearch, 4.0, 1.0) AS rank
+        FROM itemSearch s JOIN item i ON i.itemId = s.rowid
+        WHERE itemSearch MATCH ? AND i.restaurantId = ?
+        ORDER BY rank, i.itemId LIMIT ? OFFSET ?''',
+}.items())
+#Size of the sqlite3 statement cache of every connection: all the named
+#statements plus room for ad hoc ones.
+STATEMENT_CACHE_SIZE = max(100, 2 * len(STATEMENTS))
+
+
+def connection_profile(**pragmas):
+    '''
+    Builds a connection profile from :py:data:`DEFAULT_CONNECTION_PROFILE`,
+    overriding the given PRAGMAs. Use ``None`` to skip a PRAGMA.
+
+    :Example:
+
+    >>> engine = Engine(profile=connection_profile(synchronous='FULL'))
+
+    :return: a dictionary with the PRAGMA names as keys.
+    :raises ValueError: if a PRAGMA is not in :py:data:`CONNECTION_PRAGMAS`.
+
+    '''
+    profile = dict(DEFAULT_CONNECTION_PROFILE)
+    for name, value in pragmas.items():
+        if name not in CONNECTION_PRAGMAS:
+            raise ValueError("Unknown connection PRAGMA %s" % name)
+        profile[name] = value
+    return profile
+
+
+def apply_connection_profile(con, profile):
+    '''
+    Executes the PRAGMAs of a connection profile, sets
+    :py:class:`sqlite3.Row` as the row factory of the connection and makes
+    its implicit transactions start with :py:data:`WRITE_ISOLATION_LEVEL`.
+
+    :param sqlite3.Connection con: the connection to configure.
+    :param dict profile: the PRAGMA values, see :py:func:`connection_profile`
+    :raises ValueError: if a PRAGMA value is not a plain keyword or number.
+
+    '''
+    for name in CONNECTION_PRAGMAS:
+        value = profile.get(name)
+        if value is None:
+            continue
+        if not _PRAGMA_VALUE.match(str(value)):
+            raise ValueError("Invalid value %r for PRAGMA %s" % (value, name))
+        con.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+    con.row_factory = sqlite3.Row
+    con.isolation_level = WRITE_ISOLATION_LEVEL
+
+
+#Whether SQLite accepts URI file names, see _uri_filenames()
+_URI_FILENAMES = None
+
+
+def _uri_filenames():
+    '''
+    Tells if the SQLite library interprets ``file:`` URIs as file names. The
+    sqlite3 module of Python 2 cannot enable them, so they only work when
+    SQLite was compiled with ``SQLITE_USE_URI``.
+
+    '''
+    global _URI_FILENAMES
+    if _URI_FILENAMES is None:
+        con = sqlite3.connect(':memory:')
+        try:
+            _URI_FILENAMES = any(row[0].startswith('USE_URI') for row in
+                                 con.execute('PRAGMA compile_options'))
+        finally:
+            con.close()
+    return _URI_FILENAMES
+
+
+def open_connection(db_path, profile=None, check_same_thread=True,
+                    read_only=False):
+    '''
+    Opens a sqlite3 connection configured with a connection profile.
+
+    :param str db_path: Location of the database file.
+    :param dict profile: the PRAGMA values. If None the
+        :py:data:`DEFAULT_CONNECTION_PROFILE` is used.
+    :param bool check_same_thread: passed to :py:func:`sqlite3.connect`
+    :param bool read_only: if ``True`` the file is opened with
+        ``mode=ro``, when SQLite accepts URI file names, and ``query_only``
+        is set. The journal mode of the file is left as it is.
+    :rtype: sqlite3.Connection
+
+    '''
+    if profile is None:
+        profile = DEFAULT_CONNECTION_PROFILE
+    if read_only:
+        profile = dict(profile, journal_mode=None, query_only='ON')
+        if _uri_filenames():
+            db_path = 'file:%s?mode=ro' % urllib.pathname2url(
+                os.path.abspath(db_path))
+    con = sqlite3.connect(db_path, check_same_thread=check_same_thread,
+                          cached_statements=STATEMENT_CACHE_SIZE)
+    try:
+        apply_connection_profile(con, profile)
+    except Exception:
+        con.close()
+        raise
+    return con
+
+
+def _read_dump(path):
+    '''
+    Reads a SQL dump and prepares it to be loaded in a single transaction:
+    the ``BEGIN TRANSACTION`` and ``COMMIT`` lines of the dump are removed
+    and the tables are created only if they do not exist, so the data dump
+    can be loaded over the schema dump.
+
+    '''
+    with open(path) as f:
+        script = f.read()
+    script = _DUMP_TRANSACTION.sub('', script)
+    return _DUMP_CREATE_TABLE.sub('CREATE TABLE IF NOT EXISTS ', script)
+
+
+def _add_missing_columns(con):
+    '''
+    Adds the columns used by the API that older database files lack:
+    ``vendor.restaurantId`` and ``restaurantUser.position``.
+
+    '''
+    columns = {'vendor': ('restaurantId', 'INTEGER REFERENCES '
+                          'restaurant(restaurantId) ON DELETE CASCADE'),
+               'restaurantUser': ('position', 'TEXT')}
+    for table, (column, definition) in sorted(columns.items()):
+        existing = [row[1] for row in
+                    con.execute('PRAGMA table_info(%s)' % table)]
+        if existing and column not in existing:
+            con.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                        (table, column, definition))
+
+def _iso_date_sql(column):
+    '''
+    Returns a SQL expression converting a date column written as
+    ``dd-mm-yyyy`` (also with ``.`` or ``/``) or ``yyyy-mm-dd`` into the
+    sortable ``yyyy-mm-dd`` format. Other values become NULL.
+
+    '''
+    return ('''(CASE
+        WHEN {c} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+        THEN substr({c}, 1, 10)
+        WHEN {c} GLOB '[0-9][0-9][-./][0-9][0-9][-./][0-9][0-9][0-9][0-9]'
+        THEN substr({c}, 7, 4) || '-' || substr({c}, 4, 2) || '-' ||
+             substr({c}, 1, 2)
+        END)'''.format(c=column))
+
+
+def _week_sql(day):
+    '''
+    Returns a SQL expression with the Monday of the week of an ISO ``day``.
+
+    '''
+    return "date(%s, 'weekday 0', '-6 days')" % day
+
+#Measures of every stock aggregate as (column, expression over a ledger row
+#{row}). Unknown transaction types count as consumptions.
+_STOCK_MEASURES = (
+    ('onHand', "CASE {row}.transactionType WHEN 'input' "
+               "THEN coalesce({row}.quantity, 0) "
+               "ELSE -coalesce({row}.quantity, 0) END"),
+    ('purchasedQuantity', "CASE {row}.transactionType WHEN 'input' "
+                          "THEN coalesce({row}.quantity, 0) ELSE 0 END"),
+    ('purchasedValue', "CASE {row}.transactionType WHEN 'input' "
+                       "THEN coalesce({row}.quantity * {row}.price, 0.0) "
+                       "ELSE 0.0 END"),
+    ('consumedQuantity', "CASE WHEN {row}.transactionType "
+                         "NOT IN ('input', 'waste') "
+                         "THEN coalesce({row}.quantity, 0) ELSE 0 END"),
+    ('wastedQuantity', "CASE {row}.transactionType WHEN 'waste' "
+                       "THEN coalesce({row}.quantity, 0) ELSE 0 END"),
+    ('transactions', '1'))
+#Keys of the stock aggregates as (column, expression over a ledger row).
+#Rows with a NULL key are not aggregated.
+_STOCK_LEVEL_KEYS = (('restaurantId', '{row}.restaurantId'),
+                     ('itemId', '{row}.itemId'))
+_STOCK_ROLLUP_KEYS = {
+    'stockDaily': (('restaurantId', '{row}.restaurantId'),
+                   ('day', _iso_date_sql('{row}.date')),
+                   ('itemId', '{row}.itemId'),
+                   ('vendorId', 'coalesce({row}.vendorId, 0)')),
+    'stockWeekly': (('restaurantId', '{row}.restaurantId'),
+                    ('week', _week_sql(_iso_date_sql('{row}.date'))),
+                    ('itemId', '{row}.itemId'),
+                    ('vendorId', 'coalesce({row}.vendorId, 0)'))}
+
+
+def _stock_aggregate_table(table, keys):
+    '''
+    Returns the CREATE TABLE statement of a stock aggregate.
+
+    '''
+    columns = ['%s %s NOT NULL' % (column, 'TEXT' if column in ('day', 'week')
+                                   else 'INTEGER')
+               for column, _ in keys]
+    columns += ['%s %s NOT NULL DEFAULT 0' %
+                (column, 'REAL' if column == 'purchasedValue' else 'INTEGER')
+                for column, _ in _STOCK_MEASURES]
+    #The primary key is the covering index of the range queries
+    return ('CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY(%s)) '
+            'WITHOUT ROWID' % (table, ', '.join(columns),
+                               ', '.join(column for column, _ in keys)))
+
+
+def _stock_aggregate_change(table, keys, row, sign):
+    '''
+    Returns the statements of a stock trigger that add (``sign`` 1) or
+    subtract (``sign`` -1) the ``row`` (``NEW`` or ``OLD``) of the ledger to
+    its aggregate in ``table``.
+
+    '''
+    key_columns = [column for column, _ in keys]
+    measure_columns = [column for column, _ in _STOCK_MEASURES]
+    values = [expression.format(row=row) for _, expression in keys]
+    values += ['%d * (%s)' % (sign, expression.format(row=row))
+               for _, expression in _STOCK_MEASURES]
+    return '''
+        INSERT INTO {table}({columns})
+        SELECT {values}
+        WHERE {not_null}
+        ON CONFLICT({keys}) DO UPDATE SET {updates};
+        DELETE FROM {table} WHERE {match} AND transactions = 0;'''.format(
+        table=table, columns=', '.join(key_columns + measure_columns),
+        values=', '.join(values), keys=', '.join(key_columns),
+        not_null=' AND '.join('%s IS NOT NULL' % value
+                              for value in values[:len(keys)]),
+        updates=', '.join('%s = %s + excluded.%s' % (column, column, column)
+                          for column in measure_columns),
+        match=' AND '.join('%s = %s' % (column, value)
+                           for column, value in zip(key_columns, values)))
+
+
+def _stock_aggregate_triggers(table, keys, columns):
+    '''
+    Returns the statements creating the triggers that keep a stock aggregate
+    up to date. The update trigger fires only when one of ``columns``
+    changes.
+
+    '''
+    return ['CREATE TRIGGER IF NOT EXISTS %s_insert AFTER INSERT ON stock '
+            'BEGIN %s END' % (table, _stock_aggregate_change(table, keys,
+                                                             'NEW', 1)),
+            'CREATE TRIGGER IF NOT EXISTS %s_delete AFTER DELETE ON stock '
+            'BEGIN %s END' % (table, _stock_aggregate_change(table, keys,
+                                                             'OLD', -1)),
+            'CREATE TRIGGER IF NOT EXISTS %s_update AFTER UPDATE OF %s ON '
+            'stock BEGIN %s %s END' % (
+                table, ', '.join(columns),
+                _stock_aggregate_change(table, keys, 'OLD', -1),
+                _stock_aggregate_change(table, keys, 'NEW', 1))]
+
+
+def _stock_aggregate_query(keys):
+    '''
+    Returns the SELECT computing a stock aggregate from the whole ledger, with
+    the columns in the order of the table.
+
+    '''
+    values = [expression.format(row='stock') for _, expression in keys]
+    return ('SELECT %s, %s FROM stock WHERE %s GROUP BY %s' % (
+        ', '.join('%s AS %s' % (value, column)
+                  for value, (column, _) in zip(values, keys)),
+        ', '.join('total(%s) AS %s' % (expression.format(row='stock'), column)
+                  for column, expression in _STOCK_MEASURES),
+        ' AND '.join('%s IS NOT NULL' % value for value in values),
+        ', '.join(str(i + 1) for i in xrange(len(values)))))
+
+
+def _fill_stock_aggregate(con, table, keys):
+    '''
+    Recomputes a stock aggregate table from the whole ledger.
+
+    :return: the number of aggregate rows written.
+
+    '''
+    con.execute('DELETE FROM %s' % table)
+    return con.execute('INSERT INTO %s(%s) %s' % (
+        table, ', '.join([c for c, _ in keys] + [c for c, _ in _STOCK_MEASURES]),
+        _stock_aggregate_query(keys))).rowcount
+
+
+def _fill_stock_rollups(con):
+    '''
+    Recomputes the daily and weekly stock rollups from the ledger.
+
+    :return: the number of rollup rows written.
+
+    '''
+    return sum(_fill_stock_aggregate(con, table, keys)
+               for table, keys in sorted(_STOCK_ROLLUP_KEYS.items()))
+
+
+def _normalize_stock_dates(con):
+    '''
+    Fills the ISO date columns of the existing ledger rows.
+
+    '''
+    con.execute('UPDATE stock SET isoDate = %s, isoExpireDate = %s' %
+                (_iso_date_sql('date'), _iso_date_sql('expireDate')))
+
+
+def _allocate_batches(con, restaurant_id, item_id, quantity):
+    '''
+    Takes ``quantity`` from the remaining quantity of the batches of an item,
+    first expired first out. Batches without expiry date are used last.
+
+    :return: the quantity that could not be allocated because the batches
+        are exhausted.
+
+    '''
+    for statement in ('stock_batches_fefo', 'stock_batches_no_expiry'):
+        while quantity > 0:
+            batches = con.execute(STATEMENTS[statement],
+                                  (restaurant_id, item_id)).fetchall()
+            if not batches:
+                break
+            for batch_id, remaining in batches:
+                taken = min(remaining, quantity)
+                con.execute(STATEMENTS['stock_take_batch'],
+                            (taken, batch_id))
+                quantity -= taken
+                if quantity == 0:
+                    break
+    return quantity
+
+
+def _fill_stock_batches(con):
+    '''
+    Recomputes the remaining quantity of every batch by allocating the total
+    consumed and wasted quantity of each item to its batches, first expired
+    first out. The expired flags are cleared; the next sweep sets them
+    again.
+
+    :return: the number of items allocated.
+
+    '''
+    con.execute("UPDATE stock SET expired = 0, remaining = CASE "
+                "WHEN transactionType = 'input' THEN coalesce(quantity, 0) "
+                "END")
+    totals = con.execute('SELECT restaurantId, itemId, '
+                         'consumedQuantity + wastedQuantity FROM stockLevel '
+                         'WHERE consumedQuantity + wastedQuantity > 0'
+                         ).fetchall()
+    for restaurant_id, item_id, quantity in totals:
+        _allocate_batches(con, restaurant_id, item_id, quantity)
+    return len(totals)
+
+
+def _fill_stock_levels(con):
+    '''
+    Recomputes the whole stockLevel table from the stock ledger.
+
+    :return: the number of aggregates written.
+
+    '''
+    return _fill_stock_aggregate(con, 'stockLevel', _STOCK_LEVEL_KEYS)
+
+#FTS5 full-text indexes of the searchable tables: index name and tuple
+#(table, key column, indexed columns). The indexes are external content
+#tables: they store only the tokens and read the text from the table.
+SEARCH_INDEXES = {
+    'userSearch': ('user', 'userId',
+                   ('username', 'firstname', 'lastname', 'email')),
+    'restaurantSearch': ('restaurant', 'restaurantId',
+                         ('restaurantName', 'address')),
+    'itemSearch': ('item', 'itemId', ('itemName', 'description')),
+    }
+#Tokenizer and prefix indexes of SEARCH_INDEXES. The prefix indexes answer
+#the prefix queries of two and three characters without scanning the terms.
+_SEARCH_OPTIONS = ("tokenize = 'unicode61 remove_diacritics 2', "
+                   "prefix = '2 3'")
+
+
+def _search_index(index, table, key, columns):
+    '''
+    Returns the statements creating a full-text index of ``table`` and the
+    triggers keeping it in sync with the table.
+
+    '''
+    names = ', '.join(columns)
+    new = ', '.join('NEW.%s' % column for column in columns)
+    old = ', '.join('OLD.%s' % column for column in columns)
+    insert = ('INSERT INTO %s(rowid, %s) VALUES(NEW.%s, %s);' %
+              (index, names, key, new))
+    delete = ("INSERT INTO %s(%s, rowid, %s) VALUES('delete', OLD.%s, %s);" %
+              (index, index, names, key, old))
+    return ["CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, "
+            "content = '%s', content_rowid = '%s', %s)" %
+            (index, names, table, key, _SEARCH_OPTIONS),
+            'CREATE TRIGGER IF NOT EXISTS %s_insert AFTER INSERT ON %s '
+            'BEGIN %s END' % (index, table, insert),
+            'CREATE TRIGGER IF NOT EXISTS %s_delete AFTER DELETE ON %s '
+            'BEGIN %s END' % (index, table, delete),
+            'CREATE TRIGGER IF NOT EXISTS %s_update AFTER UPDATE OF %s ON %s '
+            'BEGIN %s %s END' % (index, names, table, delete, insert)]
+
+
+def _fill_search_indexes(con):
+    '''
+    Rebuilds every full-text index from its table.
+
+    '''
+    for index in sorted(SEARCH_INDEXES):
+        con.execute("INSERT INTO %s(%s) VALUES('rebuild')" % (index, index))
+
+
+#Tables whose rows belong to a restaurant, with the column holding its id.
+#The triggers of _restaurant_change_triggers() record their changes in the
+#table restaurantChange. item.restaurantId is declared TEXT.
+RESTAURANT_CHANGE_SOURCES = (('restaurant', 'restaurantId'),
+                             ('restaurantUser', 'restaurantId'),
+                             ('item', 'CAST(%s.restaurantId AS INTEGER)'),
+                             ('vendor', 'restaurantId'),
+                             ('stock', 'restaurantId'))
+#Marks the restaurants selected by the trigger as changed with the next
+#version. Writes are serialized, so versions grow in commit order.
+_MARK_RESTAURANT_CHANGED = '''
+    INSERT INTO restaurantChange(restaurantId, version)
+    SELECT {column},
+           coalesce((SELECT max(version) FROM restaurantChange), 0) + 1
+    {source} WHERE {condition}
+    ON CONFLICT(restaurantId) DO UPDATE SET version = excluded.version;'''
+
+
+def _mark_restaurant_changed(column, condition, source=''):
+    return _normalize_sql(_MARK_RESTAURANT_CHANGED.format(
+        column=column, condition=condition, source=source))
+
+
+def _restaurant_change_triggers():
+    '''
+    Returns the statements creating the triggers that record in the table
+    ``restaurantChange`` the last version in which every restaurant, its
+    staff, items, vendors or stock changed. An update of a user changes the
+    restaurants where the user works.
+
+    '''
+    statements = []
+    for table, column in RESTAURANT_CHANGE_SOURCES:
+        if '%s' not in column:
+            column = '%s.' + column
+        new, old = column % 'NEW', column % 'OLD'
+        mark_new = _mark_restaurant_changed(new, '%s IS NOT NULL' % new)
+        mark_old = _mark_restaurant_changed(old, '%s IS NOT NULL' % old)
+        #The old restaurant also changes when a row moves to another one
+        mark_moved = _mark_restaurant_changed(
+            old, '%s IS NOT NULL AND %s IS NOT %s' % (old, old, new))
+        statements += [
+            'CREATE TRIGGER IF NOT EXISTS restaurantChange_%s_insert '
+            'AFTER INSERT ON %s BEGIN %s END' % (table, table, mark_new),
+            'CREATE TRIGGER IF NOT EXISTS restaurantChange_%s_delete '
+            'AFTER DELETE ON %s BEGIN %s END' % (table, table, mark_old),
+            'CREATE TRIGGER IF NOT EXISTS restaurantChange_%s_update '
+            'AFTER UPDATE ON %s BEGIN %s %s END' % (table, table, mark_new,
+                                                    mark_moved)]
+    statements.append(
+        'CREATE TRIGGER IF NOT EXISTS restaurantChange_user_update '
+        'AFTER UPDATE ON user BEGIN %s END' % _mark_restaurant_changed(
+            'ru.restaurantId', 'ru.userId = NEW.userId',
+            'FROM restaurantUser ru'))
+    return statements
+
+
+def _fill_restaurant_changes(con):
+    '''
+    Records every existing restaurant as changed in the first version.
+
+    '''
+    con.execute('INSERT OR IGNORE INTO restaurantChange(restaurantId, '
+                'version) SELECT restaurantId, 1 FROM restaurant')
+
+
+#Columns of a user that are published with the restaurants and in the change
+#log. The password is not one of them.
+USER_DATA_COLUMNS = ('username', 'firstname', 'lastname', 'email', 'phone',
+                     'dob')
+#Tables recorded in the change log, with their key and the columns stored
+#as a JSON object in the data of every change. The passwords of the users
+#are left out, and so are the ISO dates of the stock, which are derived from
+#its dates.
+CHANGE_LOG_TABLES = (
+    ('user', 'userId', USER_DATA_COLUMNS),
+    ('restaurant', 'restaurantId', ('restaurantName', 'address', 'phone')),
+    ('restaurantUser', 'id', ('userId', 'restaurantId', 'position')),
+    ('item', 'itemId', ('itemName', 'description', 'restaurantId')),
+    ('vendor', 'vendorId',
+     ('Name', 'address', 'email', 'phont', 'restaurantId')),
+    ('stock', 'id',
+     ('price', 'quantity', 'quantityInStock', 'expireDate', 'date',
+      'transactionType', 'vendorId', 'itemId', 'restaurantId', 'userId',
+      'remaining', 'expired')))
+#Values of changeLog.operation.
+CHANGE_OPERATIONS = ('insert', 'update', 'delete')
+#Unix time of a change in seconds.
+_CHANGE_TIME = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def _change_log_triggers():
+    '''
+    Returns the statements creating the triggers that append every insert,
+    delete and update of the tables of :py:data:`CHANGE_LOG_TABLES` to the
+    table ``changeLog``. The updates of columns that are not recorded are
+    not logged.
+
+    '''
+    statements = []
+    for table, key, columns in CHANGE_LOG_TABLES:
+        for operation in CHANGE_OPERATIONS:
+            row = 'OLD' if operation == 'delete' else 'NEW'
+            event = operation.upper()
+            if operation == 'update':
+                event += ' OF ' + ', '.join(columns)
+            data = ', '.join("'%s', %s.%s" % (column, row, column)
+                             for column in (key,) + columns)
+            statements.append(
+                'CREATE TRIGGER IF NOT EXISTS changeLog_%s_%s AFTER %s ON %s '
+                'BEGIN INSERT INTO changeLog(tableName, operation, rowKey, '
+                "time, data) VALUES('%s', '%s', %s.%s, %s, json_object(%s)); "
+                'END' % (table, operation, event, table, table, operation,
+                         row, key, _CHANGE_TIME, data))
+    return statements
+
+
+def search_expression(text):
+    '''
+    Turns free text into an FTS5 query matching the rows that contain every
+    word of the text as a prefix of one of their words, for instance
+    ``ali has`` into ``"ali"* "has"*``. Punctuation separates words, as in
+    the index, so an email address can be searched as typed.
+
+    :return: the query, or None if the text has no words.
+
+    '''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    terms = _SEARCH_TERM.findall(text)
+    if not terms:
+        return None
+    return u' '.join(u'"%s"*' % term for term in terms)
+
+#Versioned schema migrations. Each entry is a tuple (version, description,
+#steps) where every step is either a SQL statement or a function receiving the
+#sqlite3 connection. The last version applied to a database file is stored in
+#its PRAGMA user_version, so the migrations run on a live database without
+#dumping and reloading it. See Engine.migrate().
+MIGRATIONS = [
+    (1, 'Add the columns missing from older database files',
+     [_add_missing_columns]),
+    (2, 'Unique lookup keys for users and restaurants',
+     ['CREATE UNIQUE INDEX IF NOT EXISTS user_username_uidx '
+      'ON user(username)',
+      'CREATE UNIQUE INDEX IF NOT EXISTS restaurant_restaurantName_uidx '
+      'ON restaurant(restaurantName)']),
+    (3, 'Indexes for the restaurant staff joins and the foreign keys',
+     ['CREATE INDEX IF NOT EXISTS restaurantUser_restaurantId_idx '
+      'ON restaurantUser(restaurantId, userId)',
+      'CREATE INDEX IF NOT EXISTS restaurantUser_userId_idx '
+      'ON restaurantUser(userId)',
+      'CREATE INDEX IF NOT EXISTS stock_restaurantId_idx '
+      'ON stock(restaurantId)',
+      'CREATE INDEX IF NOT EXISTS stock_itemId_idx ON stock(itemId)',
+      'CREATE INDEX IF NOT EXISTS stock_vendorId_idx ON stock(vendorId)',
+      'CREATE INDEX IF NOT EXISTS stock_userId_idx ON stock(userId)',
+      'CREATE INDEX IF NOT EXISTS item_restaurantId_idx '
+      'ON item(restaurantId)',
+      'CREATE INDEX IF NOT EXISTS vendor_restaurantId_idx '
+      'ON vendor(restaurantId)']),
+    (4, 'On-hand stock aggregates maintained by triggers on the ledger',
+     ['CREATE TABLE IF NOT EXISTS stockLevel ('
+      'restaurantId INTEGER NOT NULL, itemId INTEGER NOT NULL, '
+      'onHand INTEGER NOT NULL DEFAULT 0, '
+      'purchasedQuantity INTEGER NOT NULL DEFAULT 0, '
+      'purchasedValue REAL NOT NULL DEFAULT 0.0, '
+      'consumedQuantity INTEGER NOT NULL DEFAULT 0, '
+      'wastedQuantity INTEGER NOT NULL DEFAULT 0, '
+      'transactions INTEGER NOT NULL DEFAULT 0, '
+      'PRIMARY KEY(restaurantId, itemId))',
+      'CREATE INDEX IF NOT EXISTS stock_restaurantId_itemId_idx '
+      'ON stock(restaurantId, itemId)'] +
+     _stock_aggregate_triggers('stockLevel', _STOCK_LEVEL_KEYS,
+                               ('price', 'quantity', 'transactionType',
+                                'itemId', 'restaurantId')) +
+     [_fill_stock_levels]),
+    (5, 'Sortable stock dates and daily and weekly stock rollups',
+     ['ALTER TABLE stock ADD COLUMN isoDate TEXT',
+      'ALTER TABLE stock ADD COLUMN isoExpireDate TEXT',
+      _normalize_stock_dates,
+      'CREATE INDEX IF NOT EXISTS stock_restaurantId_isoDate_idx '
+      'ON stock(restaurantId, isoDate)',
+      #The ISO columns follow the free text ones
+      'CREATE TRIGGER IF NOT EXISTS stock_iso_dates_insert AFTER INSERT ON '
+      'stock BEGIN UPDATE stock SET isoDate = %s, isoExpireDate = %s '
+      'WHERE id = NEW.id; END' % (_iso_date_sql('NEW.date'),
+                                  _iso_date_sql('NEW.expireDate')),
+      'CREATE TRIGGER IF NOT EXISTS stock_iso_dates_update AFTER UPDATE OF '
+      'date, expireDate ON stock BEGIN UPDATE stock SET isoDate = %s, '
+      'isoExpireDate = %s WHERE id = NEW.id; END' % (
+          _iso_date_sql('NEW.date'), _iso_date_sql('NEW.expireDate'))] +
+     [_stock_aggregate_table(table, keys)
+      for table, keys in sorted(_STOCK_ROLLUP_KEYS.items())] +
+     [statement for table, keys in sorted(_STOCK_ROLLUP_KEYS.items())
+      for statement in _stock_aggregate_triggers(
+          table, keys, ('price', 'quantity', 'transactionType', 'itemId',
+                        'restaurantId', 'vendorId', 'date'))] +
+     [_fill_stock_rollups]),
+    (6, 'Remaining quantity and expiry flag of the stock batches',
+     ['ALTER TABLE stock ADD COLUMN remaining INTEGER',
+      'ALTER TABLE stock ADD COLUMN expired INTEGER NOT NULL DEFAULT 0',
+      'CREATE INDEX IF NOT EXISTS stock_batch_fefo_idx '
+      'ON stock(restaurantId, itemId, isoExpireDate) WHERE remaining > 0',
+      'CREATE INDEX IF NOT EXISTS stock_batch_expiry_idx '
+      'ON stock(restaurantId, isoExpireDate) '
+      'WHERE remaining > 0 AND expired = 0 AND isoExpireDate IS NOT NULL',
+      'CREATE INDEX IF NOT EXISTS stock_batch_sweep_idx '
+      'ON stock(isoExpireDate) '
+      'WHERE remaining > 0 AND expired = 0 AND isoExpireDate IS NOT NULL',
+      _fill_stock_batches]),
+    (7, 'Full-text search indexes of users, restaurants and items',
+     [statement for index, (table, key, columns)
+      in sorted(SEARCH_INDEXES.items())
+      for statement in _search_index(index, table, key, columns)] +
+     [_fill_search_indexes]),
+    (8, 'Versions of the last change of every restaurant',
+     ['CREATE TABLE IF NOT EXISTS restaurantChange ('
+      'restaurantId INTEGER PRIMARY KEY, version INTEGER NOT NULL)',
+      'CREATE INDEX IF NOT EXISTS restaurantChange_version_idx '
+      'ON restaurantChange(version)'] +
+     _restaurant_change_triggers() +
+     [_fill_restaurant_changes]),
+    (9, 'Change log of the restaurant data and the stock ledger',
+     ['CREATE TABLE IF NOT EXISTS changeLog ('
+      'seq INTEGER PRIMARY KEY AUTOINCREMENT, tableName TEXT NOT NULL, '
+      'operation TEXT NOT NULL, rowKey INTEGER NOT NULL, time REAL NOT NULL, '
+      'data TEXT)',
+      'CREATE INDEX IF NOT EXISTS changeLog_row_idx '
+      'ON changeLog(tableName, rowKey, seq)',
+      #The log is complete after truncatedSeq, see compact_changes()
+      'CREATE TABLE IF NOT EXISTS changeLogState ('
+      'id INTEGER PRIMARY KEY CHECK (id = 1), '
+      'truncatedSeq INTEGER NOT NULL)',
+      'INSERT OR IGNORE INTO changeLogState(id, truncatedSeq) VALUES(1, 0)'] +
+     _change_log_triggers()),
+    (10, 'Password changes do not change the restaurants of the user',
+     ['DROP TRIGGER IF EXISTS restaurantChange_user_update',
+      'CREATE TRIGGER IF NOT EXISTS restaurantChange_user_update '
+      'AFTER UPDATE OF %s ON user BEGIN %s END' % (
+          ', '.join(USER_DATA_COLUMNS), _mark_restaurant_changed(
+              'ru.restaurantId', 'ru.userId = NEW.userId',
+              'FROM restaurantUser ru'))]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+class ChangeLogTruncatedError(LookupError):
+    '''
+    Raised by :py:meth:`Connection.get_changes` when the changes after the
+    requested position are no longer in the change log, because the log was
+    truncated by :py:meth:`Connection.compact_changes`, cleared, or belongs
+    to another database file. The consumer has to read the tables again and
+    continue from the ``seq`` attribute of the exception.
+
+    '''
+    def __init__(self, after, seq):
+        super(ChangeLogTruncatedError, self).__init__(
+            'The change log is not complete after %d' % after)
+        self.after = after
+        self.seq = seq
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    '''
+    Raised by :py:meth:`ConnectionPool.checkout` when no connection becomes
+    available before the checkout timeout expires. It usually means that some
+    :py:class:`Connection` instances are never closed.
+
+    '''
+    pass
+
+
+def is_busy_error(excp):
+    '''
+    Tells if an exception is a transient lock error, that is, if the
+    statement failed because another connection held the database lock
+    longer than the busy timeout.
+
+    '''
+    if not isinstance(excp, sqlite3.OperationalError) or \
+            isinstance(excp, PoolTimeoutError):
+        return False
+    message = str(excp)
+    return 'locked' in message or 'busy' in message
+
+
+class RetryPolicy(object):
+    '''
+    Retry of the writes that fail with a transient lock error (see
+    :py:func:`is_busy_error`). The failed transaction is rolled back and the
+    write runs again after a delay chosen at random between zero and an
+    exponentially growing limit ("full jitter"), so writers that collided do
+    not collide again in lockstep.
+
+    The busy timeout of the connection profile is how long SQLite itself
+    waits for the lock before each attempt fails.
+
+    :Example:
+
+    >>> engine = Engine(profile=connection_profile(busy_timeout=250),
+    ...                 retry_policy=RetryPolicy(attempts=8))
+
+    :param int attempts: maximum number of attempts, including the first.
+    :param float base_delay: limit of the delay before the first retry, in
+        seconds. It doubles with every retry.
+    :param float max_delay: upper bound of the delay limit, in seconds.
+
+    '''
+    def __init__(self, attempts=DEFAULT_RETRY_ATTEMPTS,
+                 base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 max_delay=DEFAULT_RETRY_MAX_DELAY):
+        super(RetryPolicy, self).__init__()
+        if attempts < 1:
+            raise ValueError("The number of attempts must be at least 1")
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry):
+        '''
+        Returns the seconds to wait before the retry number ``retry``
+        (starting at 1).
+
+        '''
+        limit = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return random.uniform(0, limit)
+
+    def run(self, function, rollback, on_retry=None):
+        '''
+        Calls ``function`` until it does not fail with a transient lock error
+        or the attempts are exhausted.
+
+        :param function: callable without arguments.
+        :param rollback: callable that discards the failed transaction.
+        :param on_retry: if given, called before every retry.
+        :return: the value returned by ``function``.
+        :raises sqlite3.OperationalError: the lock error of the last attempt.
+
+        '''
+        retry = 0
+        while True:
+            try:
+                return function()
+            except sqlite3.OperationalError, excp:
+                if not is_busy_error(excp):
+                    raise
+                rollback()
+                retry += 1
+                if retry >= self.attempts:
+                    raise
+            if on_retry is not None:
+                on_retry()
+            time.sleep(self.delay(retry))
+
+
+_NO_RETRY = RetryPolicy(attempts=1)
+
+
+def _retry_on_busy(method):
+    '''
+    Decorates a Connection method that writes in a single transaction, so
+    that it is retried with the :py:class:`RetryPolicy` of the connection.
+    Without a policy the failed transaction is rolled back and the error is
+    raised.
+
+    '''
+    def retried(self, *args, **kwargs):
+        call = lambda: method(self, *args, **kwargs)
+        if self.retry_policy is None:
+            return _NO_RETRY.run(call, self.con.rollback)
+        return self.retry_policy.run(call, self.con.rollback,
+                                     lambda: self._on_retry(method.__name__))
+    retried.__name__ = method.__name__
+    retried.__doc__ = method.__doc__
+    return retried
+
+
+class ConnectionPool(object):
+    '''
+    Thread-safe pool of sqlite3 connections to a single database file.
+
+    Connections are opened lazily up to ``size`` and are handed out by
+    :py:meth:`checkout` and given back by :py:meth:`checkin`. Every connection
+    is opened with the connection profile already applied, and it is
+    health checked before being handed out again. A thread gets back the
+    connection it used last time whenever that connection is idle.
+
+    An instance of this class should not be instantiated directly. The
+    :py:class:`Engine` creates one per database file.
+
+    :param str db_path: Location of the database file.
+    :param int size: Maximum number of connections kept open.
+    :param float timeout: Seconds that :py:meth:`checkout` waits for a free
+        connection before raising :py:class:`PoolTimeoutError`.
+    :param dict profile: PRAGMAs applied to every new connection, see
+        :py:func:`connection_profile`
+    :param bool read_only: if ``True`` the connections are read-only, see
+        :py:func:`open_connection`.
+
+    '''
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_POOL_TIMEOUT, profile=None, read_only=False):
+        super(ConnectionPool, self).__init__()
+        if size < 1:
+            raise ValueError("The pool size must be at least 1")
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.profile = profile
+        self.read_only = read_only
+        self._cond = threading.Condition()
+        self._idle = []
+        self._opened = 0
+        #Last connection used by each thread (per-thread affinity)
+        self._local = threading.local()
+        #Metrics
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+    def _open(self):
+        '''
+        Opens a new sqlite3 connection with the connection profile applied.
+
+        '''
+        return open_connection(self.db_path, self.profile,
+                               check_same_thread=False,
+                               read_only=self.read_only)
+
+    def _is_healthy(self, con):
+        '''
+        Checks that an idle connection is still usable.
+
+        '''
+        try:
+            con.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _take_idle(self):
+        '''
+        Removes and returns an idle connection, preferring the one last used by
+        the calling thread. Must be called holding the pool lock.
+
+        '''
+        if not self._idle:
+            return None
+        preferred = getattr(self._local, 'con', None)
+        if preferred is not None:
+            for i, con in enumerate(self._idle):
+                if con is preferred:
+                    return self._idle.pop(i)
+        return self._idle.pop()
+
+    def checkout(self):
+        '''
+        Borrows a connection from the pool, opening a new one if the pool is
+        not full yet.
+
+        :return: an open sqlite3 connection
+        :rtype: sqlite3.Connection
+        :raises PoolTimeoutError: if no connection is available after
+            :py:attr:`timeout` seconds.
+
+        '''
+        start = time.time()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                con = self._take_idle()
+                if con is not None:
+                    break
+                if self._opened < self.size:
+                    #Reserve the slot; the connection is opened below
+                    self._opened += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        "No connection available in the pool after %.1f "
+                        "seconds (size %d)" % (self.timeout, self.size))
+                waited = True
+                self._cond.wait(remaining)
+            elapsed = time.time() - start
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._wait_time += elapsed
+            self._max_wait_time = max(self._max_wait_time, elapsed)
+
+        if con is not None and not self._is_healthy(con):
+            self._discard(con)
+            con = None
+            with self._cond:
+                self._opened += 1
+        if con is None:
+            try:
+                con = self._open()
+            except sqlite3.Error:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+        self._local.con = con
+        return con
+
+    def checkin(self, con):
+        '''
+        Gives back a connection obtained with :py:meth:`checkout`. Any
+        uncommitted change is rolled back.
+
+        :param sqlite3.Connection con: the connection to return.
+
+        '''
+        try:
+            con.rollback()
+        except sqlite3.Error:
+            self._discard(con)
+            with self._cond:
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(con)
+            self._cond.notify()
+
+    def _discard(self, con):
+        '''
+        Closes a broken connection and frees its slot in the pool.
+
+        '''
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._opened -= 1
+            self._discarded += 1
+
+    def dispose(self):
+        '''
+        Closes all the idle connections. Connections currently checked out
+        stay open and go back to the pool when they are returned.
+
+        '''
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for con in idle:
+            con.close()
+
+    def metrics(self):
+        '''
+        Returns the current state and counters of the pool.
+
+        :return: a dictionary with the following keys:
+
+            * ``size``: maximum number of connections
+            * ``opened``: connections currently open
+            * ``idle``: connections waiting in the pool
+            * ``in_use``: connections currently checked out
+            * ``checkouts``: total number of checkouts
+            * ``waits``: checkouts that had to wait for a free connection
+            * ``wait_time``: total seconds spent in :py:meth:`checkout`
+            * ``max_wait_time``: longest checkout in seconds
+            * ``timeouts``: checkouts that raised :py:class:`PoolTimeoutError`
+            * ``discarded``: connections closed after a failed health check
+
+        '''
+        with self._cond:
+            return {'size': self.size,
+                    'opened': self._opened,
+                    'idle': len(self._idle),
+                    'in_use': self._opened - len(self._idle),
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'wait_time': self._wait_time,
+                    'max_wait_time': self._max_wait_time,
+                    'timeouts': self._timeouts,
+                    'discarded': self._discarded
+                    }
+
+
+class RecordCache(object):
+    '''
+    Thread-safe in-process cache of database records with LRU and TTL
+    eviction, bounded both in number of entries and in approximate memory.
+
+    Entries are grouped in namespaces (for instance ``user`` and
+    ``restaurant``) and stored pickled, so callers get their own copy and
+    can modify it without altering the cache. Unpickling a record is several
+    times faster than ``copy.deepcopy``, and the size of the pickle is the
+    memory an entry uses.
+
+    The cache of a file is shared by Engines of every record mode, so the
+    :py:class:`Connection` stores dictionaries, never :py:class:`Record`
+    objects, and builds the records of the ``record`` mode when it reads
+    them.
+
+    A value read from the database is only stored if no invalidation happened
+    since the read started (see :py:meth:`token`). This keeps a reader that
+    raced with a writer from caching the old value after the writer
+    invalidated it.
+
+    An instance of this class should not be instantiated directly. Use
+    :py:func:`shared_cache` so that every :py:class:`Connection` to the same
+    file shares the cache and sees the invalidations of the others.
+
+    :param int max_entries: maximum number of cached records.
+    :param float ttl: seconds a record stays valid.
+    :param int max_bytes: maximum memory used by the pickled records.
+
+    '''
+    def __init__(self, max_entries, ttl=DEFAULT_CACHE_TTL,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        super(RecordCache, self).__init__()
+        if max_entries < 1:
+            raise ValueError("The cache must hold at least one entry")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        #(namespace, key) -> (expires, size, value), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        #Metrics
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def token(self):
+        '''
+        Returns the invalidation counter. Read it before querying the
+        database and pass it to :py:meth:`put`.
+
+        '''
+        with self._lock:
+            return self._generation
+
+    def get(self, namespace, key):
+        '''
+        Returns a copy of a cached record or None if it is not cached or it
+        has expired.
+
+        '''
+        with self._lock:
+            entry = self._entries.pop((namespace, key), None)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires, size, value = entry
+            if expires < time.time():
+                self._bytes -= size
+                self._expirations += 1
+                self._misses += 1
+                return None
+            #Move to the most recently used end
+            self._entries[(namespace, key)] = entry
+            self._hits += 1
+        return cPickle.loads(value)
+
+    def put(self, namespace, key, value, token):
+        '''
+        Stores a copy of a record read from the database.
+
+        :param token: value of :py:meth:`token` before the record was read.
+            If an invalidation happened meanwhile the record is not stored.
+
+        '''
+        value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if token != self._generation:
+                return
+            old = self._entries.pop((namespace, key), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[(namespace, key)] = (time.time() + self.ttl, size,
+                                               value)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self._evictions += 1
+
+    def invalidate(self, namespace, key=None):
+        '''
+        Removes a record, or every record of a namespace if ``key`` is None.
+
+        '''
+        with self._lock:
+            self._generation += 1
+            if key is not None:
+                keys = [(namespace, key)]
+            else:
+                keys = [k for k in self._entries if k[0] == namespace]
+            for k in keys:
+                entry = self._entries.pop(k, None)
+                if entry is not None:
+                    self._bytes -= entry[1]
+                    self._invalidations += 1
+
+    def clear(self):
+        '''
+        Removes every record.
+
+        '''
+        with self._lock:
+            self._generation += 1
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''
+        Returns the counters of the cache.
+
+        :return: a dictionary with the keys ``entries``, ``bytes``,
+            ``hits``, ``misses``, ``evictions`` (entries removed to respect
+            the size limits), ``expirations`` (entries found expired) and
+            ``invalidations`` (entries removed by writes).
+
+        '''
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'expirations': self._expirations,
+                    'invalidations': self._invalidations
+                    }
+
+class Record(tuple):
+    '''
+    Compact read-only record built from a database row.
+
+    It is a tuple with the values of the row and it behaves like the
+    dictionary created by the matching ``_create_*_object`` helper of
+    :py:class:`Connection`: ``record['username']``, :py:meth:`get`,
+    :py:meth:`keys`, :py:meth:`items`, ``in`` and iteration work on the keys,
+    and a record compares equal to the equivalent dictionary. The names of
+    the keys are stored once per class in :py:attr:`fields`, so a record
+    needs much less memory than a dictionary and is created without running
+    Python code. Use :py:meth:`to_dict` to get a real dictionary, for
+    instance to serialize it to JSON.
+
+    Subclasses are created with :py:func:`_record_class`.
+
+    '''
+    __slots__ = ()
+    #Keys of the record, in the order of the columns of the row
+    fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                return tuple.__getitem__(self, self._index[key])
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return list(tuple.__iter__(self))
+
+    def items(self):
+        return zip(self.fields, tuple.__iter__(self))
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def to_dict(self):
+        '''
+        Returns the record as a dictionary.
+
+        '''
+        return dict(zip(self.fields, tuple.__iter__(self)))
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict())
+
+
+def _record_class(name, fields):
+    '''
+    Creates a :py:class:`Record` subclass with the given keys. Every key is
+    also available as an attribute.
+
+    '''
+    attrs = {'__slots__': (),
+             'fields': tuple(fields),
+             '_index': dict((field, i) for i, field in enumerate(fields))}
+    for i, field in enumerate(fields):
+        attrs[field] = property(operator.itemgetter(i))
+    return type(name, (Record,), attrs)
+
+#Records returned in 'record' mode. Their fields follow the columns selected
+#by the corresponding statements.
+UserRecord = _record_class('UserRecord', ('firstname', 'lastname', 'email',
+                                          'phone', 'username', 'dob'))
+UserListRecord = _record_class('UserListRecord',
+                               ('username', 'firstname', 'lastname'))
+RestaurantListRecord = _record_class('RestaurantListRecord',
+                                     ('restaurantName', 'addess', 'phone'))
+RestaurantRecord = _record_class('RestaurantRecord',
+                                 ('restaurantId', 'restaurantName', 'address',
+                                  'phone'))
+StaffRecord = _record_class('StaffRecord',
+                            ('username', 'firstname', 'lastname', 'email',
+                             'phone', 'dob', 'position'))
+ItemRecord = _record_class('ItemRecord', ('itemId', 'itemName', 'description'))
+VendorRecord = _record_class('VendorRecord', ('vendorId', 'name', 'address',
+                                              'email', 'phone'))
+#Statement and record of every list of RESTAURANT_DETAIL_FIELDS.
+_RESTAURANT_DETAILS = {'staff': ('restaurant_staff', StaffRecord),
+                       'items': ('restaurant_items', ItemRecord),
+                       'vendors': ('restaurant_vendors', VendorRecord)}
+
+
+
+def _from_dict(record, value):
+    '''
+    Builds a record of the class ``record`` from the equivalent dictionary.
+
+    '''
+    return record(value[field] for field in record.fields)
+
+
+def _restaurant_details_copy(details, records):
+    '''
+    Returns a copy of the result of
+    :py:meth:`Connection.get_restaurant_details` with the restaurant and the
+    members of its lists as Records if ``records`` is True, or else as
+    dictionaries.
+
+    '''
+    if records:
+        convert = _from_dict
+    else:
+        convert = lambda record, value: value.to_dict()
+    copy = {'restaurant': convert(RestaurantRecord, details['restaurant'])}
+    for field, (_, record) in _RESTAURANT_DETAILS.items():
+        if field in details:
+            copy[field] = [convert(record, value) for value in details[field]]
+    return copy
+
+#Caches shared by all the Engines of this process, by database file.
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def shared_cache(db_path, max_entries, ttl=DEFAULT_CACHE_TTL,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    '''
+    Returns the :py:class:`RecordCache` of a database file, creating it the
+    first time. Later calls for the same file return the same cache and
+    ignore the size arguments.
+
+    '''
+    key = os.path.realpath(db_path)
+    with _shared_caches_lock:
+        cache = _shared_caches.get(key)
+        if cache is None:
+            cache = RecordCache(max_entries, ttl, max_bytes)
+            _shared_caches[key] = cache
+        return cache
 
 
 class Engine(object):
@@ -34,36 +1657,235 @@ class Engine(object):
     :param db_path: The path of the database file (always with respect to the
         calling script. If not specified, the Engine will use the file located
         at *db/forum.db*
+    :param int pool_size: Maximum number of pooled connections. Use ``0`` to
+        open a new sqlite3 connection for every :py:class:`Connection`.
+    :param float pool_timeout: Seconds to wait for a pooled connection before
+        raising :py:class:`PoolTimeoutError`.
+    :param dict profile: PRAGMAs applied once to every sqlite3 connection when
+        it is opened. If not specified :py:data:`DEFAULT_CONNECTION_PROFILE`
+        is used. See :py:func:`connection_profile`.
+    :param bool auto_migrate: If ``True`` the pending :py:data:`MIGRATIONS`
+        are applied the first time :py:meth:`connect` is called.
+    :param int cache_size: Maximum number of records kept by the read-through
+        cache of :py:meth:`Connection.get_user`,
+        :py:meth:`Connection.get_restaurant` and
+        :py:meth:`Connection.get_restaurant_details`. ``0`` disables the
+        cache. The
+        cache is shared by every Engine of the process using the same file.
+    :param float cache_ttl: Seconds a cached record stays valid.
+    :param int cache_max_bytes: Approximate memory limit of the cache.
+    :param str record_mode: ``dict`` (default) to get users and restaurant
+        lists as dictionaries, or ``record`` to get compact
+        :py:class:`Record` objects with the same keys.
+    :param instrumentation: if given, :py:meth:`connect` returns
+        connections whose methods and statements are measured by it.
+    :type instrumentation: instrumentation.Instrumentation
+    :param retry_policy: if given, the writes of the connections that fail
+        because the database is locked are retried with it. Together with
+        the ``busy_timeout`` of the profile it sets how concurrent writers
+        wait for each other.
+    :type retry_policy: RetryPolicy
+    :param int readers: if not ``0``, the Engine keeps this many read-only
+        connections besides the pool, which then holds the writer
+        connections, and :py:meth:`connect` returns a
+        :py:class:`ReplicaConnection`: the :py:data:`READ_METHODS` run on the
+        readers and the writes on the writers, each method borrowing its
+        connection only while it runs. With ``pool_size=1`` all the writes go
+        through one connection. Requires the WAL journal mode and cannot be
+        combined with an instrumentation.
 
     '''
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, pool_size=DEFAULT_POOL_SIZE,
+                 pool_timeout=DEFAULT_POOL_TIMEOUT, profile=None,
+                 auto_migrate=True, cache_size=0,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 cache_max_bytes=DEFAULT_CACHE_MAX_BYTES, record_mode='dict',
+                 instrumentation=None, retry_policy=None, readers=0):
         '''
         '''
 
         super(Engine, self).__init__()
+        if record_mode not in RECORD_MODES:
+            raise ValueError("Unknown record mode %s" % record_mode)
+        self.record_mode = record_mode
+        self.instrumentation = instrumentation
+        self.retry_policy = retry_policy
+        self.auto_migrate = auto_migrate
+        self._migrated = False
+        self._migrate_lock = threading.Lock()
         if db_path is not None:
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
+        if profile is not None:
+            self.profile = profile
+        else:
+            self.profile = DEFAULT_CONNECTION_PROFILE
+        if pool_size:
+            self.pool = ConnectionPool(self.db_path, pool_size, pool_timeout,
+                                       self.profile)
+        else:
+            self.pool = None
+        if readers:
+            if self.pool is None:
+                raise ValueError("An Engine with readers needs a pool")
+            if instrumentation is not None:
+                raise ValueError("Readers cannot be combined with an "
+                                 "instrumentation")
+            self.reader_pool = ConnectionPool(self.db_path, readers,
+                                              pool_timeout, self.profile,
+                                              read_only=True)
+        else:
+            self.reader_pool = None
+        if cache_size:
+            self.cache = shared_cache(self.db_path, cache_size, cache_ttl,
+                                      cache_max_bytes)
+        else:
+            self.cache = None
 
     def connect(self):
         '''
-        Creates a connection to the database.
+        Creates a connection to the database. When the Engine has a pool, the
+        underlying sqlite3 connection is borrowed from it and it is given back
+        when :py:meth:`Connection.close` is called.
 
         :return: A Connection instance
         :rtype: Connection
 
         '''
-        return Connection(self.db_path)
+        if self.auto_migrate and not self._migrated:
+            with self._migrate_lock:
+                if not self._migrated:
+                    self.migrate()
+                    self._migrated = True
+        if self.instrumentation is not None:
+            return self.instrumentation.connect(self)
+        if self.reader_pool is not None:
+            return ReplicaConnection(self.db_path, self.pool,
+                                     self.reader_pool, self.cache,
+                                     self.record_mode, self.retry_policy)
+        return Connection(self.db_path, self.pool, self.profile, self.cache,
+                          self.record_mode, self.retry_policy)
+
+    def schema_version(self):
+        '''
+        Returns the last migration applied to the database file.
+
+        :return: the version stored in ``PRAGMA user_version``
+        :rtype: int
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            return con.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            con.close()
+
+    def migrate(self, target=SCHEMA_VERSION):
+        '''
+        Applies the pending :py:data:`MIGRATIONS` up to ``target``. Every
+        migration runs in its own ``BEGIN IMMEDIATE`` transaction together
+        with the update of ``PRAGMA user_version``, so a failed migration
+        leaves the database in the previous version and two processes never
+        apply the same migration twice.
+
+        :param int target: last version to apply.
+        :return: the version of the database after the migration.
+        :rtype: int
+        :raises sqlite3.Error: if a migration fails, for instance when a
+            unique index cannot be created because of duplicated values.
+
+        '''
+        con = open_connection(self.db_path, self.profile)
+        #Transactions are controlled explicitly
+        con.isolation_level = None
+        try:
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            for number, description, steps in MIGRATIONS:
+                if number <= version or number > target:
+                    continue
+                con.execute('BEGIN IMMEDIATE')
+                try:
+                    #Another process may have migrated meanwhile
+                    version = con.execute('PRAGMA user_version').fetchone()[0]
+                    if number > version:
+                        for step in steps:
+                            if callable(step):
+                                step(con)
+                            else:
+                                con.execute(step)
+                        con.execute('PRAGMA user_version = %d' % number)
+                        version = number
+                    con.execute('COMMIT')
+                except Exception:
+                    con.execute('ROLLBACK')
+                    raise
+            return version
+        finally:
+            con.close()
+
+    def pool_metrics(self):
+        '''
+        Returns the metrics of the connection pool.
+
+        :return: dictionary with the format provided in the method:
+            :py:meth:`ConnectionPool.metrics` or None if the Engine has no
+            pool.
+
+        '''
+        if self.pool is None:
+            return None
+        return self.pool.metrics()
+
+    def reader_pool_metrics(self):
+        '''
+        Returns the metrics of the read-only connections.
+
+        :return: dictionary with the format provided in the method:
+            :py:meth:`ConnectionPool.metrics` or None if the Engine has no
+            readers.
+
+        '''
+        if self.reader_pool is None:
+            return None
+        return self.reader_pool.metrics()
+
+    def cache_stats(self):
+        '''
+        Returns the counters of the read-through cache.
+
+        :return: dictionary with the format provided in the method:
+            :py:meth:`RecordCache.stats` or None if the cache is disabled.
+
+        '''
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def dispose(self):
+        '''
+        Closes all the idle pooled connections.
+
+        '''
+        if self.pool is not None:
+            self.pool.dispose()
+        if self.reader_pool is not None:
+            self.reader_pool.dispose()
 
     def remove_database(self):
         '''
         Removes the database file from the filesystem.
 
         '''
-        if os.path.exists(self.db_path):
-            #THIS REMOVES THE DATABASE STRUCTURE
-            os.remove(self.db_path)
+        self.dispose()
+        if self.cache is not None:
+            self.cache.clear()
+        self._migrated = False
+        for path in (self.db_path, self.db_path + '-wal',
+                     self.db_path + '-shm'):
+            if os.path.exists(path):
+                #THIS REMOVES THE DATABASE STRUCTURE
+                os.remove(path)
 
     def clear(self):
         '''
@@ -71,20 +1893,168 @@ class Engine(object):
         it keeps the database schema (meaning the table structure)
 
         '''
-        keys_on = 'PRAGMA foreign_keys = ON'
         #THIS KEEPS THE SCHEMA AND REMOVE VALUES
-        con = sqlite3.connect(self.db_path)
-        #Activate foreing keys support
-        cur = con.cursor()
-        cur.execute(keys_on)
-        with con:
-            cur = con.cursor()
-            cur.execute("DELETE FROM messages")
-            cur.execute("DELETE FROM users")
-            #NOTE since we have ON DELETE CASCADE BOTH IN users_profile AND
-            #friends, WE DO NOT HAVE TO WORRY TO CLEAR THOSE TABLES.
+        con = open_connection(self.db_path, self.profile)
+        con.isolation_level = None
+        try:
+            existing = set(row[0] for row in con.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                for table in CLEAR_TABLES:
+                    if table in existing:
+                        con.execute('DELETE FROM %s' % table)
+                #The consumers of the change log have to start over
+                if 'changeLogState' in existing:
+                    last = con.execute(STATEMENTS['change_log_bounds']
+                                       ).fetchone()[1]
+                    con.execute(STATEMENTS['truncate_change_log'], (last,))
+                con.execute('COMMIT')
+            except Exception:
+                con.execute('ROLLBACK')
+                raise
+        finally:
+            con.close()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _load_dump(self, path, refresh):
+        '''
+        Loads a SQL dump in one transaction with :py:data:`BULK_LOAD_PROFILE`.
+
+        :param bool refresh: if ``True`` the data derived from the ledger by
+            the migrations already applied is recomputed in the same
+            transaction.
+        :raises sqlite3.IntegrityError: if the loaded rows break a foreign
+            key. Nothing is loaded in that case.
+
+        '''
+        script = _read_dump(path)
+        con = open_connection(self.db_path, BULK_LOAD_PROFILE)
+        con.isolation_level = None
+        try:
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            try:
+                #executescript() runs the statements one by one inside the
+                #transaction opened by its first statement
+                con.executescript('BEGIN IMMEDIATE;\n' + script)
+                if refresh:
+                    for number, _, steps in MIGRATIONS:
+                        if number > version:
+                            break
+                        for step in steps:
+                            if callable(step):
+                                step(con)
+                violations = con.execute('PRAGMA foreign_key_check').fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError(
+                        "%d rows of %s break a foreign key" %
+                        (len(violations), path))
+                con.execute('COMMIT')
+            except Exception:
+                con.execute('ROLLBACK')
+                raise
+        finally:
+            con.close()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def create_tables(self, schema=None):
+        '''
+        Creates the tables of the schema dump, if they do not exist, and
+        applies the :py:data:`MIGRATIONS`.
+
+        :param str schema: path of the schema dump. If not specified
+            :py:data:`DEFAULT_SCHEMA` is used.
+        :return: the version of the database after the migration.
+        :rtype: int
+
+        '''
+        self._load_dump(schema or DEFAULT_SCHEMA, False)
+        version = self.migrate()
+        self._migrated = True
+        return version
+
+    def populate(self, dump=None):
+        '''
+        Loads the rows of a data dump in a single transaction. The stock
+        aggregates, rollups and batches of the migrations already applied
+        are recomputed before the transaction is committed.
+
+        :param str dump: path of the data dump. If not specified
+            :py:data:`DEFAULT_DATA_DUMP` is used.
+        :raises sqlite3.IntegrityError: if a row already exists or breaks a
+            foreign key. Nothing is loaded in that case.
+
+        '''
+        self._load_dump(dump or DEFAULT_DATA_DUMP, True)
+
+    def reset(self, schema=None, dump=None):
+        '''
+        Rebuilds the database file from the schema and data dumps. Any
+        existing file is removed first, so no connection of the Engine may
+        be in use.
+
+        :return: the version of the database after the migration.
+        :rtype: int
+
+        '''
+        self._check_idle()
+        self.remove_database()
+        version = self.create_tables(schema)
+        self.populate(dump)
+        return version
+
+    def snapshot(self, path):
+        '''
+        Writes a consistent copy of the database to ``path`` with
+        ``VACUUM INTO``, while other connections keep reading and writing.
+        An existing file at ``path`` is replaced.
+
+        :param str path: location of the snapshot file.
+
+        '''
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        con = open_connection(self.db_path, self.profile)
+        try:
+            con.execute('VACUUM INTO ?', (tmp_path,))
+        finally:
+            con.close()
+        os.rename(tmp_path, path)
+
+    def restore(self, path):
+        '''
+        Replaces the database file with a snapshot written by
+        :py:meth:`snapshot`. The copy is renamed over the database file, so
+        a failed restore leaves the previous file in place. No connection of
+        the Engine may be in use.
+
+        :param str path: location of the snapshot file.
+        :raises RuntimeError: if a pooled connection is in use.
+
+        '''
+        self._check_idle()
+        tmp_path = self.db_path + '.restore'
+        shutil.copyfile(path, tmp_path)
+        self.dispose()
+        #The WAL of the previous file must not be applied to the snapshot
+        for stale in (self.db_path + '-wal', self.db_path + '-shm'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        os.rename(tmp_path, self.db_path)
+        if self.cache is not None:
+            self.cache.clear()
+        self._migrated = False
+
+    def _check_idle(self):
+        for pool in (self.pool, self.reader_pool):
+            if pool is not None and pool.metrics()['in_use']:
+                raise RuntimeError("The database file cannot be replaced "
+                                   "while %d connections are in use" %
+                                   pool.metrics()['in_use'])
 
-   
 
 class Connection(object):
     '''
@@ -102,20 +2072,164 @@ class Connection(object):
 
     :param db_path: Location of the database file.
     :type dbpath: str
+    :param pool: Pool to borrow the sqlite3 connection from. If None a new
+        sqlite3 connection is opened.
+    :type pool: ConnectionPool
+    :param dict profile: PRAGMAs applied when a new sqlite3 connection is
+        opened. Pooled connections are already configured by the pool.
+    :param cache: Read-through cache of :py:meth:`get_user` and
+        :py:meth:`get_restaurant`. The methods modifying users and
+        restaurants invalidate the affected records.
+    :type cache: RecordCache
+    :param str record_mode: ``dict`` or ``record``. In ``record`` mode
+        :py:meth:`get_user` returns :py:class:`UserRecord` objects and the
+        user and restaurant list methods return :py:class:`UserListRecord`
+        and :py:class:`RestaurantListRecord` objects instead of dictionaries.
+    :param retry_policy: retry of the single-transaction writes that fail
+        because the database is locked. If None they fail at once. The bulk
+        methods consume their records and are never retried.
+    :type retry_policy: RetryPolicy
+
+    The foreign keys support and the :py:class:`sqlite3.Row` row factory are
+    set once when the sqlite3 connection is opened, so the methods of this
+    class do not configure the connection before each query. The writes
+    start their transactions with ``BEGIN IMMEDIATE``, so a transaction never
+    fails when it takes the write lock halfway.
 
     '''
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool=None, profile=None, cache=None,
+                 record_mode='dict', retry_policy=None):
         super(Connection, self).__init__()
-        self.con = sqlite3.connect(db_path)
+        self._pool = pool
+        self.cache = cache
+        self.retry_policy = retry_policy
+        self._in_snapshot = False
+        #Cursors reused by the methods that consume their results at once
+        self._cur = None
+        self._raw_cur = None
+        #Functions transforming rows into the returned objects. Records are
+        #built from plain tuples, so their cursors have no row factory.
+        if record_mode == 'record':
+            self._raw_rows = True
+            self._user_row = UserRecord
+            self._user_list_row = UserListRecord
+            self._restaurant_list_row = RestaurantListRecord
+        else:
+            self._raw_rows = False
+            self._user_row = self._create_user_object
+            self._user_list_row = self._create_user_list_object
+            self._restaurant_list_row = self._create_restaurant_list_object
+        self.con = self._open(db_path, pool, profile)
+
+    def _open(self, db_path, pool, profile):
+        '''
+        Returns the sqlite3 connection used by the methods: borrowed from
+        the pool or opened with the profile.
+
+        '''
+        if pool is not None:
+            return pool.checkout()
+        return open_connection(db_path, profile)
 
     def close(self):
         '''
-        Closes the database connection, commiting all changes.
+        Closes the database connection, commiting all changes. A pooled
+        connection is given back to the pool instead of being closed.
 
         '''
         if self.con:
+            for cur in (self._cur, self._raw_cur):
+                if cur is not None:
+                    cur.close()
+            self._cur = self._raw_cur = None
             self.con.commit()
-            self.con.close()
+            if self._pool is not None:
+                self._pool.checkin(self.con)
+            else:
+                self.con.close()
+            self.con = None
+
+    def interrupt(self):
+        '''
+        Aborts the statement running on this connection. It is called from
+        another thread, for instance to cancel a long read. The interrupted
+        method raises :py:class:`sqlite3.OperationalError`. Nothing happens
+        if no statement is running.
+
+        '''
+        con = self.con
+        if con is not None:
+            con.interrupt()
+
+    @contextlib.contextmanager
+    def read_snapshot(self):
+        '''
+        Runs the reads of a ``with`` block on a single snapshot of the
+        database: they do not see the writes committed by other connections
+        meanwhile. Nested blocks share the outer snapshot.
+
+        :Example:
+
+        >>> with con.read_snapshot():
+        ...     users = con.get_users()
+        ...     restaurants = con.get_restaurants()
+
+        Only reads should run in the block: a write of this connection
+        commits the snapshot transaction and ends the snapshot.
+
+        '''
+        if self._in_snapshot:
+            yield self
+            return
+        con = self.con
+        #The snapshot is taken by the first read of the transaction
+        con.execute('BEGIN')
+        self._in_snapshot = True
+        try:
+            con.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            yield self
+        finally:
+            self._in_snapshot = False
+            con.rollback()
+
+    def _cursor(self, raw=False):
+        '''
+        Returns the cursor shared by the methods of this connection that read
+        all their results before returning. Generators and bulk methods,
+        which keep a result set open, create their own cursor instead.
+
+        :param bool raw: if ``True`` the cursor returns plain tuples instead
+            of :py:class:`sqlite3.Row` objects.
+        :rtype: sqlite3.Cursor
+
+        '''
+        if raw:
+            if self._raw_cur is None:
+                self._raw_cur = self.con.cursor()
+                self._raw_cur.row_factory = None
+            return self._raw_cur
+        if self._cur is None:
+            self._cur = self.con.cursor()
+        return self._cur
+
+    def _invalidate(self, namespace, key=None):
+        '''
+        Removes records modified by this connection from the read-through
+        cache. See :py:meth:`RecordCache.invalidate`.
+
+        '''
+        if self.cache is not None:
+            self.cache.invalidate(namespace, key)
+            #The restaurant details embed the restaurant and its staff
+            if namespace == 'restaurant':
+                self.cache.invalidate('restaurant_details')
+
+    def _on_retry(self, method):
+        '''
+        Called by the :py:class:`RetryPolicy` before a write is retried.
+
+        '''
+        pass
 
     #FOREIGN KEY STATUS
     def check_foreign_keys_status(self):
@@ -123,8 +2237,8 @@ class Connection(object):
         Check if the foreign keys has been activated.
 
         :return: ``True`` if  foreign_keys is activated and ``False`` otherwise.
-        :raises sqlite3.Error: when a sqlite3 error happen. In this case the
-            connection is closed.
+        :raises sqlite3.Error: when a sqlite3 error happen. The connection
+            stays open, so the caller can retry or close it.
 
         '''
         try:
@@ -138,8 +2252,7 @@ class Connection(object):
             print "Foreign Keys status: %s" % 'ON' if is_activated else 'OFF'
         except sqlite3.Error, excp:
             print "Error %s:" % excp.args[0]
-            self.close()
-            raise excp
+            raise
         return is_activated
 
     def set_foreign_keys_support(self):
@@ -312,16 +2425,20 @@ class Connection(object):
             :py:meth:`_create_user_object`
 
         '''
+        #Look first in the cache
+        if self.cache is not None:
+            user = self.cache.get('user', username)
+            if user is not None:
+                if self._raw_rows:
+                    return _from_dict(UserRecord, user)
+                return user
+            token = self.cache.token()
         #Create the SQL Statements
           #SQL Statement for retrieving the user given a username
-        query1 = 'SELECT * from user WHERE username = ?'
-          #SQL Statement for retrieving the user information
+        query1 = STATEMENTS['user_by_username']
                
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        #Cursor initialization
+        cur = self._cursor(self._raw_rows)
         #Execute SQL Statement to retrieve the id given a username
         pvalue = (username,)
         cur.execute(query1, pvalue)
@@ -332,8 +2449,11 @@ class Connection(object):
 
         # Execute the SQL Statement to retrieve the user invformation.
         # Create first the valuse
-        
-        return self._create_user_object(row)
+        user = self._user_row(row)
+        if self.cache is not None:
+            self.cache.put('user', username,
+                           user.to_dict() if self._raw_rows else user, token)
+        return user
 
 
     def get_restaurant(self, restaurant_name):
@@ -345,19 +2465,18 @@ class Connection(object):
             :py:meth:`_create_restaurant_object`
 
         '''
+        #Look first in the cache
+        if self.cache is not None:
+            restaurant = self.cache.get('restaurant', restaurant_name)
+            if restaurant is not None:
+                return restaurant
+            token = self.cache.token()
         #Create the SQL Statements
           #SQL Statement for retrieving the restuarant information
-        query = 'SELECT r.*, u.*, ru.position,u.phone as uphone, r.phone as rphone FROM restaurant r\
-		 JOIN restaurantUser ru ON r.restaurantId = ru.restaurantId \
-		 JOIN user u ON ru.userId = u.userId\
-		 WHERE restaurantName = ?'
+        query = STATEMENTS['restaurant_with_staff']
 
-               
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        #Cursor initialization
+        cur = self._cursor()
         #Execute SQL Statement to retrieve the id given a username
         pvalue = (restaurant_name,)
         cur.execute(query, pvalue)
@@ -368,8 +2487,84 @@ class Connection(object):
 
         # Execute the SQL Statement to retrieve the restaurant  invformation.
         # Create first the valuse
+        restaurant = self._create_restaurant_object(row)
+        if self.cache is not None:
+            self.cache.put('restaurant', restaurant_name, restaurant, token)
+        return restaurant
+
+    def get_restaurant_details(self, restaurantName, fields=None):
+        '''
+        Extracts a restaurant with all its staff, items and vendors. It runs
+        one query for the restaurant and one for each list, whatever the
+        number of staff members.
+
+        :param str restaurantName: The name of the restaurant to search for.
+        :param fields: the lists to include, among
+            :py:data:`RESTAURANT_DETAIL_FIELDS`. If None, all of them. The
+            lists that are not included are not queried.
+        :return: None if the restaurant does not exist, else a dictionary:
 
-        return self._create_restaurant_object(row)
+            .. code-block:: javascript
+
+                {'restaurant': {'restaurantId': 1,
+                                'restaurantName': 'Milano',
+                                'address': 'address', 'phone': 'phone'},
+                 'staff': [{'username': 'username',
+                            'firstname': 'firstname',
+                            'lastname': 'lastname', 'email': 'email',
+                            'phone': 'phone', 'dob': 'dob',
+                            'position': 'position'}],
+                 'items': [{'itemId': 1, 'itemName': 'itemName',
+                            'description': 'description'}],
+                 'vendors': [{'vendorId': 1, 'name': 'name',
+                              'address': 'address', 'email': 'email',
+                              'phone': 'phone'}]}
+
+            The staff is in the order it was assigned, and the items and
+            vendors in the order they were created. In ``record`` mode the
+            restaurant and the members of the lists are
+            :py:class:`Record` objects.
+        :raises ValueError: if ``fields`` has an unknown list.
+
+        '''
+        if fields is None:
+            fields = RESTAURANT_DETAIL_FIELDS
+        else:
+            unknown = set(fields) - set(RESTAURANT_DETAIL_FIELDS)
+            if unknown:
+                raise ValueError("Unknown restaurant fields %s" %
+                                 ', '.join(sorted(unknown)))
+            fields = tuple(field for field in RESTAURANT_DETAIL_FIELDS
+                           if field in fields)
+        #Look first in the cache
+        if self.cache is not None:
+            details = self.cache.get('restaurant_details',
+                                     (restaurantName, fields))
+            if details is not None:
+                if self._raw_rows:
+                    return _restaurant_details_copy(details, True)
+                return details
+            token = self.cache.token()
+        cur = self._cursor(True)
+        cur.execute(STATEMENTS['restaurant_by_name'], (restaurantName,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        if self._raw_rows:
+            build = lambda record, row: record(row)
+        else:
+            build = lambda record, row: dict(zip(record.fields, row))
+        details = {'restaurant': build(RestaurantRecord, row)}
+        for field in fields:
+            statement, record = _RESTAURANT_DETAILS[field]
+            cur.execute(STATEMENTS[statement], (row[0],))
+            details[field] = [build(record, child)
+                              for child in cur.fetchall()]
+        if self.cache is not None:
+            self.cache.put('restaurant_details', (restaurantName, fields),
+                           _restaurant_details_copy(details, False)
+                           if self._raw_rows else details, token)
+        return details
 
     #ACCESSING THE USER table
     def get_users(self):
@@ -381,31 +2576,91 @@ class Connection(object):
             :py:meth:`_create_user_list_object`
 
         '''
-        #Create the SQL Statements
-        #SQL Statement for retrieving the user given a username
+        #Create the SQL Statements
+        #SQL Statement for retrieving the user given a username
+
+        #Only the columns used by _create_user_list_object
+        query = STATEMENTS['users_list']
+
+        #Create the cursor
+        cur = self._cursor(self._raw_rows)
+        #Execute main SQL Statement
+        cur.execute(query)
+        #Process the results
+        rows = cur.fetchall()
+        if rows is None:
+            return None
+        #Process the response.
+        return map(self._user_list_row, rows)
+
+    def get_users_page(self, limit=DEFAULT_PAGE_SIZE, after=None):
+        '''
+        Extracts one page of users ordered by username. The page starts after
+        the username given as cursor, so every page is read through the
+        unique index on username no matter how deep it is.
+
+        :Example:
+
+        >>> users, after = con.get_users_page(100)
+        >>> while after is not None:
+        ...     users, after = con.get_users_page(100, after)
+
+        :param int limit: maximum number of users in the page.
+        :param str after: cursor returned with the previous page. If None the
+            first page is returned.
+        :return: a tuple ``(users, next_after)``, where ``users`` is a list of
+            dictionaries with the format provided in the method
+            :py:meth:`_create_user_list_object` and ``next_after`` is the
+            cursor of the next page or None if this is the last page.
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        #Create the SQL Statements. One extra row tells if there is a next page
+        if after is None:
+            query = STATEMENTS['users_page_first']
+            pvalue = (limit + 1,)
+        else:
+            query = STATEMENTS['users_page_after']
+            pvalue = (after, limit + 1)
+        #Create the cursor
+        cur = self._cursor(self._raw_rows)
+        cur.execute(query, pvalue)
+        rows = cur.fetchall()
+        users = map(self._user_list_row, rows[:limit])
+        if len(rows) > limit:
+            return users, users[-1]['username']
+        return users, None
+
+    def iter_users(self, batch_size=DEFAULT_PAGE_SIZE):
+        '''
+        Generator version of :py:meth:`get_users`. The users are read from
+        the database ``batch_size`` rows at a time with ``fetchmany``, so the
+        first user is available immediately and the memory used does not
+        depend on the size of the table.
 
-        query = 'SELECT * FROM user'
+        :param int batch_size: number of rows fetched at a time.
+        :return: generator of dictionaries with the format provided in the
+            method :py:meth:`_create_user_list_object`
 
-        #SQL Statement for retrieving the user information
-               
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
+        '''
+        query = STATEMENTS['users_list']
+        #The generator owns its cursor, so other methods can be called while
+        #it is consumed
         cur = self.con.cursor()
-        #Execute main SQL Statement
+        if self._raw_rows:
+            cur.row_factory = None
         cur.execute(query)
-        #Process the results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #Process the response.
-        users = []
-        for row in rows:
-            users.append(self._create_user_list_object(row))
-        return users
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._user_list_row(row)
 
 
+    @_retry_on_busy
     def append_user(self, username, user):
         '''
         Create a new user in the database.
@@ -428,13 +2683,16 @@ class Connection(object):
 	        * ``lastname``: family name of the user
 	        * ``dob``: date of birth of the user
 	        * ``email``: current email of the user          
-	        * ``password``: password of the user 
+	        * ``password``: password of the user. It should be a hash
+	          built by :py:class:`auth.PasswordHasher`, as
+	          :py:meth:`auth.Authenticator.register_user` does. A
+	          plaintext password is hashed at the first login.
 	        * ``phone``: cellphone number of the user.
 
             Note that all values are string if they are not otherwise indicated.
 
         :return: the username of the added user or None if the
-            ``username`` passed as parameter is not  in the database.
+            ``username`` passed as parameter is already in the database.
         :raise ValueError: if the user argument is not well formed.
 
 	dictionary template
@@ -444,13 +2702,11 @@ class Connection(object):
         '''
 	
         #Create the SQL Statements
-          #SQL Statement for extracting the userid given a username
-        query1 = 'SELECT userid from user WHERE username = ?'
-          #SQL Statement to create the row in  users table
-        query2 = 'INSERT INTO user(username, firstname, lastname, phone, email, password, dob)\
-                  VALUES(?,?,?,?,?,?,?)'
+          #SQL Statement to create the row in  users table. The unique index
+          #on username turns a duplicated username into a no-op, so no
+          #previous SELECT is needed and concurrent writers cannot race.
+        query = STATEMENTS['append_user']
 
-	
 	_username = username
 	_firstname = user['firstname']
 	_lastname = user['lastname']
@@ -459,29 +2715,79 @@ class Connection(object):
 	_password = user['password']
 	_dob = user['dob']
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a username
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that username expected)
+        #Cursor initialization
+        cur = self._cursor()
+        #Add the row in users table: one statement and one commit
+        pvalue = (_username, _firstname, _lastname, _phone, _email, _password, _dob)
+        cur.execute(query, pvalue)
+        self.con.commit()
+        #No row inserted means that the username already exists
+        if cur.rowcount < 1:
+            return None
+        return _username
+
+    def get_password_hash(self, username):
+        '''
+        Returns the stored password of a user: a hash built by
+        :py:class:`auth.PasswordHasher` or, for the users created with a
+        plaintext password, the plaintext. The user is found through the
+        unique index on ``username``.
+
+        :param str username: the username of the user.
+        :return: the stored password or None if the user does not exist or
+            has no password.
+
+        '''
+        cur = self._cursor(True)
+        cur.execute(STATEMENTS['user_password'], (username,))
         row = cur.fetchone()
-        #If there is no user add rows in user and user profile
         if row is None:
-            #Add the row in users table
-            # Execute the statement
-            pvalue = (_username, _firstname, _lastname, _phone, _email, _password, _dob)
-            cur.execute(query2, pvalue)
+            return None
+        return row[0]
 
-            self.con.commit()
-            #We do not do any comprobation and return the username
-            return _username
+    def get_password_hashes(self, limit=DEFAULT_PAGE_SIZE, after=None):
+        '''
+        Returns a page of the stored passwords of the users, sorted by
+        username. Used to hash the plaintext passwords of old users, see
+        :py:meth:`auth.Authenticator.upgrade_passwords`.
+
+        :param int limit: maximum number of users in the page.
+        :param str after: if not None, the page starts after this username.
+        :return: a list of tuples ``(username, password)``.
+
+        '''
+        cur = self._cursor(True)
+        if after is None:
+            cur.execute(STATEMENTS['user_passwords_first'], (limit,))
         else:
-            return None
+            cur.execute(STATEMENTS['user_passwords_after'], (after, limit))
+        return cur.fetchall()
+
+    @_retry_on_busy
+    def set_password_hash(self, username, password_hash, previous=None):
+        '''
+        Replaces the stored password of a user.
+
+        :param str username: the username of the user.
+        :param str password_hash: the new stored password, usually built by
+            :py:meth:`auth.PasswordHasher.hash`.
+        :param str previous: if not None, the password is only replaced if
+            the stored one is still ``previous``. A rehash does not overwrite
+            a password changed meanwhile by another connection.
+        :return: True if the password was replaced, False if the user does
+            not exist or its password is no longer ``previous``.
+
+        '''
+        cur = self._cursor()
+        if previous is None:
+            cur.execute(STATEMENTS['set_password'], (password_hash, username))
+        else:
+            cur.execute(STATEMENTS['replace_password'],
+                        (password_hash, username, previous))
+        self.con.commit()
+        return cur.rowcount > 0
 
+    @_retry_on_busy
     def append_restaurant(self, restaurant):
         '''
         Create a new restaurant in the database.
@@ -509,8 +2815,7 @@ class Connection(object):
         '''
 	
           #SQL Statement to create the row in  restaurant table
-        query = 'INSERT INTO restaurant(restaurantName, address, phone)\
-                  VALUES(?,?,?)'
+        query = STATEMENTS['insert_restaurant']
 
 	
 
@@ -518,11 +2823,8 @@ class Connection(object):
 	_address = restaurant['address']
 	_phone = restaurant['phone']
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        #Cursor initialization
+        cur = self._cursor()
        
   
         pvalue = (_restaurantName, _address, _phone)
@@ -533,6 +2835,7 @@ class Connection(object):
         return _restaurantName
 
 
+    @_retry_on_busy
     def assign_user_to_restaurant(self, username, restaurantName, position):
         '''
         Create a new user in the database.
@@ -555,18 +2858,14 @@ class Connection(object):
 	
         #Create the SQL Statements
           #SQL Statement for extracting the userid given a username
-        query1 = 'SELECT userid from user WHERE username = ?'
+        query1 = STATEMENTS['user_id_by_username']
           #SQL Statement for extracting the restaurantid given a restaurantName
-        query2 = 'SELECT restaurantId from restaurant WHERE restaurantName = ?'
+        query2 = STATEMENTS['restaurant_id_by_name']
           #SQL Statement to create the row in  restaurantUser table
-        query3 = 'INSERT INTO restaurantUser(userId, restaurantId, position)\
-                  VALUES(?,?,?)'
+        query3 = STATEMENTS['insert_restaurant_user']
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        #Cursor initialization
+        cur = self._cursor()
         #Execute the statement to extract the id associated to a username
         pvalue = (username,)
         cur.execute(query1, pvalue)
@@ -580,10 +2879,11 @@ class Connection(object):
 	rowr = cur.fetchone()
 	
 	#check if the restaurant and user is exist in the database
-	if row['userid'] !='' and rowr['restaurantId'] != '':
-	    pvalue = (row['userid'], rowr['restaurantId'], position, )
+	if row['userId'] !='' and rowr['restaurantId'] != '':
+	    pvalue = (row['userId'], rowr['restaurantId'], position, )
 	    cur.execute(query3, pvalue)
 	    self.con.commit()	
+	    self._invalidate('restaurant', restaurantName)
 	    return True
         else:
             return False
@@ -599,28 +2899,77 @@ class Connection(object):
         '''
         #Create the SQL Statements
           #SQL Statement for retrieving the user given a username
-        query = 'SELECT * FROM restaurant'
-          #SQL Statement for retrieving the user information
-               
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+          #Only the columns used by _create_restaurant_list_object
+        query = STATEMENTS['restaurants_list']
+
+        #Cursor initialization
+        cur = self._cursor(self._raw_rows)
         #Execute SQL Statement to retrieve the id given a username
         
         cur.execute(query)
        
         rows = cur.fetchall()
-	restaurants = []
-        for row in rows:
-            # Execute the SQL Statement to retrieve the user invformation.
-            # Create first the valuse
-            restaurants.append(self._create_restaurant_list_object(row))
-	return restaurants;
+        #Create the restaurant objects
+	return map(self._restaurant_list_row, rows)
 
+    def get_restaurants_page(self, limit=DEFAULT_PAGE_SIZE, after=None):
+        '''
+        Extracts one page of restaurants ordered by name. Works like
+        :py:meth:`get_users_page` using the restaurant name as cursor.
+
+        :param int limit: maximum number of restaurants in the page.
+        :param str after: cursor returned with the previous page. If None the
+            first page is returned.
+        :return: a tuple ``(restaurants, next_after)``, where ``restaurants``
+            is a list of dictionaries with the format provided in the method
+            :py:meth:`_create_restaurant_list_object` and ``next_after`` is
+            the cursor of the next page or None if this is the last page.
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        #Create the SQL Statements. One extra row tells if there is a next page
+        if after is None:
+            query = STATEMENTS['restaurants_page_first']
+            pvalue = (limit + 1,)
+        else:
+            query = STATEMENTS['restaurants_page_after']
+            pvalue = (after, limit + 1)
+        #Cursor initialization
+        cur = self._cursor(self._raw_rows)
+        cur.execute(query, pvalue)
+        rows = cur.fetchall()
+        restaurants = map(self._restaurant_list_row, rows[:limit])
+        if len(rows) > limit:
+            return restaurants, restaurants[-1]['restaurantName']
+        return restaurants, None
+
+    def iter_restaurants(self, batch_size=DEFAULT_PAGE_SIZE):
+        '''
+        Generator version of :py:meth:`get_restaurants` reading the rows
+        ``batch_size`` at a time with ``fetchmany``.
 
+        :param int batch_size: number of rows fetched at a time.
+        :return: generator of dictionaries with the format provided in the
+            method :py:meth:`_create_restaurant_list_object`
 
+        '''
+        query = STATEMENTS['restaurants_list']
+        cur = self.con.cursor()
+        if self._raw_rows:
+            cur.row_factory = None
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._restaurant_list_row(row)
+
+
+
+    @_retry_on_busy
     def modify_user(self, username, user):
         '''
         Extracts all the information of a user.
@@ -633,26 +2982,11 @@ class Connection(object):
 	modify_user('ali', {'firstname': 'ali' ,'lastname': 'hassani', 'phone': '0475556633', 'email': 'ali.hassani@yahoo.com','dob': '22-02-2002'})
         '''
         #Create the SQL Statements
-          #SQL Statement for retrieving the username given a username
-        query1 = 'SELECT username from user WHERE username = ?'
-          #SQL Statement for retrieving the user information
-               
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute SQL Statement to retrieve the username given a username
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-       
-        row = cur.fetchone()
-        if row is None:
-            return None
+          #SQL Statement for updating the user given a username. The WHERE
+          #clause uses the unique index on username, so the statement both
+          #checks that the user exists and modifies it.
+        query = STATEMENTS['modify_user']
 
-        query2 = 'UPDATE user SET firstname = ?, lastname = ?, phone = ?, email = ?, dob =? WHERE username = ?'
-
-	
 	_username = username
 	_firstname = user['firstname']
 	_lastname = user['lastname']
@@ -660,31 +2994,21 @@ class Connection(object):
 	_email = user['email']
 	_dob = user['dob']
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a username
-        pvalue = (username,)
-        cur.execute(query1, pvalue)
-        #No value expected (no other user with that username expected)
-        row = cur.fetchone()
-        #If there is no user add rows in user and user profile
-        if row is not None:
-            #Add the row in users table
-            # Execute the statement
-            pvalue = (_firstname, _lastname, _phone, _email, _dob, _username)
-            cur.execute(query2, pvalue)
-
-            self.con.commit()
-            #We do not do any comprobation and return the username
-	    if cur.rowcount < 1:
-		return None
-            return _username
-        else:
+        #Cursor initialization
+        cur = self._cursor()
+        #Execute the statement: one statement and one commit
+        pvalue = (_firstname, _lastname, _phone, _email, _dob, _username)
+        cur.execute(query, pvalue)
+        self.con.commit()
+        #No row updated means that the user does not exist
+        if cur.rowcount < 1:
             return None
+        #The restaurants embed the data of their staff
+        self._invalidate('user', _username)
+        self._invalidate('restaurant')
+        return _username
 
+    @_retry_on_busy
     def modify_restaurant(self,restaurantName, restaurant):
         '''
         Extracts all the information of a restaurant.
@@ -696,21 +3020,16 @@ class Connection(object):
         '''
         #Create the SQL Statements
           #SQL Statement for retrieving the restuartantName as given restaurntname
-	query1 = 'SELECT restaurantName FROM restaurant WHERE restaurantName = ?'
+	query1 = STATEMENTS['restaurant_name_by_name']
           #SQL Statement for updating the restuarant information
-        query2 = 'UPDATE restaurant SET restaurantName = ?, address = ?, phone = ? \
-		 WHERE restaurantName = ?'
-          #SQL Statement for retrieving the user information
+        query2 = STATEMENTS['modify_restaurant']
              
 	_restaurantName = restaurant['restaurantName']
 	_address = restaurant['address']
 	_phone = restaurant['phone']
 
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        #Cursor initialization
+        cur = self._cursor()
         #Execute SQL Statement to retrieve the id given a username
         pvalue = (restaurantName,)
         cur.execute(query1, pvalue)
@@ -727,8 +3046,11 @@ class Connection(object):
 	    self.con.commit()
 	    if cur.rowcount < 1:
 		return None
+	    self._invalidate('restaurant', restaurantName)
+	    self._invalidate('restaurant', _restaurantName)
 	    return True
  
+    @_retry_on_busy
     def delete_user(self, username):
     	'''
     	Delete all the information of a given user
@@ -739,14 +3061,11 @@ class Connection(object):
     	'''
     	
     	#SQL Statement for deleting user from database
-    	query = 'DELETE FROM user WHERE username = ?'
+    	query = STATEMENTS['delete_user']
     	
-    	#Active foreign key support
-    	self.set_foreign_keys_support()
     	
-    	#Cursor and row initialization
-    	self.con.row_factory = sqlite3.Row
-    	cur = self.con.cursor()
+    	#Cursor initialization
+    	cur = self._cursor()
     	
     	#Supply value for the sql statement and execute sql statement 
     	pvalue = (username, )
@@ -754,16 +3073,963 @@ class Connection(object):
     	self.con.commit()
     	if cur.rowcount < 1:
     	    return False
+    	#The restaurants embed the data of their staff
+    	self._invalidate('user', username)
+    	self._invalidate('restaurant')
     	return True
 
+    #SEARCH
+    def _search(self, statement, query, parameters, limit, offset, build):
+        '''
+        Runs one of the ``search_*`` statements and returns one page of its
+        ranked results.
+
+        :return: a tuple ``(results, next_offset)``
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        expression = search_expression(query)
+        if expression is None:
+            return [], None
+        cur = self._cursor(self._raw_rows and build is not None)
+        cur.execute(STATEMENTS[statement],
+                    (expression,) + parameters + (limit + 1, offset))
+        rows = cur.fetchall()
+        if build is None:
+            results = [dict(zip(row.keys(), row)) for row in rows[:limit]]
+        else:
+            results = map(build, rows[:limit])
+        if len(rows) > limit:
+            return results, offset + limit
+        return results, None
+
+    def search_users(self, query, limit=DEFAULT_PAGE_SIZE, offset=0):
+        '''
+        Searches the users whose username, names or email contain words
+        starting with every word of ``query`` (see
+        :py:func:`search_expression`). The best matches come first; a match
+        in the username weighs more than in the names, and these more than
+        in the email.
+
+        :Example:
+
+        >>> users, offset = con.search_users('ali has')
+        >>> while offset is not None:
+        ...     users, offset = con.search_users('ali has', 20, offset)
+
+        :param str query: free text.
+        :param int limit: maximum number of users in the page.
+        :param int offset: number of results skipped, that is, the
+            ``next_offset`` returned with the previous page. Every page ranks
+            all the matches, so deep pages are not cheaper than the first.
+        :return: a tuple ``(users, next_offset)``, where ``users`` is a list
+            of dictionaries with the format provided in the method
+            :py:meth:`_create_user_list_object` and ``next_offset`` is None
+            if this is the last page.
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        return self._search('search_users', query, (), limit, offset,
+                            self._user_list_row)
+
+    def search_restaurants(self, query, limit=DEFAULT_PAGE_SIZE, offset=0):
+        '''
+        Searches the restaurants whose name or address contain words starting
+        with every word of ``query``. Matches in the name come first. The
+        pagination works as in :py:meth:`search_users`.
+
+        :return: a tuple ``(restaurants, next_offset)``, where ``restaurants``
+            is a list of dictionaries with the format provided in the method
+            :py:meth:`_create_restaurant_list_object`.
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        return self._search('search_restaurants', query, (), limit, offset,
+                            self._restaurant_list_row)
+
+    def search_items(self, query, restaurantName=None,
+                     limit=DEFAULT_PAGE_SIZE, offset=0):
+        '''
+        Searches the items whose name or description contain words starting
+        with every word of ``query``. Matches in the name come first. The
+        pagination works as in :py:meth:`search_users`.
+
+        :param str restaurantName: if given, only the items of this
+            restaurant are searched.
+        :return: a tuple ``(items, next_offset)``, where ``items`` is a list
+            of dictionaries with the keys ``itemId``, ``itemName``,
+            ``description``, ``restaurantId`` and ``rank`` (smaller is a
+            better match). No item is found for an unknown restaurant.
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        if restaurantName is None:
+            return self._search('search_items', query, (), limit, offset,
+                                None)
+        restaurant_id = self._lookup_id('restaurant_id_by_name',
+                                        restaurantName)
+        if restaurant_id is None:
+            return [], None
+        return self._search('search_items_of_restaurant', query,
+                            (restaurant_id,), limit, offset, None)
+
+    #BULK IMPORT
+    def _bulk_append(self, query, records, build, chunk_size):
+        '''
+        Inserts many rows with ``executemany`` inside one transaction.
+
+        The records are consumed in chunks of ``chunk_size``, so generators of
+        any length can be imported with bounded memory. A record that cannot
+        be built or that violates a constraint is reported and skipped, and
+        the import continues with the next record. Any other error rolls back
+        the whole import.
+
+        :param str query: the INSERT statement.
+        :param records: iterable of dictionaries.
+        :param build: function receiving a record and returning a tuple
+            ``(key, parameters)``. It raises ``KeyError`` or ``ValueError``
+            if the record is not well formed.
+        :param int chunk_size: number of rows passed to each ``executemany``.
+        :return: a dictionary with the keys ``inserted`` (number of rows
+            added) and ``errors``, a list of dictionaries with the keys
+            ``index`` (position of the record in ``records``), ``key`` and
+            ``error``.
+        :raises ValueError: if ``chunk_size`` is smaller than 1.
+
+        '''
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1")
+        inserted = 0
+        errors = []
+        records = iter(records)
+        index = 0
+        #executemany pulls the parameters lazily: when a row fails, the last
+        #row pulled is the offending one. Rows pulled before it are already
+        #inserted, so the chunk is resumed after it.
+        position = [0]
+
+        def params(chunk, start):
+            for i in xrange(start, len(chunk)):
+                position[0] = i
+                yield chunk[i][2]
+        cur = self.con.cursor()
+        try:
+            while True:
+                batch = list(itertools.islice(records, chunk_size))
+                if not batch:
+                    break
+                #Build the parameters of the chunk
+                chunk = []
+                for record in batch:
+                    try:
+                        key, pvalue = build(record)
+                    except KeyError, excp:
+                        errors.append({'index': index, 'key': None,
+                                       'error': 'missing field %s' %
+                                       excp.args[0]})
+                    except (ValueError, TypeError), excp:
+                        errors.append({'index': index, 'key': None,
+                                       'error': str(excp)})
+                    else:
+                        chunk.append((index, key, pvalue))
+                    index += 1
+                start = 0
+                while start < len(chunk):
+                    try:
+                        cur.executemany(query, params(chunk, start))
+                        inserted += len(chunk) - start
+                        start = len(chunk)
+                    except sqlite3.IntegrityError, excp:
+                        failed = position[0]
+                        inserted += failed - start
+                        errors.append({'index': chunk[failed][0],
+                                       'key': chunk[failed][1],
+                                       'error': str(excp)})
+                        start = failed + 1
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        return {'inserted': inserted, 'errors': errors}
+
+    def append_users_bulk(self, users, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Create many users in the database in one transaction.
+
+        :param users: iterable (for instance a generator) of dictionaries
+            with the format used by :py:meth:`append_user`, including the
+            ``username`` key.
+        :param int chunk_size: number of users inserted per ``executemany``.
+        :return: dictionary with the format provided in the method
+            :py:meth:`_bulk_append`. Duplicated usernames are reported as
+            errors.
+
+        '''
+        query = STATEMENTS['insert_user']
+
+        def build(user):
+            return user['username'], (user['username'], user['firstname'],
+                                      user['lastname'], user['phone'],
+                                      user['email'], user['password'],
+                                      user['dob'])
+        return self._bulk_append(query, users, build, chunk_size)
+
+    def append_restaurants_bulk(self, restaurants,
+                                chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Create many restaurants in the database in one transaction.
+
+        :param restaurants: iterable of dictionaries with the format used by
+            :py:meth:`append_restaurant`.
+        :param int chunk_size: number of restaurants inserted per
+            ``executemany``.
+        :return: dictionary with the format provided in the method
+            :py:meth:`_bulk_append`. Duplicated restaurant names are
+            reported as errors.
+
+        '''
+        query = STATEMENTS['insert_restaurant']
+
+        def build(restaurant):
+            return restaurant['restaurantName'], (
+                restaurant['restaurantName'], restaurant['address'],
+                restaurant['phone'])
+        return self._bulk_append(query, restaurants, build, chunk_size)
+
+    def _restaurant_id_resolver(self):
+        '''
+        Returns a function mapping restaurant names to restaurant ids. Every
+        name is looked up only once.
+
+        '''
+        ids = {}
+        cur = self.con.cursor()
+
+        def resolve(restaurant_name):
+            if restaurant_name not in ids:
+                cur.execute(STATEMENTS['restaurant_id_by_name'],
+                            (restaurant_name,))
+                row = cur.fetchone()
+                ids[restaurant_name] = row[0] if row is not None else None
+            restaurant_id = ids[restaurant_name]
+            if restaurant_id is None:
+                raise ValueError("unknown restaurant %s" % restaurant_name)
+            return restaurant_id
+        return resolve
+
+    def append_items_bulk(self, items, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Create many items in the database in one transaction.
+
+        :param items: iterable of dictionaries with the following format:
+
+                .. code-block:: javascript
+
+                    {'itemName': 'coca cola', 'description': 'soft drink',
+                     'restaurantName': 'Milano'}
+
+        :param int chunk_size: number of items inserted per ``executemany``.
+        :return: dictionary with the format provided in the method
+            :py:meth:`_bulk_append`. Items of unknown restaurants are
+            reported as errors.
+
+        '''
+        query = STATEMENTS['insert_item']
+        resolve = self._restaurant_id_resolver()
+
+        def build(item):
+            return item['itemName'], (item['itemName'], item['description'],
+                                      resolve(item['restaurantName']))
+        report = self._bulk_append(query, items, build, chunk_size)
+        if report['inserted']:
+            self._invalidate('restaurant_details')
+        return report
+
+    def append_vendors_bulk(self, vendors, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Create many vendors in the database in one transaction.
+
+        :param vendors: iterable of dictionaries with the following format:
+
+                .. code-block:: javascript
+
+                    {'name': 'Prisma', 'address': 'Linnanmaa, Oulu, Finland',
+                     'email': 'prisma@prisma.fi', 'phone': '04332255',
+                     'restaurantName': 'Milano'}
+
+        :param int chunk_size: number of vendors inserted per
+            ``executemany``.
+        :return: dictionary with the format provided in the method
+            :py:meth:`_bulk_append`. Vendors of unknown restaurants are
+            reported as errors.
+
+        '''
+        query = STATEMENTS['insert_vendor']
+        resolve = self._restaurant_id_resolver()
+
+        def build(vendor):
+            return vendor['name'], (vendor['name'], vendor['address'],
+                                    vendor['email'], vendor['phone'],
+                                    resolve(vendor['restaurantName']))
+        report = self._bulk_append(query, vendors, build, chunk_size)
+        if report['inserted']:
+            self._invalidate('restaurant_details')
+        return report
+
+    #STOCK
+    def _lookup_id(self, statement, value):
+        '''
+        Returns the id selected by one of the ``*_id_by_*`` statements or
+        None if there is no such row.
+
+        '''
+        cur = self._cursor()
+        cur.execute(STATEMENTS[statement], (value,))
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    def _create_stock_level_object(self, row):
+        '''
+        It takes a database Row and transform it into a python dictionary.
+
+        :param row: The row obtained from the database.
+        :type row: sqlite3.Row
+        :return: a dictionary with the following format:
+
+                .. code-block:: javascript
+
+                    {'itemId': 4, 'onHand': 12, 'purchased': 15,
+                     'consumed': 3, 'wasted': 0, 'transactions': 3,
+                     'averageCost': 2.99, 'value': 35.88}
+
+            where:
+
+            * ``onHand``: quantity currently in stock
+            * ``purchased``, ``consumed``, ``wasted``: total quantities of
+              each kind of transaction
+            * ``averageCost``: average purchase price of the item
+            * ``value``: valuation of the stock at the average purchase price
+
+        '''
+        purchased = row['purchasedQuantity']
+        average = row['purchasedValue'] / purchased if purchased else 0.0
+        return {'itemId': row['itemId'], 'onHand': row['onHand'],
+                'purchased': purchased, 'consumed': row['consumedQuantity'],
+                'wasted': row['wastedQuantity'],
+                'transactions': row['transactions'],
+                'averageCost': average, 'value': row['onHand'] * average}
+
+    @_retry_on_busy
+    def record_stock_transaction(self, restaurantName, itemId,
+                                 transactionType, quantity, price=None,
+                                 vendorId=None, username=None, date=None,
+                                 expireDate=None):
+        '''
+        Appends a transaction to the stock ledger. The on-hand aggregate of
+        the item is updated by a trigger in the same transaction, so reading
+        the current stock never scans the ledger.
+
+        Every purchase is a batch. Consumptions and waste are taken from the
+        batches of the item first expired first out (see
+        :py:meth:`get_expiring_batches`), including batches that already
+        expired, which should be booked as waste.
+
+        :param str restaurantName: restaurant owning the stock.
+        :param int itemId: id of the item.
+        :param str transactionType: one of :py:data:`STOCK_PURCHASE`,
+            :py:data:`STOCK_CONSUMPTION` or :py:data:`STOCK_WASTE`.
+        :param int quantity: positive quantity of the transaction.
+        :param float price: unit price. Purchases are valued with it.
+        :param int vendorId: vendor of a purchase.
+        :param str username: user registering the transaction.
+        :param str date: date of the transaction. Today by default.
+        :param str expireDate: expiry date of a purchase.
+        :return: the id of the new ledger row.
+        :raises ValueError: if the type or the quantity are not valid, if
+            the restaurant or the user do not exist or if the item does not
+            belong to the restaurant.
+        :raises sqlite3.IntegrityError: if the vendor does not exist.
+
+        '''
+        if transactionType not in STOCK_TRANSACTION_TYPES:
+            raise ValueError("Unknown stock transaction type %s" %
+                             transactionType)
+        if quantity <= 0:
+            raise ValueError("The quantity must be positive")
+        restaurant_id = self._lookup_id('restaurant_id_by_name',
+                                        restaurantName)
+        if restaurant_id is None:
+            raise ValueError("unknown restaurant %s" % restaurantName)
+        #item.restaurantId is declared as TEXT
+        owner = self._lookup_id('restaurant_id_by_item', itemId)
+        if owner is None or int(owner) != restaurant_id:
+            raise ValueError("item %s is not an item of %s" %
+                             (itemId, restaurantName))
+        user_id = None
+        if username is not None:
+            user_id = self._lookup_id('user_id_by_username', username)
+            if user_id is None:
+                raise ValueError("unknown user %s" % username)
+        if date is None:
+            date = time.strftime(STOCK_DATE_FORMAT)
+        purchase = transactionType == STOCK_PURCHASE
+        change = quantity if purchase else -quantity
+        cur = self._cursor()
+        pvalue = (price, quantity, restaurant_id, itemId, change, expireDate,
+                  date, transactionType, vendorId, itemId, restaurant_id,
+                  user_id, quantity if purchase else None)
+        try:
+            cur.execute(STATEMENTS['insert_stock'], pvalue)
+            stock_id = cur.lastrowid
+            if not purchase:
+                _allocate_batches(self.con, restaurant_id, itemId, quantity)
+        except Exception:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        return stock_id
+
+    def get_stock_level(self, restaurantName, itemId):
+        '''
+        Extracts the current stock of an item. The cost does not depend on
+        the length of the ledger.
+
+        :return: dictionary with the format provided in the method
+            :py:meth:`_create_stock_level_object` or None if the item has no
+            stock transactions in the restaurant.
+
+        '''
+        restaurant_id = self._lookup_id('restaurant_id_by_name',
+                                        restaurantName)
+        if restaurant_id is None:
+            return None
+        cur = self._cursor()
+        cur.execute(STATEMENTS['stock_level'], (restaurant_id, itemId))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return self._create_stock_level_object(row)
+
+    def get_stock_levels(self, restaurantName):
+        '''
+        Extracts the current stock of every item of a restaurant ordered by
+        itemId.
+
+        :return: list of dictionaries with the format provided in the method
+            :py:meth:`_create_stock_level_object`. The list is empty if the
+            restaurant does not exist.
+
+        '''
+        restaurant_id = self._lookup_id('restaurant_id_by_name',
+                                        restaurantName)
+        if restaurant_id is None:
+            return []
+        cur = self._cursor()
+        cur.execute(STATEMENTS['stock_levels'], (restaurant_id,))
+        return map(self._create_stock_level_object, cur.fetchall())
+
+    def get_stock_transactions(self, restaurantName, itemId,
+                               limit=DEFAULT_PAGE_SIZE, after=None):
+        '''
+        Extracts one page of the ledger of an item in the order the
+        transactions were recorded.
+
+        :param int limit: maximum number of transactions in the page.
+        :param int after: cursor returned with the previous page. If None the
+            first page is returned.
+        :return: a tuple ``(transactions, next_after)``, where
+            ``transactions`` is a list of dictionaries with the columns of the
+            stock table and ``next_after`` is the cursor of the next page or
+            None if this is the last page.
+        :raises ValueError: if ``limit`` is smaller than 1.
+
+        '''
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        restaurant_id = self._lookup_id('restaurant_id_by_name',
+                                        restaurantName)
+        if restaurant_id is None:
+            return [], None
+        cur = self._cursor()
+        cur.execute(STATEMENTS['stock_transactions'],
+                    (restaurant_id, itemId, after or 0, limit + 1))
+        rows = cur.fetchall()
+        transactions = [dict(zip(row.keys(), row)) for row in rows[:limit]]
+        if len(rows) > limit:
+            return transactions, transactions[-1]['id']
+        return transactions, None
+
+    def rebuild_stock_levels(self):
+        '''
+        Recomputes all the on-hand aggregates from the stock ledger in one
+        transaction.
+
+        :return: the number of (restaurant, item) aggregates written.
+
+        '''
+        try:
+            count = _fill_stock_levels(self.con)
+        except Exception:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        return count
+
+    def verify_stock_levels(self, tolerance=1e-6):
+        '''
+        Compares the on-hand aggregates with the totals recomputed from the
+        stock ledger.
+
+        :param float tolerance: largest accepted difference of the purchased
+            value, which is a sum of floats.
+        :return: list of dictionaries ``{'restaurantId', 'itemId',
+            'expected', 'actual'}`` for every aggregate that differs, where
+            ``expected`` and ``actual`` are tuples ``(onHand,
+            purchasedQuantity, purchasedValue, consumedQuantity,
+            wastedQuantity, transactions)`` or None if the row is missing.
+            The list is empty if the aggregates are consistent.
+
+        '''
+        cur = self.con.cursor()
+        cur.row_factory = None
+        expected = {}
+        for row in cur.execute(_stock_aggregate_query(_STOCK_LEVEL_KEYS)):
+            expected[row[:2]] = (int(row[2]), int(row[3]), row[4],
+                                 int(row[5]), int(row[6]), int(row[7]))
+        mismatches = []
+
+        def differs(a, b):
+            return (a[:2] + a[3:] != b[:2] + b[3:] or
+                    abs(a[2] - b[2]) > tolerance * max(1.0, abs(a[2])))
+        for row in cur.execute(STATEMENTS['stock_levels_all']):
+            key, actual = row[:2], tuple(row[2:])
+            wanted = expected.pop(key, None)
+            if wanted is None or differs(wanted, actual):
+                mismatches.append({'restaurantId': key[0], 'itemId': key[1],
+                                   'expected': wanted, 'actual': actual})
+        for key, wanted in sorted(expected.items()):
+            mismatches.append({'restaurantId': key[0], 'itemId': key[1],
+                               'expected': wanted, 'actual': None})
+        return mismatches
+
+    def rebuild_stock_batches(self):
+        '''
+        Recomputes the remaining quantity of every batch from the on-hand
+        aggregates in one transaction. The expired flags are cleared.
+
+        :return: the number of items whose consumption was allocated.
+
+        '''
+        try:
+            count = _fill_stock_batches(self.con)
+        except Exception:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        return count
+
+    def get_expiring_batches(self, restaurantName, limit=10, before=None):
+        '''
+        Extracts the batches of a restaurant that expire first, for first
+        expired first out picking. Only batches with remaining quantity that
+        have not been flagged by :py:meth:`sweep_expired_batches` are
+        returned. The query reads ``limit`` entries of a partial index, so
+        its cost does not depend on the size of the ledger.
+
+        :param int limit: maximum number of batches.
+        :param str before: if given, only batches expiring on this date or
+            earlier are returned.
+        :return: list of dictionaries ordered by expiry date:
+
+                .. code-block:: javascript
+
+                    {'id': 5, 'itemId': 4, 'remaining': 12,
+                     'expireDate': '2019-10-21', 'price': 2.99,
+                     'vendorId': 2}
+
+            The list is empty if the restaurant does not exist.
+        :raises ValueError: if ``before`` is not a valid date.
+
+        '''
+        restaurant_id = self._lookup_id('restaurant_id_by_name',
+                                        restaurantName)
+        if restaurant_id is None:
+            return []
+        before = normalize_date(before) if before is not None else '9999-12-31'
+        cur = self._cursor(True)
+        cur.execute(STATEMENTS['expiring_batches'],
+                    (restaurant_id, before, limit))
+        return [{'id': row[0], 'itemId': row[1], 'remaining': row[2],
+                 'expireDate': row[3], 'price': row[4], 'vendorId': row[5]}
+                for row in cur.fetchall()]
+
+    def sweep_expired_batches(self, today=None, chunk_size=1000):
+        '''
+        Flags the batches that expired before ``today`` and still have
+        remaining quantity. Flagged batches leave the expiry indexes, so every
+        sweep only reads the batches that expired since the previous one.
+
+        Run it periodically, for instance daily with
+        ``python service/stock_levels.py sweep``, and book the returned
+        quantities as waste.
+
+        :param str today: date of the sweep. Today by default.
+        :param int chunk_size: batches flagged per transaction.
+        :return: list of the batches flagged, as dictionaries:
+
+                .. code-block:: javascript
+
+                    {'id': 3, 'restaurantId': 2, 'itemId': 4,
+                     'remaining': 2, 'expireDate': '2018-09-21'}
+
+        '''
+        if today is None:
+            today = time.strftime('%Y-%m-%d')
+        else:
+            today = normalize_date(today)
+        cur = self._cursor(True)
+        flagged = []
+        while True:
+            cur.execute(STATEMENTS['expired_batches_due'], (today, chunk_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            try:
+                cur.executemany(STATEMENTS['flag_expired_batch'],
+                                ((row[0],) for row in rows))
+            except Exception:
+                self.con.rollback()
+                raise
+            self.con.commit()
+            flagged.extend({'id': row[0], 'restaurantId': row[1],
+                            'itemId': row[2], 'remaining': row[3],
+                            'expireDate': row[4]} for row in rows)
+            if len(rows) < chunk_size:
+                break
+        return flagged
+
+    #CHANGE LOG
+    def get_changes(self, after=0, limit=DEFAULT_PAGE_SIZE):
+        '''
+        Extracts the changes recorded in the change log after a position, in
+        the order they were committed.
+
+        The data of a change is the row after an insert or an update and
+        the row before a delete, with the columns of
+        :py:data:`CHANGE_LOG_TABLES`. A consumer should apply inserts and
+        updates as upserts, because :py:meth:`compact_changes` keeps only
+        the last change of every row.
+
+        :param int after: position returned by the previous call, or 0.
+        :param int limit: maximum number of changes.
+        :return: a tuple ``(changes, position)``, where ``changes`` is a list
+            of dictionaries:
+
+                .. code-block:: javascript
+
+                    {'seq': 12, 'table': 'user', 'operation': 'update',
+                     'key': 3, 'time': 1539680000.5,
+                     'data': {'userId': 3, 'username': 'mika', ...}}
+
+            and ``position`` is the ``seq`` of the last change, or ``after``
+            if there are none, to pass as ``after`` to the next call.
+        :raises ValueError: if ``limit`` is smaller than 1.
+        :raises ChangeLogTruncatedError: if the changes after ``after`` are
+            no longer in the log.
+
+        '''
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        cur = self._cursor(True)
+        cur.execute(STATEMENTS['changes_after'], (after, limit))
+        rows = cur.fetchall()
+        #The bounds are read after the page: a truncation meanwhile can only
+        #raise for a page that was still complete
+        truncated, last = cur.execute(STATEMENTS['change_log_bounds']
+                                      ).fetchone()
+        if after < truncated or after > last:
+            raise ChangeLogTruncatedError(after, last)
+        changes = [{'seq': row[0], 'table': row[1], 'operation': row[2],
+                    'key': row[3], 'time': row[4], 'data': json.loads(row[5])}
+                   for row in rows]
+        return changes, changes[-1]['seq'] if changes else after
+
+    def iter_changes(self, after=0, batch_size=DEFAULT_PAGE_SIZE):
+        '''
+        Generator version of :py:meth:`get_changes`. It reads the log
+        ``batch_size`` changes at a time until its end.
+
+        :return: generator of dictionaries with the format of the changes
+            returned by :py:meth:`get_changes`.
+        :raises ChangeLogTruncatedError: if the changes after ``after`` are
+            no longer in the log.
+
+        '''
+        while True:
+            changes, after = self.get_changes(after, batch_size)
+            for change in changes:
+                yield change
+            if len(changes) < batch_size:
+                break
+
+    def compact_changes(self, before=None, max_rows=None, max_age=None,
+                        chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Bounds the size of the change log.
+
+        First the changes up to ``before`` that are followed by a later
+        change of the same row are removed. No row is lost, so with the
+        position of the slowest consumer as ``before`` no consumer misses a
+        change. Then the oldest changes are removed until the log has at
+        most ``max_rows`` changes and none older than ``max_age``. The
+        consumers that had not read those changes get a
+        :py:class:`ChangeLogTruncatedError`.
+
+        Run it periodically. Every transaction removes the changes of
+        ``chunk_size`` consecutive positions, so writers are not blocked
+        for long.
+
+        :param int before: last position whose superseded changes are
+            removed. If None, the whole log.
+        :param int max_rows: maximum number of changes kept.
+        :param float max_age: maximum age in seconds of the changes kept.
+        :return: dictionary with the number of changes ``collapsed``, the
+            number of changes ``truncated`` and the position
+            ``truncatedSeq`` after which the log is complete.
+
+        '''
+        cur = self._cursor(True)
+
+        def delete(statement, first, last):
+            removed = 0
+            for start in xrange(first - 1, last, chunk_size):
+                try:
+                    cur.execute(STATEMENTS[statement],
+                                (start, min(start + chunk_size, last)))
+                except Exception:
+                    self.con.rollback()
+                    raise
+                self.con.commit()
+                removed += cur.rowcount
+            return removed
+
+        first, last = cur.execute(STATEMENTS['change_seq_range']).fetchone()
+        if first is None:
+            first = last = 0
+        if before is not None:
+            last = min(last, before)
+        collapsed = delete('collapse_changes', first, last)
+        end = 0
+        if max_rows is not None:
+            row = cur.execute(STATEMENTS['change_seq_keeping'],
+                              (max_rows,)).fetchone()
+            if row is not None:
+                end = row[0]
+        if max_age is not None:
+            row = cur.execute(STATEMENTS['first_change_since'],
+                              (time.time() - max_age,)).fetchone()
+            if row is None:
+                row = cur.execute(STATEMENTS['change_log_bounds']).fetchone()
+                end = max(end, row[1])
+            else:
+                end = max(end, row[0] - 1)
+        truncated = 0
+        if end:
+            #The position is recorded before the changes are removed
+            try:
+                cur.execute(STATEMENTS['truncate_change_log'], (end,))
+            except Exception:
+                self.con.rollback()
+                raise
+            self.con.commit()
+            truncated = delete('delete_changes', first, end)
+        return {'collapsed': collapsed, 'truncated': truncated,
+                'truncatedSeq': cur.execute(
+                    STATEMENTS['change_log_bounds']).fetchone()[0]}
 
 
+def _read_method(name):
+    method = getattr(Connection, name).im_func
 
+    def read(self, *args, **kwargs):
+        if self._active is not None:
+            return method(self, *args, **kwargs)
+        reader = self._snapshot or self._readers.checkout()
+        self._activate(reader)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._activate(None)
+            if reader is not self._snapshot:
+                self._readers.checkin(reader)
+
+    def read_generator(self, *args, **kwargs):
+        #The reader stays borrowed until the generator is exhausted or closed
+        reader = self._snapshot or self._readers.checkout()
+        try:
+            iterator = method(self, *args, **kwargs)
+            while True:
+                previous = self._active
+                self._activate(reader)
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._activate(previous)
+                yield row
+        finally:
+            if reader is not self._snapshot:
+                self._readers.checkin(reader)
+
+    wrapper = read_generator if inspect.isgeneratorfunction(method) \
+        else read
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def _write_method(name):
+    method = getattr(Connection, name).im_func
+
+    def write(self, *args, **kwargs):
+        if self._active is not None or self._pinned is not None:
+            return method(self, *args, **kwargs)
+        writer = self._writers.checkout()
+        self._activate(writer)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._activate(None)
+            self._writers.checkin(writer)
+    write.__name__ = name
+    write.__doc__ = method.__doc__
+    return write
 
 
+class ReplicaConnection(Connection):
+    '''
+    :py:class:`Connection` of an :py:class:`Engine` with readers. The
+    :py:data:`READ_METHODS` run on the read-only connections of the Engine
+    and the other public methods on its writer connections, so long reads
+    never hold the connection a writer needs. Every method borrows its
+    connection while it runs; the generators keep it until they are
+    exhausted or closed.
+
+    Code using :py:attr:`con` directly, outside of the methods, gets a
+    writer connection that stays borrowed until :py:meth:`close`; the write
+    methods then run on it too.
+
+    :param writers: pool of the writer connections.
+    :type writers: ConnectionPool
+    :param readers: pool of the read-only connections.
+    :type readers: ConnectionPool
 
+    '''
+    def __init__(self, db_path, writers, readers, cache=None,
+                 record_mode='dict', retry_policy=None):
+        self._writers = writers
+        self._readers = readers
+        #Connection of the method running, writer pinned through con and
+        #reader of the current read_snapshot block
+        self._active = None
+        self._pinned = None
+        self._snapshot = None
+        self._closed = False
+        #Guards _active against interrupt(), called from other threads
+        self._active_lock = threading.Lock()
+        self._cursors = {}
+        super(ReplicaConnection, self).__init__(db_path, writers, None,
+                                                cache, record_mode,
+                                                retry_policy)
+
+    def _open(self, db_path, pool, profile):
+        #The connections are borrowed by the methods
+        return None
+
+    @property
+    def con(self):
+        if self._active is not None:
+            return self._active
+        if self._pinned is None and not self._closed:
+            self._pinned = self._writers.checkout()
+        return self._pinned
+
+    @con.setter
+    def con(self, value):
+        self._pinned = value
+
+    def _activate(self, con):
+        with self._active_lock:
+            self._active = con
+
+    def interrupt(self):
+        '''
+        Aborts the statement of the method running, on the reader or the
+        writer it borrowed. Unlike :py:attr:`con`, it never borrows a
+        connection. See :py:meth:`Connection.interrupt`.
 
+        '''
+        #The connection is not given back to its pool while the lock is held,
+        #so the statement of another Connection is never interrupted
+        with self._active_lock:
+            con = self._active or self._pinned
+            if con is not None:
+                con.interrupt()
+
+    def _cursor(self, raw=False):
+        con = self.con
+        cur = self._cursors.get((con, raw))
+        if cur is None:
+            cur = con.cursor()
+            if raw:
+                cur.row_factory = None
+            self._cursors[con, raw] = cur
+        return cur
 
+    @contextlib.contextmanager
+    def read_snapshot(self):
+        '''
+        Runs the reads of a ``with`` block on one reader and on a single
+        snapshot of the database. See :py:meth:`Connection.read_snapshot`;
+        the writes of the block run on a writer and do not end the snapshot,
+        but they are not visible inside it.
 
+        '''
+        if self._snapshot is not None:
+            yield self
+            return
+        reader = self._readers.checkout()
+        try:
+            reader.execute('BEGIN')
+            reader.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            self._snapshot = reader
+            yield self
+        finally:
+            self._snapshot = None
+            self._readers.checkin(reader)
 
+    def close(self):
+        '''
+        Closes the cursors and gives back the writer connection borrowed
+        through :py:attr:`con`, commiting its changes.
 
+        '''
+        for cur in self._cursors.values():
+            cur.close()
+        self._cursors = {}
+        if self._pinned is not None:
+            self._pinned.commit()
+            self._writers.checkin(self._pinned)
+            self._pinned = None
+        self._closed = True
+
+    for _name in READ_METHODS:
+        locals()[_name] = _read_method(_name)
+    #The methods written above, such as close and interrupt, are not wrapped
+    for _name, _ in inspect.getmembers(Connection, inspect.ismethod):
+        if not _name.startswith('_') and _name not in locals():
+            locals()[_name] = _write_method(_name)
+    del _name, _
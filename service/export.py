@@ -0,0 +1,296 @@
+'''
+Created on 16.10.2026
+
+Parallel export of the restaurants with their staff, items, vendors and
+stock ledger to NDJSON files, one JSON document per line and restaurant.
+
+The restaurants are split into partitions, ranges of consecutive
+``restaurantId`` values with about the same number of restaurants, that a
+pool of processes exports in parallel. Every worker reads its partition
+through its own read-only connection and in one read transaction, so a
+partition is a consistent snapshot of the database, and writes the file
+``part-NNNNN.ndjson`` as it reads. The lists of a restaurant, including its
+ledger, are streamed into its document, so the memory of a worker does not
+depend on the size of the partition nor of the ledger.
+
+An incremental export only writes the restaurants that changed after a
+version of the table ``restaurantChange`` (see
+:py:data:`database.MIGRATIONS`). Every export returns, and saves in the
+file ``manifest.json``, the ``watermark`` to pass as ``since`` to the next
+one. A restaurant that changes while the export runs may be exported again
+by the next one, but it is never missed. Deleted restaurants are written as
+``{"restaurantId": id, "deleted": true}``.
+
+:Example:
+
+>>> report = export_dataset('db/rms.db', 'export/full')
+>>> export_dataset('db/rms.db', 'export/delta', since=report['watermark'])
+
+or from the command line::
+
+    python service/export.py export/full --processes 4
+    python service/export.py export/delta --since 1234
+
+'''
+
+import argparse, json, multiprocessing, os, sys, time
+
+from database import DEFAULT_DB_PATH, open_connection
+
+#Rows of the ledger read with every fetchmany.
+EXPORT_FETCH_SIZE = 1000
+#Partitions per process: smaller partitions balance the work of the
+#processes when the restaurants have ledgers of different sizes.
+PARTITIONS_PER_PROCESS = 4
+#Bounds of the first and last partitions, so that the restaurants added
+#after the partitions are computed are also exported.
+_MIN_ID = -2 ** 63
+_MAX_ID = 2 ** 63 - 1
+
+#Keys and columns of the JSON objects of a restaurant document and of its
+#lists. The objects are encoded by SQLite, which is faster than building
+#and encoding dictionaries in Python.
+RESTAURANT_FIELDS = (('restaurantId', 'r.restaurantId'),
+                     ('restaurantName', 'r.restaurantName'),
+                     ('address', 'r.address'), ('phone', 'r.phone'))
+STAFF_FIELDS = (('username', 'u.username'), ('firstname', 'u.firstname'),
+                ('lastname', 'u.lastname'), ('email', 'u.email'),
+                ('phone', 'u.phone'), ('dob', 'u.dob'),
+                ('position', 'ru.position'))
+ITEM_FIELDS = (('itemId', 'itemId'), ('itemName', 'itemName'),
+               ('description', 'description'))
+VENDOR_FIELDS = (('vendorId', 'vendorId'), ('name', 'Name'),
+                 ('address', 'address'), ('email', 'email'),
+                 ('phone', 'phont'))
+STOCK_FIELDS = (('id', 'id'), ('date', 'date'), ('expireDate', 'expireDate'),
+                ('transactionType', 'transactionType'), ('price', 'price'),
+                ('quantity', 'quantity'),
+                ('quantityInStock', 'quantityInStock'),
+                ('remaining', 'remaining'), ('expired', 'expired'),
+                ('itemId', 'itemId'), ('vendorId', 'vendorId'),
+                ('userId', 'userId'))
+
+
+#Lists of a restaurant document in the order they are written, with the
+#tables, the column of the restaurant id and the order of the objects. The
+#ledger goes last so that it can be streamed.
+LISTS = (('staff', 'restaurantUser ru JOIN user u ON u.userId = ru.userId',
+          'ru.restaurantId', 'ru.id', STAFF_FIELDS),
+         ('items', 'item', 'restaurantId', 'itemId', ITEM_FIELDS),
+         ('vendors', 'vendor', 'restaurantId', 'vendorId', VENDOR_FIELDS),
+         ('stock', 'stock', 'restaurantId', 'id', STOCK_FIELDS))
+
+
+def _json_object(fields):
+    '''
+    Returns the SQL expression encoding the columns of ``fields`` as a
+    JSON object.
+
+    '''
+    return 'json_object(%s)' % ', '.join("'%s', %s" % field
+                                         for field in fields)
+
+_RESTAURANTS = '''
+    SELECT r.restaurantId, %s, 0 FROM restaurant r
+    WHERE r.restaurantId BETWEEN ? AND ?
+    ORDER BY r.restaurantId''' % _json_object(RESTAURANT_FIELDS)
+_CHANGED_RESTAURANTS = '''
+    SELECT c.restaurantId, %s, r.restaurantId IS NULL
+    FROM restaurantChange c
+    LEFT JOIN restaurant r ON r.restaurantId = c.restaurantId
+    WHERE c.restaurantId BETWEEN ? AND ? AND c.version > ?
+    ORDER BY c.restaurantId''' % _json_object(RESTAURANT_FIELDS)
+_LIST_QUERIES = [(key, 'SELECT %s FROM %s WHERE %s = ? ORDER BY %s' %
+                  (_json_object(fields), source, column, order))
+                 for key, source, column, order, fields in LISTS]
+
+
+def partition_bounds(con, partitions, since=None):
+    '''
+    Splits the restaurants into ranges of ``restaurantId`` with about the
+    same number of restaurants.
+
+    :param con: a sqlite3 connection.
+    :param int partitions: maximum number of ranges.
+    :param int since: if not None the ranges split the restaurants that
+        changed after this version.
+    :return: a list of tuples ``(low, high)`` of inclusive bounds that cover
+        every possible id.
+
+    '''
+    if since is None:
+        query, parameters = 'SELECT restaurantId FROM restaurant', ()
+    else:
+        query = 'SELECT restaurantId FROM restaurantChange WHERE version > ?'
+        parameters = (since,)
+    count = con.execute('SELECT count(*) FROM (%s)' % query,
+                        parameters).fetchone()[0]
+    size = max(1, -(-count // max(1, partitions)))
+    lows = [_MIN_ID]
+    cur = con.execute(query + ' ORDER BY restaurantId', parameters)
+    for i, (restaurant_id,) in enumerate(cur):
+        if i and i % size == 0:
+            lows.append(restaurant_id)
+    highs = [low - 1 for low in lows[1:]] + [_MAX_ID]
+    return zip(lows, highs)
+
+
+def _write_restaurant(out, row, cursors):
+    '''
+    Writes the document of a restaurant as one line. The lists are read
+    :py:data:`EXPORT_FETCH_SIZE` objects at a time.
+
+    :return: the number of rows of the document.
+
+    '''
+    restaurant_id, document, deleted = row
+    if deleted:
+        out.write('{"restaurantId":%d,"deleted":true}\n' % restaurant_id)
+        return 1
+    rows = 1
+    #The lists are added before the closing brace of the restaurant object
+    out.write(document[:-1])
+    for (key, query), cur in zip(_LIST_QUERIES, cursors):
+        out.write(',"%s":[' % key)
+        cur.execute(query, (restaurant_id,))
+        separator = ''
+        while True:
+            chunk = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not chunk:
+                break
+            out.write(separator)
+            out.write(','.join([child[0] for child in chunk]))
+            separator = ','
+            rows += len(chunk)
+        out.write(']')
+    out.write('}\n')
+    return rows
+
+
+def export_partition(task):
+    '''
+    Exports the restaurants of one partition. It runs in the worker
+    processes of :py:func:`export_dataset`.
+
+    :param tuple task: ``(db_path, out_dir, number, low, high, since)``
+    :return: dictionary with the keys ``partition``, ``path``,
+        ``restaurants``, ``rows``, ``bytes`` and ``seconds``.
+
+    '''
+    db_path, out_dir, number, low, high, since = task
+    start = time.time()
+    path = os.path.join(out_dir, 'part-%05d.ndjson' % number)
+    restaurants = rows = 0
+    con = open_connection(db_path, read_only=True)
+    try:
+        #The objects are written as SQLite encodes them, in UTF-8
+        con.text_factory = str
+        con.isolation_level = None
+        con.execute('BEGIN')
+        if since is None:
+            cur = con.execute(_RESTAURANTS, (low, high))
+        else:
+            cur = con.execute(_CHANGED_RESTAURANTS, (low, high, since))
+        cursors = [con.cursor() for _ in _LIST_QUERIES]
+        #The file appears complete or not at all
+        with open(path + '.tmp', 'wb') as out:
+            for row in cur:
+                rows += _write_restaurant(out, row, cursors)
+                restaurants += 1
+            size = out.tell()
+        os.rename(path + '.tmp', path)
+        con.execute('COMMIT')
+    finally:
+        con.close()
+    return {'partition': number, 'path': path, 'restaurants': restaurants,
+            'rows': rows, 'bytes': size, 'seconds': time.time() - start}
+
+
+def export_dataset(db_path, out_dir, processes=None, partitions=None,
+                   since=None):
+    '''
+    Exports the restaurants of a database to NDJSON files.
+
+    :param str db_path: location of the database file. It must have the
+        schema version 8 or later (see :py:meth:`database.Engine.migrate`).
+    :param str out_dir: directory of the files. It is created if it does not
+        exist.
+    :param int processes: worker processes. If None, one per CPU. With 1 the
+        partitions are exported in the calling process.
+    :param int partitions: number of partitions. If None,
+        :py:data:`PARTITIONS_PER_PROCESS` per process.
+    :param int since: if not None, only the restaurants that changed after
+        this version are exported.
+    :return: dictionary with the keys ``since``, ``watermark``,
+        ``restaurants``, ``rows``, ``bytes``, ``seconds``, ``rows_per_s``
+        and ``partitions``, the list of the dictionaries returned by
+        :py:func:`export_partition`.
+
+    '''
+    start = time.time()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if partitions is None:
+        partitions = processes * PARTITIONS_PER_PROCESS
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    con = open_connection(db_path, read_only=True)
+    try:
+        #Read before the workers start: they may see later changes, which
+        #the next export writes again
+        watermark = con.execute('SELECT coalesce(max(version), 0) '
+                                'FROM restaurantChange').fetchone()[0]
+        bounds = partition_bounds(con, partitions, since)
+    finally:
+        con.close()
+    tasks = [(db_path, out_dir, number, low, high, since)
+             for number, (low, high) in enumerate(bounds)]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(export_partition, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(export_partition, tasks)
+    seconds = time.time() - start
+    rows = sum(result['rows'] for result in results)
+    report = {'since': since, 'watermark': watermark,
+              'restaurants': sum(result['restaurants'] for result in results),
+              'rows': rows,
+              'bytes': sum(result['bytes'] for result in results),
+              'seconds': seconds,
+              'rows_per_s': rows / seconds if seconds else 0.0,
+              'partitions': results}
+    with open(os.path.join(out_dir, 'manifest.json'), 'wb') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the restaurants '
+                                     'with their staff, items, vendors and '
+                                     'stock to NDJSON files.')
+    parser.add_argument('out_dir', help='directory of the NDJSON files')
+    parser.add_argument('--db', default=DEFAULT_DB_PATH,
+                        help='database file (default %(default)s)')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--partitions', type=int,
+                        help='partitions of the restaurants (default: %d per '
+                        'process)' % PARTITIONS_PER_PROCESS)
+    parser.add_argument('--since', type=int,
+                        help='only export the restaurants changed after '
+                        'this watermark of a previous export')
+    args = parser.parse_args(argv)
+    report = export_dataset(args.db, args.out_dir, args.processes,
+                            args.partitions, args.since)
+    print '%d restaurants, %d rows in %.2f s (%.0f rows/s), watermark %d' % (
+        report['restaurants'], report['rows'], report['seconds'],
+        report['rows_per_s'], report['watermark'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+'''
+Created on 16.10.2026
+
+Group commit of the writes of many callers.
+
+Every mutating method of :py:class:`database.Connection` commits its own
+transaction, so the write throughput is limited by the latency of one commit
+per write. A :py:class:`GroupCommitWriter` collects the writes of all its
+callers and runs them in a single transaction every few milliseconds or
+every ``max_batch`` writes. Each write runs inside its own SAVEPOINT, so a
+failing write is rolled back alone and does not affect the rest of the
+batch.
+
+Callers get a :py:class:`async_database.Future` that resolves once the
+transaction of their write has been committed with the configured
+durability.
+
+:Example:
+
+>>> writer = GroupCommitWriter(Engine(), durability='full')
+>>> future = writer.append_user('ali', user)
+>>> future.result()
+'ali'
+>>> writer.close()
+
+'''
+
+import sqlite3, threading, time, Queue
+
+from async_database import Future
+
+#Durability levels and the PRAGMA synchronous used for the group commits:
+#'off' does not wait for the disk, 'normal' survives a crash of the process
+#and 'full' also survives a power failure.
+DURABILITY_LEVELS = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}
+#Default limits of a batch: number of writes and seconds since the first one.
+DEFAULT_MAX_BATCH = 100
+DEFAULT_MAX_DELAY = 0.005
+
+#Methods of database.Connection available through the writer.
+GROUP_COMMIT_METHODS = ('append_user', 'append_restaurant',
+                        'assign_user_to_restaurant', 'modify_user',
+                        'modify_restaurant', 'delete_user',
+                        'record_stock_transaction')
+
+
+class _DeferredCommit(object):
+    '''
+    Proxy of a sqlite3 connection that ignores ``commit`` and ``rollback``,
+    so the methods of :py:class:`database.Connection` run inside the
+    transaction of the batch. The writer decides what is committed or
+    rolled back.
+
+    '''
+    def __init__(self, con):
+        self.__dict__['_con'] = con
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._con, name, value)
+
+
+def _rollback(raw):
+    '''
+    Rolls back the transaction of a batch. An error such as SQLITE_FULL, an
+    I/O error or an interrupt may have rolled it back already.
+
+    '''
+    try:
+        raw.execute('ROLLBACK')
+    except sqlite3.OperationalError:
+        #No transaction is active
+        pass
+
+
+def _fail_requests(requests, excp):
+    '''
+    Resolves with ``excp`` the futures of the requests that are not
+    resolved yet.
+
+    '''
+    for request in requests:
+        if request is None:
+            continue
+        future = request[0]
+        if future._start() or not future.done():
+            future._finish(exception=excp)
+
+
+def _writer_method(name):
+    def method(self, *args, **kwargs):
+        return self._submit(name, args, kwargs)
+    method.__name__ = name
+    method.__doc__ = '''
+        Queues a :py:meth:`database.Connection.%s` call for the next group
+        commit. Takes the same arguments as the Connection method.
+
+        :return: a Future resolved with the value returned by the method once
+            the write is committed.
+        :rtype: async_database.Future
+
+        ''' % name
+    return method
+
+
+class GroupCommitWriter(object):
+    '''
+    Writer thread that commits the writes of many callers in batches.
+
+    :param engine: Engine used to open the connection of the writer thread.
+    :type engine: database.Engine
+    :param int max_batch: maximum number of writes per transaction.
+    :param float max_delay: maximum seconds a write waits for more writes
+        before its batch is committed.
+    :param str durability: one of the keys of :py:data:`DURABILITY_LEVELS`.
+    :param int max_queue: maximum number of queued writes. ``0`` means
+        unbounded. When the queue is full the callers block.
+    :raises ValueError: if the durability level is unknown.
+
+    '''
+    def __init__(self, engine, max_batch=DEFAULT_MAX_BATCH,
+                 max_delay=DEFAULT_MAX_DELAY, durability='normal',
+                 max_queue=0):
+        super(GroupCommitWriter, self).__init__()
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError("Unknown durability level %s" % durability)
+        if max_batch < 1:
+            raise ValueError("The batch size must be at least 1")
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durability = durability
+        self._queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._closed = False
+        #Metrics
+        self._batches = 0
+        self._operations = 0
+        self._failed = 0
+        self._commit_failures = 0
+        self._max_batch_size = 0
+        self._commit_time = 0.0
+        self._max_commit_time = 0.0
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='rms-group-commit')
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    for _name in GROUP_COMMIT_METHODS:
+        locals()[_name] = _writer_method(_name)
+    del _name
+
+    def _check_running(self):
+        if self._closed:
+            raise RuntimeError("The GroupCommitWriter is closed")
+        if self._error is not None:
+            raise RuntimeError("The writer thread of the GroupCommitWriter "
+                               "stopped: %s" % self._error)
+
+    def _drain(self, excp):
+        '''
+        Fails the queued writes. Called once the writer thread has stopped.
+
+        '''
+        requests = []
+        while True:
+            try:
+                requests.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        _fail_requests(requests, excp)
+
+    def _submit(self, method, args, kwargs):
+        self._check_running()
+        future = Future(method, None)
+        self._queue.put((future, args, kwargs))
+        #The writer thread may have stopped and drained the queue meanwhile
+        if self._error is not None:
+            self._drain(self._error)
+            self._check_running()
+        return future
+
+    def _next_batch(self):
+        '''
+        Waits for a write and collects the writes that arrive within
+        ``max_delay`` seconds, up to ``max_batch``.
+
+        :return: the list of requests and whether the writer must stop.
+
+        '''
+        request = self._queue.get()
+        if request is None:
+            return [], True
+        batch = [request]
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    request = self._queue.get(True, remaining)
+                else:
+                    request = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        try:
+            con = self.engine.connect()
+            raw = con.con
+            #The pooled connection gets its setting back when the writer stops
+            synchronous = raw.execute('PRAGMA synchronous').fetchone()[0]
+            raw.execute('PRAGMA synchronous = %s' %
+                        DURABILITY_LEVELS[self.durability])
+            #Transactions are controlled explicitly and a batch holds the
+            #write lock, so its writes are not retried one by one
+            isolation_level = raw.isolation_level
+            raw.isolation_level = None
+            retry_policy, con.retry_policy = con.retry_policy, None
+        except Exception, excp:
+            self._error = excp
+            self._ready.set()
+            return
+        #The methods invalidate the cache before the batch is committed, so
+        #the invalidations are repeated after the commit
+        invalidations = []
+        invalidate = con._invalidate
+
+        def record_invalidation(namespace, key=None):
+            invalidate(namespace, key)
+            invalidations.append((namespace, key))
+        con._invalidate = record_invalidation
+        con.con = _DeferredCommit(raw)
+        self._ready.set()
+        stop = False
+        try:
+            while not stop:
+                batch, stop = self._next_batch()
+                if batch:
+                    del invalidations[:]
+                    try:
+                        self._commit_batch(con, raw, batch)
+                    except Exception, excp:
+                        #The writer stops: no write is left unresolved and
+                        #the new ones are refused
+                        self._error = excp
+                        _fail_requests(batch, excp)
+                        self._drain(excp)
+                        _rollback(raw)
+                        return
+                    for namespace, key in invalidations:
+                        invalidate(namespace, key)
+        finally:
+            del con._invalidate
+            con.con = raw
+            raw.isolation_level = isolation_level
+            con.retry_policy = retry_policy
+            raw.execute('PRAGMA synchronous = %d' % synchronous)
+            con.close()
+
+    def _commit_batch(self, con, raw, batch):
+        '''
+        Runs the writes of a batch in one transaction, each inside its own
+        SAVEPOINT, commits it and resolves the futures. If the transaction
+        cannot be started or committed, or a write aborts it, every write of
+        the batch fails with that error.
+
+        '''
+        done = []
+        try:
+            raw.execute('BEGIN IMMEDIATE')
+            for future, args, kwargs in batch:
+                if not future._start():
+                    continue
+                done.append((future, None, None))
+                raw.execute('SAVEPOINT rms_write')
+                try:
+                    result = getattr(con, future.method)(*args, **kwargs)
+                except Exception, excp:
+                    done[-1] = (future, None, excp)
+                    try:
+                        raw.execute('ROLLBACK TO rms_write')
+                    except sqlite3.Error:
+                        #The error rolled back the whole transaction
+                        raise excp
+                else:
+                    done[-1] = (future, result, None)
+                raw.execute('RELEASE rms_write')
+            start = time.time()
+            raw.execute('COMMIT')
+        except Exception, excp:
+            _rollback(raw)
+            _fail_requests(batch, excp)
+            self._count(len(batch), len(batch), None, True)
+            return
+        elapsed = time.time() - start
+        failed = 0
+        for future, result, excp in done:
+            if excp is not None:
+                failed += 1
+                future._finish(exception=excp)
+            else:
+                future._finish(result)
+        self._count(len(done), failed, elapsed, False)
+
+    def _count(self, size, failed, commit_time, commit_failed):
+        with self._lock:
+            self._batches += 1
+            self._operations += size
+            self._failed += failed
+            self._max_batch_size = max(self._max_batch_size, size)
+            if commit_failed:
+                self._commit_failures += 1
+            if commit_time is not None:
+                self._commit_time += commit_time
+                self._max_commit_time = max(self._max_commit_time,
+                                            commit_time)
+
+    def metrics(self):
+        '''
+        Returns the counters of the writer.
+
+        :return: a dictionary with the following keys:
+
+            * ``queue_depth``: writes waiting for the next batch
+            * ``batches``: transactions run
+            * ``operations``: writes run
+            * ``failed``: writes that raised an exception or whose commit
+              failed
+            * ``commit_failures``: batches that could not be committed
+            * ``mean_batch_size`` and ``max_batch_size``: writes per batch
+            * ``mean_commit_ms`` and ``max_commit_ms``: latency of COMMIT
+
+        '''
+        with self._lock:
+            batches = self._batches
+            committed = batches - self._commit_failures
+            return {'queue_depth': self._queue.qsize(),
+                    'batches': batches,
+                    'operations': self._operations,
+                    'failed': self._failed,
+                    'commit_failures': self._commit_failures,
+                    'mean_batch_size':
+                        self._operations / float(batches) if batches else 0.0,
+                    'max_batch_size': self._max_batch_size,
+                    'mean_commit_ms':
+                        self._commit_time * 1000 / committed
+                        if committed else 0.0,
+                    'max_commit_ms': self._max_commit_time * 1000
+                    }
+
+    def close(self):
+        '''
+        Commits the queued writes, stops the writer thread and releases its
+        connection.
+
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
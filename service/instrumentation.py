@@ -0,0 +1,673 @@
+'''
+Created on 16.10.2026
+
+Instrumentation of the database API provided by :py:mod:`database`.
+
+An :py:class:`Instrumentation` passed to :py:class:`database.Engine` makes
+the Engine return :py:class:`InstrumentedConnection` objects. Their sqlite3
+connection is wrapped so that every statement executed by the methods of
+:py:class:`database.Connection` is timed. The instrumentation records:
+
+* a latency histogram per public method of the Connection
+* a latency histogram and the number of rows returned per SQL statement
+* a latency histogram of the commits
+* the statements that failed because the database was locked
+  (``SQLITE_BUSY``) and the writes retried by the
+  :py:class:`database.RetryPolicy` of the Engine
+
+Statements slower than ``slow_query_ms`` are written to a slow-query log,
+one JSON object per line, together with their ``EXPLAIN QUERY PLAN``.
+The metrics are exported in the Prometheus text format with
+:py:meth:`Instrumentation.export` or periodically by a
+:py:class:`MetricsExporter`.
+
+The latency of a statement is the time spent in ``execute``, which in
+SQLite runs the statement up to its first row; the time spent fetching the
+remaining rows is part of the latency of the method.
+
+:Example:
+
+>>> instrumentation = Instrumentation(slow_query_ms=50,
+...                                   slow_log='/var/log/rms/slow.log')
+>>> engine = Engine(instrumentation=instrumentation)
+>>> exporter = MetricsExporter(instrumentation, '/var/lib/rms/rms.prom')
+
+'''
+
+import bisect, collections, inspect, json, os, sqlite3, sys, threading, time
+
+from database import (Connection, STATEMENTS, connection_profile,
+                      is_busy_error, open_connection)
+
+#Upper bounds in milliseconds of the buckets of the latency histograms.
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                      500, 1000, 2500, 5000, 10000)
+#Statements slower than this are written to the slow-query log by default.
+DEFAULT_SLOW_QUERY_MS = 100.0
+#Seconds before the plan of the same slow statement is explained again.
+DEFAULT_EXPLAIN_INTERVAL = 60.0
+#Milliseconds the connection explaining a slow statement waits for a lock.
+#The statement may belong to a transaction that holds it.
+EXPLAIN_BUSY_TIMEOUT_MS = 100
+#Number of slow queries kept in memory for slow_queries().
+DEFAULT_SLOW_QUERY_HISTORY = 100
+#Label of the statements run outside of a Connection method, for instance by
+#the reporting functions.
+NO_METHOD = '(none)'
+
+#Name of every statement of database.STATEMENTS, used as metric label
+_STATEMENT_NAMES = dict((sql, name) for name, sql in STATEMENTS.items())
+_EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def _statement_label(sql):
+    '''
+    Returns the name of a statement of :py:data:`database.STATEMENTS` or,
+    for other statements, their SQL with the whitespace collapsed.
+
+    '''
+    name = _STATEMENT_NAMES.get(sql)
+    return name if name is not None else ' '.join(sql.split())
+
+
+class Histogram(object):
+    '''
+    Latency histogram with the fixed buckets of
+    :py:data:`LATENCY_BUCKETS_MS`. It is not thread-safe; the
+    :py:class:`Instrumentation` serializes the updates.
+
+    '''
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def quantile(self, q):
+        '''
+        Returns the upper bound of the bucket holding the ``q`` quantile, or
+        the maximum latency seen when it falls in the last bucket.
+
+        '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum_ms': self.sum, 'max_ms': self.max,
+                'p50_ms': self.quantile(0.5), 'p95_ms': self.quantile(0.95),
+                'p99_ms': self.quantile(0.99)}
+
+
+class _StatementStats(object):
+    __slots__ = ('latency', 'rows')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+
+
+class Instrumentation(object):
+    '''
+    Collects the metrics of every :py:class:`InstrumentedConnection` of one
+    or more Engines. All the methods are thread-safe.
+
+    :param float slow_query_ms: statements slower than this are logged.
+        ``None`` disables the slow-query log.
+    :param slow_log: path of the slow-query log, opened in append mode, or
+        an open file. If None the slow queries are only kept in memory, see
+        :py:meth:`slow_queries`.
+    :param bool explain: if ``True`` the ``EXPLAIN QUERY PLAN`` of the slow
+        statements is logged, at most once every ``explain_interval``
+        seconds per statement.
+    :param float explain_interval: see ``explain``.
+
+    '''
+    def __init__(self, slow_query_ms=DEFAULT_SLOW_QUERY_MS, slow_log=None,
+                 explain=True, explain_interval=DEFAULT_EXPLAIN_INTERVAL):
+        super(Instrumentation, self).__init__()
+        self.slow_query_ms = slow_query_ms
+        self.explain = explain
+        self.explain_interval = explain_interval
+        if isinstance(slow_log, basestring):
+            slow_log = open(slow_log, 'a')
+        self._slow_log = slow_log
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._methods = {}
+        self._statements = {}
+        self._commits = Histogram()
+        self._busy = collections.defaultdict(int)
+        self._busy_retries = collections.defaultdict(int)
+        self._slow = collections.defaultdict(int)
+        self._slow_history = collections.deque(
+            maxlen=DEFAULT_SLOW_QUERY_HISTORY)
+        self._explained = {}
+
+    def connect(self, engine):
+        '''
+        Opens an :py:class:`InstrumentedConnection` with the settings of an
+        Engine. Called by :py:meth:`database.Engine.connect`.
+
+        '''
+        return InstrumentedConnection(engine.db_path, engine.pool,
+                                      engine.profile, engine.cache,
+                                      engine.record_mode, self,
+                                      engine.retry_policy)
+
+    def current_method(self):
+        '''
+        Returns the Connection method running in the calling thread, or
+        :py:data:`NO_METHOD`.
+
+        '''
+        return getattr(self._local, 'method', None) or NO_METHOD
+
+    def count_busy_retry(self, method=None):
+        '''
+        Counts a retry of an operation that found the database locked. The
+        retries of the :py:class:`database.RetryPolicy` are counted by the
+        connections; other code retrying writes can call it too.
+
+        '''
+        with self._lock:
+            self._busy_retries[method or self.current_method()] += 1
+
+    def _observe_method(self, name, seconds):
+        with self._lock:
+            histogram = self._methods.get(name)
+            if histogram is None:
+                histogram = self._methods[name] = Histogram()
+            histogram.observe(seconds * 1000)
+
+    def _observe_statement(self, db_path, sql, parameters, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            stats = self._statements.get(sql)
+            if stats is None:
+                stats = self._statements[sql] = _StatementStats()
+            stats.latency.observe(ms)
+            if sql == 'COMMIT':
+                self._commits.observe(ms)
+        if self.slow_query_ms is not None and ms >= self.slow_query_ms:
+            try:
+                self._log_slow_query(db_path, sql, parameters, ms)
+            except Exception:
+                #The statement succeeded: a failure of the log, for instance
+                #a full disk, must not reach the caller
+                pass
+
+    def _observe_commit(self, seconds):
+        with self._lock:
+            self._commits.observe(seconds * 1000)
+
+    def _observe_busy(self):
+        with self._lock:
+            self._busy[self.current_method()] += 1
+
+    def _add_rows(self, sql, rows):
+        if rows:
+            with self._lock:
+                stats = self._statements.get(sql)
+                if stats is not None:
+                    stats.rows += rows
+
+    def _plan(self, db_path, sql, parameters):
+        '''
+        Returns the ``EXPLAIN QUERY PLAN`` of a statement, or None if it was
+        explained recently or it cannot be explained.
+
+        The plan is read through a new read-only connection. The sqlite3
+        module of Python 2 commits the open transaction before a statement
+        like EXPLAIN, so running it on the connection of the statement would
+        commit a write its caller may still roll back.
+
+        :param parameters: the parameters of the statement, or None if they
+            are not known.
+
+        '''
+        if not self.explain or parameters is None or \
+                not sql.lstrip()[:7].upper().startswith(_EXPLAINED):
+            return None
+        now = time.time()
+        with self._lock:
+            if now - self._explained.get(sql, 0) < self.explain_interval:
+                return None
+            self._explained[sql] = now
+        try:
+            con = open_connection(db_path, connection_profile(
+                busy_timeout=EXPLAIN_BUSY_TIMEOUT_MS), read_only=True)
+            try:
+                rows = con.execute('EXPLAIN QUERY PLAN ' + sql,
+                                   parameters).fetchall()
+            finally:
+                con.close()
+        except Exception, excp:
+            return 'not explained: %s' % excp
+        return [row[-1] for row in rows]
+
+    def _log_slow_query(self, db_path, sql, parameters, ms):
+        method = self.current_method()
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'method': method,
+                 'statement': _STATEMENT_NAMES.get(sql),
+                 'sql': ' '.join(sql.split()),
+                 'ms': round(ms, 3),
+                 'plan': self._plan(db_path, sql, parameters)}
+        with self._lock:
+            self._slow[method] += 1
+            self._slow_history.append(entry)
+            if self._slow_log is not None:
+                self._slow_log.write(json.dumps(entry) + '\n')
+                self._slow_log.flush()
+
+    def slow_queries(self):
+        '''
+        Returns the last slow queries, oldest first, as dictionaries with
+        the keys ``time``, ``method``, ``statement`` (name in
+        :py:data:`database.STATEMENTS` or None), ``sql``, ``ms`` and
+        ``plan`` (list of plan lines or None when not explained).
+
+        '''
+        with self._lock:
+            return list(self._slow_history)
+
+    def metrics(self):
+        '''
+        Returns the collected metrics.
+
+        :return: a dictionary with the following keys:
+
+            * ``methods``: latency summary of every Connection method
+            * ``statements``: latency summary and ``rows`` of every SQL
+              statement, keyed by statement name or SQL
+            * ``commits``: latency summary of the commits
+            * ``busy``: statements failed with the database locked, per
+              method
+            * ``busy_retries``: retries counted with
+              :py:meth:`count_busy_retry`, per method
+            * ``slow_queries``: slow statements per method
+
+            Latency summaries have the keys ``count``, ``sum_ms``,
+            ``max_ms``, ``p50_ms``, ``p95_ms`` and ``p99_ms``; the
+            quantiles are the upper bounds of their histogram buckets.
+
+        '''
+        with self._lock:
+            statements = {}
+            for sql, stats in self._statements.items():
+                summary = stats.latency.summary()
+                summary['rows'] = stats.rows
+                statements[_statement_label(sql)] = summary
+            return {'methods': dict((name, histogram.summary()) for
+                                    name, histogram in
+                                    self._methods.items()),
+                    'statements': statements,
+                    'commits': self._commits.summary(),
+                    'busy': dict(self._busy),
+                    'busy_retries': dict(self._busy_retries),
+                    'slow_queries': dict(self._slow)}
+
+    def reset(self):
+        '''
+        Discards the collected metrics and the slow-query history.
+
+        '''
+        with self._lock:
+            self._methods.clear()
+            self._statements.clear()
+            self._commits = Histogram()
+            self._busy.clear()
+            self._busy_retries.clear()
+            self._slow.clear()
+            self._slow_history.clear()
+            self._explained.clear()
+
+    def export(self, out=None):
+        '''
+        Writes the metrics in the Prometheus text exposition format.
+
+        :param out: path of the file to write, replaced atomically, or an
+            open file. If None the metrics are written to the standard
+            output.
+
+        '''
+        if isinstance(out, basestring):
+            tmp_path = out + '.tmp'
+            with open(tmp_path, 'w') as f:
+                self.export(f)
+            os.rename(tmp_path, out)
+            return
+        if out is None:
+            out = sys.stdout
+        with self._lock:
+            lines = []
+            _histogram_lines(lines, 'rms_method_duration_ms',
+                             'Latency of the Connection methods.',
+                             [({'method': name}, histogram) for
+                              name, histogram in sorted(
+                                  self._methods.items())])
+            statements = sorted(
+                (_statement_label(sql), stats)
+                for sql, stats in self._statements.items())
+            _histogram_lines(lines, 'rms_statement_duration_ms',
+                             'Latency of the execution of the SQL '
+                             'statements.',
+                             [({'statement': name}, stats.latency)
+                              for name, stats in statements])
+            _counter_lines(lines, 'rms_statement_rows_total',
+                           'Rows returned by the SQL statements.',
+                           [({'statement': name}, stats.rows)
+                            for name, stats in statements])
+            _histogram_lines(lines, 'rms_commit_duration_ms',
+                             'Latency of the commits.',
+                             [({}, self._commits)])
+            for name, help_text, counters in (
+                    ('rms_busy_errors_total', 'Statements failed because '
+                     'the database was locked.', self._busy),
+                    ('rms_busy_retries_total', 'Operations retried because '
+                     'the database was locked.', self._busy_retries),
+                    ('rms_slow_queries_total', 'Statements slower than the '
+                     'slow-query threshold.', self._slow)):
+                _counter_lines(lines, name, help_text,
+                               [({'method': method}, value) for
+                                method, value in sorted(counters.items())])
+        out.write('\n'.join(lines) + '\n')
+
+
+def _label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _label_value(str(value)))
+                             for name, value in sorted(labels.items()))
+
+
+def _histogram_lines(lines, name, help_text, series):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s histogram' % name)
+    for labels, histogram in series:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS + ('+Inf',),
+                                histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(dict(labels, le=bound)), cumulative))
+        lines.append('%s_sum%s %r' % (name, _labels(labels), histogram.sum))
+        lines.append('%s_count%s %d' % (name, _labels(labels),
+                                        histogram.count))
+
+
+def _counter_lines(lines, name, help_text, series):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s counter' % name)
+    for labels, value in series:
+        lines.append('%s%s %d' % (name, _labels(labels), value))
+
+
+class _InstrumentedCursor(object):
+    '''
+    Proxy of a sqlite3 cursor timing its statements and counting the rows
+    fetched.
+
+    '''
+    def __init__(self, cur, instrumentation, db_path, sql=None):
+        self.__dict__.update(_cur=cur, _instrumentation=instrumentation,
+                             _db_path=db_path, _sql=sql)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cur, name, value)
+
+    def execute(self, sql, parameters=()):
+        self.__dict__['_sql'] = sql
+        _timed(self._instrumentation, self._db_path, self._cur.execute, sql,
+               parameters, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.__dict__['_sql'] = sql
+        _timed(self._instrumentation, self._db_path, self._cur.executemany,
+               sql, seq_of_parameters, _first_parameters(seq_of_parameters))
+        return self
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        if row is not None:
+            self._instrumentation._add_rows(self._sql, 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cur.fetchmany(*args)
+        self._instrumentation._add_rows(self._sql, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cur.fetchall()
+        self._instrumentation._add_rows(self._sql, len(rows))
+        return rows
+
+    def __iter__(self):
+        count = 0
+        try:
+            for row in self._cur:
+                count += 1
+                yield row
+        finally:
+            self._instrumentation._add_rows(self._sql, count)
+
+
+def _first_parameters(seq_of_parameters):
+    '''
+    Returns the parameters of the first statement of an ``executemany``,
+    used to explain it, or None if they cannot be read without consuming an
+    iterator.
+
+    '''
+    if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters:
+        return seq_of_parameters[0]
+    return None
+
+
+def _timed(instrumentation, db_path, function, sql, parameters, explained):
+    start = time.time()
+    try:
+        result = function(sql, parameters)
+    except sqlite3.OperationalError, excp:
+        if is_busy_error(excp):
+            instrumentation._observe_busy()
+        raise
+    instrumentation._observe_statement(db_path, sql, explained,
+                                       time.time() - start)
+    return result
+
+
+class _InstrumentedSQLite(object):
+    '''
+    Proxy of a sqlite3 connection timing the statements and the commits.
+
+    '''
+    def __init__(self, con, instrumentation, db_path):
+        self.__dict__.update(_con=con, _instrumentation=instrumentation,
+                             _db_path=db_path)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._con, name, value)
+
+    def cursor(self):
+        return _InstrumentedCursor(self._con.cursor(), self._instrumentation,
+                                   self._db_path)
+
+    def execute(self, sql, parameters=()):
+        cur = _timed(self._instrumentation, self._db_path, self._con.execute,
+                     sql, parameters, parameters)
+        return _InstrumentedCursor(cur, self._instrumentation, self._db_path,
+                                   sql)
+
+    def executemany(self, sql, seq_of_parameters):
+        cur = _timed(self._instrumentation, self._db_path,
+                     self._con.executemany, sql, seq_of_parameters,
+                     _first_parameters(seq_of_parameters))
+        return _InstrumentedCursor(cur, self._instrumentation, self._db_path,
+                                   sql)
+
+    def commit(self):
+        start = time.time()
+        try:
+            self._con.commit()
+        except sqlite3.OperationalError, excp:
+            if is_busy_error(excp):
+                self._instrumentation._observe_busy()
+            raise
+        self._instrumentation._observe_commit(time.time() - start)
+
+
+def _timed_method(name):
+    method = getattr(Connection, name).im_func
+
+    def timed(self, *args, **kwargs):
+        instrumentation = self.instrumentation
+        local = instrumentation._local
+        if getattr(local, 'method', None) is not None:
+            #Called by another method: counted as part of the caller
+            return method(self, *args, **kwargs)
+        local.method = name
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            local.method = None
+            instrumentation._observe_method(name, time.time() - start)
+
+    def timed_generator(self, *args, **kwargs):
+        #The rows are read while the caller iterates
+        instrumentation = self.instrumentation
+        local = instrumentation._local
+        elapsed = 0.0
+        iterator = method(self, *args, **kwargs)
+        try:
+            while True:
+                previous = getattr(local, 'method', None)
+                local.method = name
+                start = time.time()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - start
+                    local.method = previous
+                yield row
+        finally:
+            instrumentation._observe_method(name, elapsed)
+
+    wrapper = timed_generator if inspect.isgeneratorfunction(method) \
+        else timed
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class InstrumentedConnection(Connection):
+    '''
+    :py:class:`database.Connection` whose public methods and statements are
+    measured by an :py:class:`Instrumentation`. Instances are returned by
+    :py:meth:`database.Engine.connect` when the Engine has an
+    instrumentation.
+
+    '''
+    def __init__(self, db_path, pool=None, profile=None, cache=None,
+                 record_mode='dict', instrumentation=None, retry_policy=None):
+        super(InstrumentedConnection, self).__init__(db_path, pool, profile,
+                                                     cache, record_mode,
+                                                     retry_policy)
+        self.instrumentation = instrumentation
+        self.con = _InstrumentedSQLite(self.con, instrumentation, db_path)
+
+    def _on_retry(self, method):
+        self.instrumentation.count_busy_retry(method)
+
+    def close(self):
+        if self.con:
+            self.con.commit()
+            #The pool gets back the sqlite3 connection, not the proxy
+            if isinstance(self.con, _InstrumentedSQLite):
+                self.con = self.con._con
+        super(InstrumentedConnection, self).close()
+
+    for _name, _ in inspect.getmembers(Connection, inspect.ismethod):
+        if not _name.startswith('_') and _name != 'close':
+            locals()[_name] = _timed_method(_name)
+    del _name, _
+
+
+class MetricsExporter(threading.Thread):
+    '''
+    Thread writing the metrics of an :py:class:`Instrumentation` to a file
+    every ``interval`` seconds, for instance for the textfile collector of
+    the Prometheus node exporter. The file is replaced atomically.
+
+    An export that fails, for instance on a full disk, is reported on the
+    standard error and counted in ``failures``, with the error in
+    ``last_error``, and the thread tries again at the next interval.
+
+    :param instrumentation: the metrics to export.
+    :type instrumentation: Instrumentation
+    :param str path: path of the file. If None the metrics are written to
+        the standard output.
+    :param float interval: seconds between two exports.
+
+    '''
+    def __init__(self, instrumentation, path=None, interval=15.0):
+        super(MetricsExporter, self).__init__(name='rms-metrics-exporter')
+        self.daemon = True
+        self.instrumentation = instrumentation
+        self.path = path
+        self.interval = interval
+        self.failures = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.instrumentation.export(self.path)
+            except Exception, excp:
+                self.failures += 1
+                self.last_error = excp
+                print >> sys.stderr, 'metrics export to %s failed: %s' % (
+                    self.path or 'stdout', excp)
+
+    def stop(self):
+        '''
+        Stops the thread after a last export.
+
+        '''
+        self._stop_event.set()
+        self.join()
+        self.instrumentation.export(self.path)
@@ -0,0 +1,217 @@
+'''
+Created on 16.10.2026
+
+Inventory and spend reports of the stock ledger.
+
+The reports are answered from the daily and weekly rollups of the ledger
+(tables ``stockDaily`` and ``stockWeekly``), which the triggers of the stock
+table keep up to date. Every query is a range scan of the primary key of a
+rollup, so its cost depends on the number of days in the range and not on
+the size of the ledger.
+
+Dates can be given as ``datetime.date`` objects or as strings in the format
+of the ledger (``dd-mm-yyyy``) or in ISO format (``yyyy-mm-dd``).
+
+:Example:
+
+>>> con = Engine().connect()
+>>> consumption(con, 'Milano', '01-02-2018', '28-02-2018', bucket='week')
+
+'''
+
+import datetime
+
+from database import (STATEMENTS, normalize_date, to_date, _fill_stock_rollups,
+                      _stock_aggregate_query, _STOCK_MEASURES,
+                      _STOCK_ROLLUP_KEYS)
+
+#Buckets of the consumption report and the rollup table that stores them.
+BUCKETS = {'day': ('stockDaily', 'day'), 'week': ('stockWeekly', 'week')}
+
+_CONSUMPTION = '''
+    SELECT {column}, itemId, sum(consumedQuantity), sum(wastedQuantity)
+    FROM {table}
+    WHERE restaurantId = ? AND {column} BETWEEN ? AND ?
+    GROUP BY {column}, itemId
+    ORDER BY {column}, itemId'''
+#Purchase totals over a range: the whole weeks are read from the weekly rollup
+#and the days before and after them from the daily rollup.
+_RANGE_TOTALS = '''
+    SELECT {group}, sum(purchasedQuantity), sum(purchasedValue)
+    FROM (SELECT {group}, purchasedQuantity, purchasedValue FROM stockDaily
+          WHERE restaurantId = ? AND day BETWEEN ? AND ?
+          UNION ALL
+          SELECT {group}, purchasedQuantity, purchasedValue FROM stockWeekly
+          WHERE restaurantId = ? AND week BETWEEN ? AND ?
+          UNION ALL
+          SELECT {group}, purchasedQuantity, purchasedValue FROM stockDaily
+          WHERE restaurantId = ? AND day BETWEEN ? AND ?)
+    GROUP BY {group}
+    HAVING sum(purchasedQuantity) > 0
+    ORDER BY {group}'''
+
+
+def week_of(value):
+    '''
+    Returns the Monday of the week of a date in ``yyyy-mm-dd`` format.
+
+    '''
+    day = to_date(value)
+    return (day - datetime.timedelta(days=day.weekday())).isoformat()
+
+
+def _restaurant_id(con, restaurantName):
+    row = con.con.execute(STATEMENTS['restaurant_id_by_name'],
+                          (restaurantName,)).fetchone()
+    if row is None:
+        raise ValueError("unknown restaurant %s" % restaurantName)
+    return row[0]
+
+
+def _split_range(start, end):
+    '''
+    Splits the inclusive range of dates ``[start, end]`` into the days before
+    the first whole week, the whole weeks and the days after them.
+
+    :return: three ``(first, last)`` tuples in ``yyyy-mm-dd`` format. Empty
+        ranges have ``first > last``.
+
+    '''
+    one_day = datetime.timedelta(days=1)
+    first_week = start + datetime.timedelta(days=-start.weekday() % 7)
+    after_weeks = end + one_day - datetime.timedelta(
+        days=(end + one_day).weekday())
+    if first_week >= after_weeks:
+        #No whole week: everything is read from the daily rollup
+        return ((start.isoformat(), end.isoformat()), ('1', '0'), ('1', '0'))
+    return ((start.isoformat(), (first_week - one_day).isoformat()),
+            (first_week.isoformat(),
+             (after_weeks - datetime.timedelta(days=7)).isoformat()),
+            (after_weeks.isoformat(), end.isoformat()))
+
+
+def _range_totals(con, group, restaurantName, start, end):
+    restaurant_id = _restaurant_id(con, restaurantName)
+    start, end = to_date(start), to_date(end)
+    if start > end:
+        return []
+    head, weeks, tail = _split_range(start, end)
+    pvalue = ((restaurant_id,) + head + (restaurant_id,) + weeks +
+              (restaurant_id,) + tail)
+    return con.con.execute(_RANGE_TOTALS.format(group=group),
+                           pvalue).fetchall()
+
+
+def consumption(con, restaurantName, start, end, bucket='day'):
+    '''
+    Consumed and wasted quantity of every item per day or per week.
+
+    :param con: open connection.
+    :type con: database.Connection
+    :param str start: first date of the range.
+    :param str end: last date of the range (inclusive).
+    :param str bucket: ``day`` or ``week``. Weeks start on Monday and are
+        identified by the date of their Monday. The weeks that overlap the
+        range are reported whole.
+    :return: list of dictionaries ordered by bucket and item:
+
+            .. code-block:: javascript
+
+                {'bucket': '2018-02-19', 'itemId': 4, 'consumed': 3,
+                 'wasted': 0}
+
+    :raises ValueError: if the restaurant, the bucket or a date are not
+        valid.
+
+    '''
+    if bucket not in BUCKETS:
+        raise ValueError("Unknown bucket %s" % bucket)
+    table, column = BUCKETS[bucket]
+    restaurant_id = _restaurant_id(con, restaurantName)
+    start = week_of(start) if bucket == 'week' else normalize_date(start)
+    query = _CONSUMPTION.format(table=table, column=column)
+    rows = con.con.execute(query, (restaurant_id, start,
+                                   normalize_date(end)))
+    return [{'bucket': row[0], 'itemId': row[1], 'consumed': row[2],
+             'wasted': row[3]} for row in rows]
+
+
+def spend_by_vendor(con, restaurantName, start, end):
+    '''
+    Quantity and value purchased from every vendor in a range of dates.
+
+    :return: list of dictionaries ordered by vendor:
+
+            .. code-block:: javascript
+
+                {'vendorId': 2, 'quantity': 15, 'spend': 44.85}
+
+        Purchases without a vendor have ``vendorId`` 0.
+    :raises ValueError: if the restaurant or a date are not valid.
+
+    '''
+    return [{'vendorId': row[0], 'quantity': row[1], 'spend': row[2]}
+            for row in _range_totals(con, 'vendorId', restaurantName, start,
+                                     end)]
+
+
+def cost_by_item(con, restaurantName, start, end):
+    '''
+    Quantity, value and average unit cost of the purchases of every item in
+    a range of dates.
+
+    :return: list of dictionaries ordered by item:
+
+            .. code-block:: javascript
+
+                {'itemId': 4, 'quantity': 15, 'spend': 44.85,
+                 'averageCost': 2.99}
+
+    :raises ValueError: if the restaurant or a date are not valid.
+
+    '''
+    return [{'itemId': row[0], 'quantity': row[1], 'spend': row[2],
+             'averageCost': row[2] / row[1] if row[1] else 0.0}
+            for row in _range_totals(con, 'itemId', restaurantName, start,
+                                     end)]
+
+
+def rebuild_rollups(con):
+    '''
+    Recomputes the daily and weekly rollups from the whole ledger in one
+    transaction.
+
+    :return: the number of rollup rows written.
+
+    '''
+    try:
+        count = _fill_stock_rollups(con.con)
+    except Exception:
+        con.con.rollback()
+        raise
+    con.con.commit()
+    return count
+
+
+def verify_rollups(con):
+    '''
+    Compares the rollups with the totals recomputed from the ledger. The
+    purchased values are compared rounded to 6 decimals.
+
+    :return: a dictionary with the rollup tables as keys and the number of
+        rows missing, extra or different as values.
+
+    '''
+    report = {}
+    for table, keys in sorted(_STOCK_ROLLUP_KEYS.items()):
+        columns = ', '.join(
+            'round(%s, 6)' % column if column == 'purchasedValue' else column
+            for column, _ in keys + _STOCK_MEASURES)
+        ledger = 'SELECT %s FROM (%s)' % (columns,
+                                          _stock_aggregate_query(keys))
+        rollup = 'SELECT %s FROM %s' % (columns, table)
+        report[table] = sum(
+            con.con.execute('SELECT count(*) FROM (%s EXCEPT %s)' %
+                            pair).fetchone()[0]
+            for pair in ((ledger, rollup), (rollup, ledger)))
+    return report
@@ -0,0 +1,622 @@
+'''
+Created on 16.10.2026
+
+Stores the data of every restaurant in its own database file.
+
+A :py:class:`ShardedEngine` keeps the users and the restaurants in a global
+catalog, which is an ordinary database file used through
+:py:class:`database.Engine`, and the items, vendors and stock of every
+restaurant in a shard file named after its ``restaurantId``. Each shard has
+its own SQLite write lock, so writes of different restaurants do not wait for
+each other.
+
+A shard has the same schema as the catalog. It holds a copy of the row of its
+restaurant and a stub (``userId`` and ``username``) of every user referenced
+by its stock, so the foreign keys and the methods of
+:py:class:`database.Connection` work unchanged inside the shard. The ids of
+items, vendors and stock transactions start at ``restaurantId * 2**32`` in
+every shard, so they are unique across shards.
+
+:Example:
+
+>>> engine = ShardedEngine('db/rms.db', 'db/shards')
+>>> con = engine.connect()
+>>> con.record_stock_transaction('Milano', 1, STOCK_PURCHASE, 10, 2.5)
+>>> con.get_all_expiring_batches(10)
+>>> con.close()
+
+'''
+
+import heapq, itertools, os, sqlite3, thread, threading
+from multiprocessing.pool import ThreadPool
+
+from database import (Engine, STATEMENTS, SEARCH_INDEXES, DEFAULT_POOL_SIZE,
+                      DEFAULT_PAGE_SIZE, DEFAULT_BULK_CHUNK_SIZE,
+                      RESTAURANT_DETAIL_FIELDS, open_connection)
+
+#Threads used to run a query on every shard.
+DEFAULT_FAN_OUT_THREADS = 8
+#First id of the items, vendors and stock of a shard: restaurantId << 32.
+SHARD_ID_BITS = 32
+#Tables whose rows belong to one restaurant and are stored in its shard.
+SHARDED_TABLES = ('item', 'vendor', 'stock')
+
+#Methods of database.Connection answered by the catalog.
+CATALOG_METHODS = ('get_user', 'get_restaurant', 'get_users',
+                   'get_restaurants', 'get_users_page',
+                   'get_restaurants_page', 'iter_users', 'iter_restaurants',
+                   'append_user', 'append_restaurant',
+                   'assign_user_to_restaurant', 'modify_user',
+                   'append_users_bulk', 'append_restaurants_bulk',
+                   'search_users', 'search_restaurants',
+                   'get_password_hash', 'get_password_hashes',
+                   'set_password_hash')
+#Methods of database.Connection whose first argument is a restaurant name and
+#that run in the shard of that restaurant.
+SHARD_METHODS = ('get_stock_level', 'get_stock_levels',
+                 'get_stock_transactions', 'get_expiring_batches')
+
+
+def _clone_schema(source, path, restaurant):
+    '''
+    Creates the shard file ``path`` with the schema of the sqlite3
+    connection ``source``, the row of its restaurant and the state of an
+    empty change log. The file is built under a temporary name and linked
+    into place, so concurrent creators never see a half built shard.
+
+    :param tuple restaurant: the restaurant row ``(restaurantId,
+        restaurantName, address, phone)``.
+
+    '''
+    objects = source.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND "
+        "name NOT LIKE 'sqlite_%' ORDER BY CASE type WHEN 'table' THEN 0 "
+        "WHEN 'index' THEN 1 ELSE 2 END").fetchall()
+    #The shadow tables of the full-text indexes are created with them
+    shadows = tuple('%s_' % name for name in SEARCH_INDEXES)
+    version = source.execute('PRAGMA user_version').fetchone()[0]
+    tmp_path = '%s.%d-%d.tmp' % (path, os.getpid(), thread.get_ident())
+    con = sqlite3.connect(tmp_path)
+    try:
+        with con:
+            for kind, name, sql in objects:
+                if kind != 'table' or not name.startswith(shadows):
+                    con.execute(sql)
+            #Seeded by the migrations, which never run on a shard
+            if any(name == 'changeLogState' for _, name, _ in objects):
+                con.execute('INSERT INTO changeLogState(id, truncatedSeq) '
+                            'VALUES(1, 0)')
+            con.execute('INSERT INTO restaurant(restaurantId, restaurantName, '
+                        'address, phone) VALUES(?,?,?,?)', restaurant)
+            first_id = restaurant[0] << SHARD_ID_BITS
+            con.executemany('INSERT INTO sqlite_sequence(name, seq) '
+                            'VALUES(?,?)',
+                            [(table, first_id) for table in SHARDED_TABLES])
+        con.execute('PRAGMA user_version = %d' % version)
+    finally:
+        con.close()
+    try:
+        os.link(tmp_path, path)
+    except OSError:
+        #Another thread or process created the shard first
+        if not os.path.exists(path):
+            raise
+    finally:
+        os.remove(tmp_path)
+
+
+class ShardedEngine(object):
+    '''
+    Abstraction of a database split in one file per restaurant.
+
+    :param str catalog_path: database file with the users and the
+        restaurants. :py:data:`database.DEFAULT_DB_PATH` by default.
+    :param str shards_dir: directory of the shard files. By default the
+        directory ``shards`` next to the catalog. It is created if needed.
+    :param int pool_size: size of the connection pool of the catalog and of
+        every shard.
+    :param int fan_out_threads: threads used by the queries that run on
+        every shard.
+    :param engine_options: other keyword arguments of
+        :py:class:`database.Engine`, used for the catalog and the shards.
+
+    '''
+    def __init__(self, catalog_path=None, shards_dir=None,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 fan_out_threads=DEFAULT_FAN_OUT_THREADS, **engine_options):
+        super(ShardedEngine, self).__init__()
+        self.catalog = Engine(catalog_path, pool_size, **engine_options)
+        if shards_dir is None:
+            shards_dir = os.path.join(
+                os.path.dirname(os.path.abspath(self.catalog.db_path)),
+                'shards')
+        if not os.path.isdir(shards_dir):
+            os.makedirs(shards_dir)
+        self.shards_dir = shards_dir
+        self.pool_size = pool_size
+        self.fan_out_threads = fan_out_threads
+        self.engine_options = engine_options
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._fan_out_pool = None
+
+    def shard_path(self, restaurant_id):
+        '''
+        Returns the location of the shard file of a restaurant.
+
+        '''
+        return os.path.join(self.shards_dir, 'restaurant_%d.db' %
+                            restaurant_id)
+
+    def shard(self, restaurant_id):
+        '''
+        Returns the :py:class:`database.Engine` of the shard of a
+        restaurant. The shard file is created the first time.
+
+        :raises ValueError: if the restaurant is not in the catalog.
+
+        '''
+        engine = self._shards.get(restaurant_id)
+        if engine is not None:
+            return engine
+        with self._lock:
+            if restaurant_id not in self._shards:
+                path = self.shard_path(restaurant_id)
+                if not os.path.exists(path):
+                    self._create_shard(restaurant_id, path)
+                self._shards[restaurant_id] = Engine(path, self.pool_size,
+                                                     **self.engine_options)
+            return self._shards[restaurant_id]
+
+    def _create_shard(self, restaurant_id, path):
+        #The schema of the catalog is up to date once it has been connected
+        self.catalog.connect().close()
+        source = open_connection(self.catalog.db_path, self.catalog.profile)
+        try:
+            restaurant = source.execute(
+                'SELECT restaurantId, restaurantName, address, phone '
+                'FROM restaurant WHERE restaurantId = ?',
+                (restaurant_id,)).fetchone()
+            if restaurant is None:
+                raise ValueError("unknown restaurant %s" % restaurant_id)
+            _clone_schema(source, path, tuple(restaurant))
+        finally:
+            source.close()
+
+    def restaurants(self, with_shard=False):
+        '''
+        Returns a list of tuples ``(restaurantId, restaurantName)`` with the
+        restaurants of the catalog.
+
+        :param bool with_shard: if ``True`` only the restaurants whose shard
+            file exists are returned.
+
+        '''
+        con = self.catalog.connect()
+        try:
+            restaurants = [tuple(row) for row in con.con.execute(
+                'SELECT restaurantId, restaurantName FROM restaurant '
+                'ORDER BY restaurantId')]
+        finally:
+            con.close()
+        if with_shard:
+            restaurants = [restaurant for restaurant in restaurants
+                           if os.path.exists(self.shard_path(restaurant[0]))]
+        return restaurants
+
+    def connect(self):
+        '''
+        Creates a connection to the catalog and the shards.
+
+        :rtype: ShardedConnection
+
+        '''
+        return ShardedConnection(self)
+
+    def fan_out_pool(self):
+        '''
+        Returns the thread pool that runs the queries on every shard.
+
+        '''
+        with self._lock:
+            if self._fan_out_pool is None:
+                self._fan_out_pool = ThreadPool(self.fan_out_threads)
+            return self._fan_out_pool
+
+    def move_to_shards(self):
+        '''
+        Copies the items, vendors and stock of every restaurant from the
+        catalog into its shard. Vendors without restaurant that supplied the
+        restaurant are copied too. Rows already in the shard are skipped, so
+        it can be run again. The catalog is not modified.
+
+        :return: dictionary with the restaurant names as keys and the number
+            of stock transactions copied as values.
+
+        '''
+        copied = {}
+        for restaurant_id, name in self.restaurants():
+            engine = self.shard(restaurant_id)
+            con = engine.connect()
+            raw = con.con
+            raw.execute('ATTACH DATABASE ? AS catalog',
+                        (self.catalog.db_path,))
+            try:
+                pvalue = (restaurant_id,)
+                raw.execute('INSERT OR IGNORE INTO main.item SELECT * FROM '
+                            'catalog.item WHERE CAST(restaurantId AS '
+                            'INTEGER) = ?', pvalue)
+                raw.execute('INSERT OR IGNORE INTO main.vendor SELECT * FROM '
+                            'catalog.vendor WHERE restaurantId = ? OR '
+                            'vendorId IN (SELECT vendorId FROM catalog.stock '
+                            'WHERE restaurantId = ?)', pvalue * 2)
+                raw.execute('INSERT OR IGNORE INTO main.user(userId, '
+                            'username) SELECT userId, username FROM '
+                            'catalog.user WHERE userId IN (SELECT userId FROM '
+                            'catalog.stock WHERE restaurantId = ?)', pvalue)
+                copied[name] = raw.execute(
+                    'INSERT OR IGNORE INTO main.stock SELECT * FROM '
+                    'catalog.stock WHERE restaurantId = ? ORDER BY id',
+                    pvalue).rowcount
+                raw.commit()
+            except Exception:
+                raw.rollback()
+                raise
+            finally:
+                raw.execute('DETACH DATABASE catalog')
+                con.close()
+        return copied
+
+    def dispose(self):
+        '''
+        Closes the idle connections of the catalog and of the shards and
+        stops the fan-out threads.
+
+        '''
+        with self._lock:
+            if self._fan_out_pool is not None:
+                self._fan_out_pool.close()
+                self._fan_out_pool.join()
+                self._fan_out_pool = None
+            shards = self._shards.values()
+        self.catalog.dispose()
+        for engine in shards:
+            engine.dispose()
+
+
+def _catalog_method(name):
+    def method(self, *args, **kwargs):
+        return getattr(self.catalog, name)(*args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = ('Runs :py:meth:`database.Connection.%s` on the '
+                      'catalog.' % name)
+    return method
+
+
+def _shard_method(name):
+    def method(self, restaurantName, *args, **kwargs):
+        return getattr(self._restaurant_connection(restaurantName), name)(
+            restaurantName, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = ('Runs :py:meth:`database.Connection.%s` on the shard '
+                      'of the restaurant.' % name)
+    return method
+
+
+class ShardedConnection(object):
+    '''
+    API of :py:class:`database.Connection` over a :py:class:`ShardedEngine`.
+
+    The methods of :py:data:`CATALOG_METHODS` run on the catalog and the
+    methods of :py:data:`SHARD_METHODS` on the shard of the restaurant given
+    as first argument. The queries over all the restaurants run on every
+    shard in parallel and merge the results. A restaurant that is not in
+    the catalog gives the same results as with
+    :py:class:`database.Connection`.
+
+    The connections of the shards are opened when they are first used. Use
+    the method :py:meth:`close` to release them.
+
+    '''
+    def __init__(self, engine):
+        super(ShardedConnection, self).__init__()
+        self.engine = engine
+        self.catalog = engine.catalog.connect()
+        self._shards = {}
+
+    for _name in CATALOG_METHODS:
+        locals()[_name] = _catalog_method(_name)
+    for _name in SHARD_METHODS:
+        locals()[_name] = _shard_method(_name)
+    del _name
+
+    def close(self):
+        '''
+        Closes the connections of the catalog and of the shards.
+
+        '''
+        for con in self._shards.values():
+            con.close()
+        self._shards = {}
+        self.catalog.close()
+
+    def _restaurant_id(self, restaurantName):
+        row = self.catalog.con.execute(STATEMENTS['restaurant_id_by_name'],
+                                       (restaurantName,)).fetchone()
+        if row is None:
+            raise ValueError("unknown restaurant %s" % restaurantName)
+        return row[0]
+
+    def _restaurant_connection(self, restaurantName):
+        '''
+        Returns the connection of the shard of a restaurant, or the
+        connection of the catalog if the restaurant does not exist. The
+        catalog has no such restaurant either, so the methods of
+        :py:class:`database.Connection` return there what they return for
+        an unknown restaurant.
+
+        '''
+        try:
+            restaurant_id = self._restaurant_id(restaurantName)
+        except ValueError:
+            return self.catalog
+        return self._shard_connection(restaurant_id)
+
+    def _shard_connection(self, restaurant_id):
+        con = self._shards.get(restaurant_id)
+        if con is None:
+            con = self.engine.shard(restaurant_id).connect()
+            self._shards[restaurant_id] = con
+        return con
+
+    def shard(self, restaurantName):
+        '''
+        Returns the :py:class:`database.Connection` of the shard of a
+        restaurant, for instance to run the reports of
+        :py:mod:`reporting` on it.
+
+        :raises ValueError: if the restaurant is not in the catalog.
+
+        '''
+        return self._shard_connection(self._restaurant_id(restaurantName))
+
+    def modify_restaurant(self, restaurantName, restaurant):
+        '''
+        Runs :py:meth:`database.Connection.modify_restaurant` on the catalog
+        and updates the copy of the restaurant in its shard.
+
+        '''
+        try:
+            restaurant_id = self._restaurant_id(restaurantName)
+        except ValueError:
+            return None
+        result = self.catalog.modify_restaurant(restaurantName, restaurant)
+        if result:
+            shard = self._shard_connection(restaurant_id)
+            shard.modify_restaurant(restaurantName, restaurant)
+        return result
+
+    def delete_user(self, username):
+        '''
+        Runs :py:meth:`database.Connection.delete_user` on the catalog and
+        then on every shard, where it deletes the stub of the user. As in a
+        single database, the foreign keys delete the stock transactions of
+        the user with it.
+
+        The shards are cleaned even if the user is no longer in the
+        catalog, so a call that failed half way can be repeated.
+
+        :return: True if the user was deleted from the catalog.
+
+        '''
+        deleted = self.catalog.delete_user(username)
+        self.fan_out('delete_user', username)
+        return deleted
+
+    def get_restaurant_details(self, restaurantName, fields=None):
+        '''
+        Runs :py:meth:`database.Connection.get_restaurant_details` on the
+        catalog for the restaurant and its staff, and on the shard of the
+        restaurant for the items and vendors.
+
+        '''
+        if fields is None:
+            fields = RESTAURANT_DETAIL_FIELDS
+        details = self.catalog.get_restaurant_details(
+            restaurantName, [field for field in fields if field == 'staff'])
+        shard_fields = [field for field in fields if field != 'staff']
+        if details is None or not shard_fields:
+            return details
+        shard = self._shard_connection(details['restaurant']['restaurantId'])
+        shard_details = shard.get_restaurant_details(restaurantName,
+                                                     shard_fields)
+        for field in shard_fields:
+            details[field] = shard_details[field]
+        return details
+
+    def record_stock_transaction(self, restaurantName, itemId,
+                                 transactionType, quantity, price=None,
+                                 vendorId=None, username=None, date=None,
+                                 expireDate=None):
+        '''
+        Runs :py:meth:`database.Connection.record_stock_transaction` on the
+        shard of the restaurant. The user is looked up in the catalog and a
+        stub of it is stored in the shard.
+
+        :raises ValueError: if the restaurant or the user do not exist.
+
+        '''
+        shard = self.shard(restaurantName)
+        if username is not None:
+            row = self.catalog.con.execute(STATEMENTS['user_id_by_username'],
+                                           (username,)).fetchone()
+            if row is None:
+                raise ValueError("unknown user %s" % username)
+            shard.con.execute('INSERT OR IGNORE INTO user(userId, username) '
+                              'VALUES(?,?)', (row[0], username))
+            shard.con.commit()
+        return shard.record_stock_transaction(
+            restaurantName, itemId, transactionType, quantity, price,
+            vendorId, username, date, expireDate)
+
+    def _append_bulk(self, method, records, chunk_size):
+        '''
+        Splits the records of a bulk import by restaurant and runs the bulk
+        method on every shard. The indexes of the errors refer to the
+        position of the records in ``records``.
+
+        '''
+        report = {'inserted': 0, 'errors': []}
+        records = iter(records)
+        start = 0
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            groups = {}
+            for index, record in enumerate(chunk, start):
+                try:
+                    restaurant_id = self._restaurant_id(
+                        record['restaurantName'])
+                except (KeyError, TypeError, ValueError), excp:
+                    key = None
+                    if isinstance(record, dict):
+                        key = record.get('itemName', record.get('name'))
+                    report['errors'].append({'index': index, 'key': key,
+                                             'error': str(excp)})
+                    continue
+                groups.setdefault(restaurant_id, []).append((index, record))
+            for restaurant_id, group in sorted(groups.items()):
+                shard = self._shard_connection(restaurant_id)
+                result = getattr(shard, method)(
+                    [record for _, record in group], chunk_size)
+                report['inserted'] += result['inserted']
+                for error in result['errors']:
+                    error['index'] = group[error['index']][0]
+                    report['errors'].append(error)
+            start += len(chunk)
+        report['errors'].sort(key=lambda error: error['index'])
+        return report
+
+    def append_items_bulk(self, items, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Runs :py:meth:`database.Connection.append_items_bulk` on the shards
+        of the restaurants of the items.
+
+        '''
+        return self._append_bulk('append_items_bulk', items, chunk_size)
+
+    def append_vendors_bulk(self, vendors, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        '''
+        Runs :py:meth:`database.Connection.append_vendors_bulk` on the
+        shards of the restaurants of the vendors.
+
+        '''
+        return self._append_bulk('append_vendors_bulk', vendors, chunk_size)
+
+    def search_items(self, query, restaurantName=None,
+                     limit=DEFAULT_PAGE_SIZE, offset=0):
+        '''
+        Runs :py:meth:`database.Connection.search_items` on the shard of the
+        restaurant or, without restaurant, on every shard, merging the
+        results by rank. The ranks of different shards are computed from
+        the statistics of each shard, so the merged order is approximate.
+
+        '''
+        if restaurantName is not None:
+            return self._restaurant_connection(restaurantName).search_items(
+                query, restaurantName, limit, offset)
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1")
+        results = [items for _, (items, _) in
+                   self.fan_out('search_items', query, None,
+                                offset + limit + 1, 0)]
+        merged = list(itertools.islice(
+            heapq.merge(*[[(item['rank'], item['itemId'], item)
+                           for item in items] for items in results]),
+            offset, offset + limit + 1))
+        items = [item for _, _, item in merged[:limit]]
+        if len(merged) > limit:
+            return items, offset + limit
+        return items, None
+
+    def fan_out(self, method, *args, **kwargs):
+        '''
+        Runs a method of :py:class:`database.Connection` on the shard of
+        every restaurant in parallel. Each call uses its own connection.
+        Restaurants without shard file have no data and are skipped.
+
+        :Example:
+
+        >>> con.fan_out('get_stock_levels', restaurant_name=True)
+
+        :param str method: name of the method.
+        :param bool restaurant_name: keyword argument; if ``True`` the name
+            of the restaurant is passed as first argument.
+        :return: list of tuples ``(restaurantName, result)`` ordered by
+            restaurantId.
+
+        '''
+        with_name = kwargs.pop('restaurant_name', False)
+        engine = self.engine
+
+        def run(restaurant):
+            restaurant_id, name = restaurant
+            con = engine.shard(restaurant_id).connect()
+            try:
+                call_args = ((name,) + args) if with_name else args
+                return name, getattr(con, method)(*call_args, **kwargs)
+            finally:
+                con.close()
+        return engine.fan_out_pool().map(run, engine.restaurants(True))
+
+    def get_all_stock_levels(self):
+        '''
+        Extracts the current stock of every item of every restaurant.
+
+        :return: list of dictionaries with the format provided in the method
+            :py:meth:`database.Connection._create_stock_level_object` plus
+            the key ``restaurantName``.
+
+        '''
+        levels = []
+        for name, result in self.fan_out('get_stock_levels',
+                                         restaurant_name=True):
+            for level in result:
+                level['restaurantName'] = name
+                levels.append(level)
+        return levels
+
+    def get_all_expiring_batches(self, limit=10, before=None):
+        '''
+        Extracts the batches of all the restaurants that expire first.
+
+        :return: list of at most ``limit`` dictionaries with the format
+            provided in the method
+            :py:meth:`database.Connection.get_expiring_batches` plus the key
+            ``restaurantName``, ordered by expiry date.
+
+        '''
+        results = []
+        for name, batches in self.fan_out('get_expiring_batches', limit,
+                                          before, restaurant_name=True):
+            for batch in batches:
+                batch['restaurantName'] = name
+            results.append(batches)
+        merged = heapq.merge(*[[(batch['expireDate'], batch['id'], batch)
+                                for batch in batches]
+                               for batches in results])
+        return [batch for _, _, batch in itertools.islice(merged, limit)]
+
+    def sweep_expired_batches(self, today=None):
+        '''
+        Runs :py:meth:`database.Connection.sweep_expired_batches` on every
+        shard in parallel.
+
+        :return: list with the batches flagged in all the shards.
+
+        '''
+        flagged = []
+        for _, batches in self.fan_out('sweep_expired_batches', today):
+            flagged.extend(batches)
+        return flagged
@@ -0,0 +1,95 @@
+'''
+Created on 16.10.2026
+
+Command line tool that checks or rebuilds the on-hand stock aggregates
+(table ``stockLevel``) from the raw stock ledger, and flags the expired
+batches::
+
+    python service/stock_levels.py verify
+    python service/stock_levels.py --db db/rms.db rebuild
+    python service/stock_levels.py sweep
+
+``verify`` exits with status 1 if any aggregate differs from the ledger.
+``sweep`` is meant to be scheduled, for instance daily from cron, and prints
+one line per batch that expired since the previous sweep.
+
+'''
+
+import argparse, sys
+
+from database import Engine, DEFAULT_DB_PATH
+
+
+def verify(db_path):
+    '''
+    Returns the aggregates that differ from the ledger, as reported by
+    :py:meth:`database.Connection.verify_stock_levels`.
+
+    '''
+    engine = Engine(db_path, pool_size=1)
+    con = engine.connect()
+    try:
+        return con.verify_stock_levels()
+    finally:
+        con.close()
+        engine.dispose()
+
+
+def rebuild(db_path):
+    '''
+    Recomputes all the aggregates and returns how many were written.
+
+    '''
+    engine = Engine(db_path, pool_size=1)
+    con = engine.connect()
+    try:
+        return con.rebuild_stock_levels()
+    finally:
+        con.close()
+        engine.dispose()
+
+
+def sweep(db_path, today=None):
+    '''
+    Flags the expired batches and returns them, as reported by
+    :py:meth:`database.Connection.sweep_expired_batches`.
+
+    '''
+    engine = Engine(db_path, pool_size=1)
+    con = engine.connect()
+    try:
+        return con.sweep_expired_batches(today)
+    finally:
+        con.close()
+        engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verify or rebuild the '
+                                     'on-hand stock aggregates, or flag the '
+                                     'expired batches.')
+    parser.add_argument('command', choices=('verify', 'rebuild', 'sweep'))
+    parser.add_argument('--db', default=DEFAULT_DB_PATH,
+                        help='database file (default %(default)s)')
+    parser.add_argument('--today', help='date of the sweep (default: today)')
+    args = parser.parse_args(argv)
+    if args.command == 'sweep':
+        for batch in sweep(args.db, args.today):
+            print 'restaurant %s item %s batch %s: %s expired on %s' % (
+                batch['restaurantId'], batch['itemId'], batch['id'],
+                batch['remaining'], batch['expireDate'])
+        return 0
+    if args.command == 'rebuild':
+        print '%d stock aggregates rebuilt' % rebuild(args.db)
+        return 0
+    mismatches = verify(args.db)
+    for mismatch in mismatches:
+        print >> sys.stderr, 'restaurant %s item %s: expected %s, found %s' % (
+            mismatch['restaurantId'], mismatch['itemId'],
+            mismatch['expected'], mismatch['actual'])
+    print '%d stock aggregates differ from the ledger' % len(mismatches)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
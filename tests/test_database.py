@@ -0,0 +1,319 @@
+'''
+Created on 16.10.2026
+
+Tests of the database API provided by :py:mod:`database`. Every test works
+on a temporary copy of ``db/rms.db``. Run them from the root of the
+repository with::
+
+    python -m unittest discover tests
+
+'''
+
+import multiprocessing, os, random, shutil, sqlite3, sys, tempfile
+import threading, time, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'service'))
+
+from auth import Authenticator, PasswordHasher
+from database import (Engine, ReplicaConnection, RetryPolicy, STOCK_PURCHASE,
+                      is_busy_error)
+from instrumentation import Instrumentation, MetricsExporter
+from sharding import ShardedEngine
+
+DB_PATH = os.path.join(ROOT, 'db', 'rms.db')
+USER = {'firstname': 'test', 'lastname': 'user', 'phone': '0400000000',
+        'email': 'test@example.com', 'password': 'secret',
+        'dob': '01-01-2000'}
+
+
+class DatabaseTestCase(unittest.TestCase):
+    '''
+    Copies the database file to a temporary directory before every test and
+    removes it afterwards.
+
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='rms-test-')
+        self.db_path = os.path.join(self.tmp_dir, 'rms.db')
+        shutil.copy(DB_PATH, self.db_path)
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def engine(self, **options):
+        engine = Engine(self.db_path, **options)
+        self.engines.append(engine)
+        return engine
+
+    def count_users(self, prefix):
+        con = sqlite3.connect(self.db_path)
+        try:
+            return con.execute('SELECT count(*) FROM user WHERE username '
+                               'LIKE ?', (prefix + '%',)).fetchone()[0]
+        finally:
+            con.close()
+
+
+class AppendUserConcurrencyTestCase(DatabaseTestCase):
+    WORKERS = 8
+    USERNAMES = 200
+
+    def test_concurrent_appends(self):
+        engine = self.engine(pool_size=self.WORKERS)
+        engine.connect().close()
+        names = ['stress%d' % i for i in xrange(self.USERNAMES)]
+        successes = dict((name, 0) for name in names)
+        errors = []
+        lock = threading.Lock()
+
+        def worker(seed):
+            order = list(names)
+            random.Random(seed).shuffle(order)
+            con = engine.connect()
+            try:
+                for name in order:
+                    try:
+                        added = con.append_user(name, USER)
+                    except Exception, excp:
+                        with lock:
+                            errors.append(excp)
+                        continue
+                    if added is not None:
+                        with lock:
+                            successes[name] += 1
+            finally:
+                con.close()
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in xrange(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        #Every username reported as added by exactly one call
+        self.assertEqual(set(successes.values()), set([1]))
+        self.assertEqual(self.count_users('stress'), self.USERNAMES)
+
+
+def _contention_worker(args):
+    '''
+    Body of one process of :py:class:`ProcessContentionTestCase`: adds and
+    then modifies ``writes`` users through its own Engine.
+
+    :return: a tuple ``(failed_writes, busy_errors, other_errors)``, the
+        errors as strings.
+
+    '''
+    path, number, writes = args
+    engine = Engine(path, pool_size=1, auto_migrate=False,
+                    retry_policy=RetryPolicy())
+    modified = dict(USER, firstname='modified')
+    failed = []
+    busy = []
+    other = []
+    con = engine.connect()
+    try:
+        for i in xrange(writes):
+            name = 'contention%d_%d' % (number, i)
+            for call, arguments in ((con.append_user, (name, USER)),
+                                   (con.modify_user, (name, modified))):
+                try:
+                    if call(*arguments) is None:
+                        failed.append('%s %s' % (call.__name__, name))
+                except sqlite3.Error, excp:
+                    (busy if is_busy_error(excp) else other).append(str(excp))
+    finally:
+        con.close()
+        engine.dispose()
+    return failed, busy, other
+
+
+class ProcessContentionTestCase(DatabaseTestCase):
+    WORKERS = 4
+    WRITES = 50
+
+    def test_writes_from_several_processes(self):
+        #Apply the migrations before the processes start
+        engine = self.engine(pool_size=1)
+        engine.connect().close()
+        pool = multiprocessing.Pool(self.WORKERS)
+        try:
+            results = pool.map(_contention_worker,
+                               [(self.db_path, i, self.WRITES)
+                                for i in xrange(self.WORKERS)])
+        finally:
+            pool.close()
+            pool.join()
+        for failed, busy, other in results:
+            self.assertEqual(busy, [])
+            self.assertEqual(other, [])
+            self.assertEqual(failed, [])
+        #Every write was committed
+        self.assertEqual(self.count_users('contention'),
+                         self.WORKERS * self.WRITES)
+        con = sqlite3.connect(self.db_path)
+        try:
+            self.assertEqual(con.execute(
+                "SELECT count(*) FROM user WHERE username LIKE 'contention%' "
+                "AND firstname = 'modified'").fetchone()[0],
+                self.WORKERS * self.WRITES)
+        finally:
+            con.close()
+
+
+class ReplicaConnectionTestCase(DatabaseTestCase):
+
+    def test_interrupt_is_not_wrapped(self):
+        #The methods wrapped by _write_method are named write
+        self.assertEqual(
+            ReplicaConnection.interrupt.im_func.__code__.co_name,
+            'interrupt')
+
+    def test_interrupt_never_borrows_a_writer(self):
+        engine = self.engine(pool_size=1, pool_timeout=0.2, readers=1)
+        con = engine.connect()
+        try:
+            checkouts = engine.pool.metrics()['checkouts']
+            con.interrupt()
+            self.assertEqual(engine.pool.metrics()['checkouts'], checkouts)
+            #With every writer in use it returns at once
+            writer = engine.pool.checkout()
+            try:
+                con.interrupt()
+            finally:
+                engine.pool.checkin(writer)
+            self.assertIsNone(con._active)
+            self.assertIsNotNone(con.get_user('ahmad'))
+            self.assertEqual(engine.pool.metrics()['in_use'], 0)
+        finally:
+            con.close()
+
+
+class AuthenticatorTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(AuthenticatorTestCase, self).setUp()
+        self.auth = Authenticator(self.engine(),
+                                  PasswordHasher(iterations=1000), threads=2)
+        self.auth.register_user('authtest', USER)
+        self.token = self.auth.verify_credentials('authtest', 'secret')
+
+    def tearDown(self):
+        self.auth.close()
+        super(AuthenticatorTestCase, self).tearDown()
+
+    def test_session(self):
+        self.assertEqual(self.auth.check_session(self.token), 'authtest')
+        self.assertIsNone(self.auth.verify_credentials('authtest', 'wrong'))
+        self.assertIsNone(self.auth.verify_credentials('nobody', 'secret'))
+
+    def test_session_ends_when_the_user_is_deleted(self):
+        con = self.auth.engine.connect()
+        try:
+            self.assertIsNotNone(con.delete_user('authtest'))
+        finally:
+            con.close()
+        self.assertIsNone(self.auth.check_session(self.token))
+
+    def test_session_ends_when_the_hash_is_replaced(self):
+        con = self.auth.engine.connect()
+        try:
+            self.assertTrue(con.set_password_hash(
+                'authtest', self.auth.hasher.hash('other')))
+        finally:
+            con.close()
+        self.assertIsNone(self.auth.check_session(self.token))
+        self.assertIsNotNone(self.auth.verify_credentials('authtest',
+                                                          'other'))
+
+    def test_missing_password_costs_a_hash(self):
+        hasher = PasswordHasher(iterations=200000)
+        for stored in (None, '', 'pbkdf2_malformed'):
+            start = time.time()
+            self.assertFalse(hasher.verify('secret', stored))
+            self.assertGreater(time.time() - start, 0.01)
+
+
+class ShardedConnectionTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        super(ShardedConnectionTestCase, self).setUp()
+        self.sharded = ShardedEngine(self.db_path)
+        self.sharded.move_to_shards()
+        self.con = self.sharded.connect()
+
+    def tearDown(self):
+        self.con.close()
+        self.sharded.dispose()
+        super(ShardedConnectionTestCase, self).tearDown()
+
+    def test_compact_changes_keeps_its_position(self):
+        shard = self.con.shard('Milano')
+        shard.record_stock_transaction('Milano', 1, STOCK_PURCHASE, 3, 1.0)
+        shard.record_stock_transaction('Milano', 1, STOCK_PURCHASE, 4, 1.0)
+        result = shard.compact_changes(max_rows=1)
+        self.assertGreater(result['truncatedSeq'], 0)
+        self.assertEqual(shard.compact_changes()['truncatedSeq'],
+                         result['truncatedSeq'])
+
+    def test_unknown_restaurant(self):
+        self.assertEqual(self.con.get_stock_levels('nowhere'), [])
+        self.assertIsNone(self.con.get_stock_level('nowhere', 1))
+        self.assertEqual(self.con.get_stock_transactions('nowhere', 1),
+                         ([], None))
+        self.assertEqual(self.con.get_expiring_batches('nowhere'), [])
+        self.assertEqual(self.con.search_items('a', 'nowhere'), ([], None))
+        self.assertIsNone(self.con.modify_restaurant(
+            'nowhere', {'restaurantName': 'x', 'address': 'x',
+                        'phone': 'x'}))
+
+    def test_delete_user_cascades_to_the_shards(self):
+        shard = self.con.shard('Milano')
+        self.con.record_stock_transaction('Milano', 1, STOCK_PURCHASE, 5,
+                                          1.0, username='ahmad')
+        user_stock = ('SELECT count(*) FROM stock WHERE userId = '
+                      '(SELECT userId FROM user WHERE username = ?)')
+        self.assertGreater(shard.con.execute(user_stock,
+                                             ('ahmad',)).fetchone()[0], 0)
+        self.assertTrue(self.con.delete_user('ahmad'))
+        self.assertIsNone(self.con.get_user('ahmad'))
+        for restaurant_id, _ in self.sharded.restaurants(True):
+            raw = sqlite3.connect(self.sharded.shard_path(restaurant_id))
+            try:
+                self.assertEqual(raw.execute(
+                    "SELECT count(*) FROM user WHERE username = 'ahmad'"
+                    ).fetchone()[0], 0)
+            finally:
+                raw.close()
+        self.assertFalse(self.con.delete_user('ahmad'))
+
+
+class MetricsExporterTestCase(DatabaseTestCase):
+
+    def test_failed_exports_do_not_stop_the_thread(self):
+        path = os.path.join(self.tmp_dir, 'missing', 'metrics.prom')
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            exporter = MetricsExporter(Instrumentation(), path, interval=0.01)
+            deadline = time.time() + 5
+            while exporter.failures < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(exporter.is_alive())
+            self.assertGreaterEqual(exporter.failures, 2)
+            self.assertIsInstance(exporter.last_error, IOError)
+            os.mkdir(os.path.dirname(path))
+            exporter.stop()
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()